@@ -0,0 +1,312 @@
+import os
+import time
+import random
+import select
+import logging
+import timerfd
+from typing import Callable
+
+from tracker import Tracker, UDPTracker, udp_socket, resolver
+from peer import Peer
+
+class Tier:
+    trackers: list[Tracker]
+    current: int = 0
+    active: Tracker = None
+    next_announce: float = 0
+    failures: int = 0
+    event: str = None
+    # Event asked for while an announce was running, sent once it is over
+    pending_event: str = None
+    fileno: int = None
+    scraping: bool = False
+
+    def __init__(self, trackers: list[Tracker]) -> None:
+        self.trackers = trackers
+
+    def __repr__(self) -> str:
+        return f'Tier({[tracker.url for tracker in self.trackers]})'
+
+class Announcer:
+    """
+    Announces to every tier of the announce list at once from the event loop (BEP 12).
+    Trackers in a tier are shuffled once and tried in order, the one that answers is
+    moved to the front of its tier. Peers from every tracker are merged.
+
+    Each tier re-announces after the interval its tracker asked for, and backs off
+    exponentially while every tracker in it fails.
+    """
+    tiers: list[Tier]
+    peers: dict
+    logger: logging.Logger
+
+    default_interval = 1800
+    retry_interval = 30
+    max_retry_interval = 1800
+    stop_timeout = 5
+    stopping = False
+
+    def __init__(self, announce_list: list, info_hash: bytes, peer_id: bytes, port: int, encoding: str, ep: select.epoll, status: Callable) -> None:
+        """
+        status() returns (left, uploaded, downloaded) for the next announce
+        """
+        self.ep = ep
+        self.status = status
+        self.logger = logging.getLogger(__name__)
+        self.tiers = []
+        for urls in announce_list:
+            trackers = []
+            for url in urls:
+                try:
+                    trackers.append(Tracker.create_tracker(url, info_hash, peer_id, port, encoding))
+                except (ValueError, NotImplementedError):
+                    self.logger.info(f'Unsupported tracker {url}')
+            random.shuffle(trackers)
+            if len(trackers) > 0:
+                self.tiers.append(Tier(trackers))
+        self.tier_of = {tracker: tier for tier in self.tiers for tracker in tier.trackers}
+        self.active = {}
+        self.peers = {}
+        self.timer = timerfd.create(timerfd.CLOCK_MONOTONIC, 0)
+        ep.register(self.timer, select.EPOLLIN)
+        # every UDP tracker answers on one shared socket
+        self.udp = None
+        if any(isinstance(tracker, UDPTracker) for tracker in self.tier_of):
+            self.udp = udp_socket()
+            ep.register(self.udp.fileno(), select.EPOLLIN)
+        # Tracker hostnames are resolved off the loop, the tier is in progress until the lookup is done
+        self.resolver = resolver()
+        ep.register(self.resolver.fileno(), select.EPOLLIN)
+
+    def announce(self, event: str = None) -> list[Peer]:
+        """
+        Announces now on every tier that is not already announcing, tiers that are get the
+        event once their announce is over
+        """
+        peers = []
+        for tier in self.tiers:
+            if tier.active is None:
+                peers += self._start(tier, event)
+            elif event is not None:
+                self.logger.info(f'{tier} is announcing, {event} is sent after it')
+                tier.pending_event = event
+        self._arm()
+        return peers
+
+    def stop(self) -> None:
+        """
+        Announces stopped on every tier a tracker knows us in, waiting up to stop_timeout
+        seconds for the answers
+        """
+        self.stopping = True
+        for tier in self.tiers:
+            if tier.active is not None:
+                self._unregister(tier)
+                tier.active.close()
+                tier.active = None
+        # Wait on our own sockets only, the loop's other sockets are not read anymore
+        self.ep = select.epoll()
+        self.ep.register(self.timer, select.EPOLLIN)
+        self.ep.register(self.resolver.fileno(), select.EPOLLIN)
+        if self.udp is not None:
+            self.ep.register(self.udp.fileno(), select.EPOLLIN)
+        for tier in self.tiers:
+            tier.pending_event = None
+            if any(tracker.started for tracker in tier.trackers):
+                self._start(tier, 'stopped')
+        deadline = time.monotonic() + self.stop_timeout
+        self._arm()
+        while any(tier.active is not None for tier in self.tiers) and time.monotonic() < deadline:
+            for fileno, eventmask in self.ep.poll(deadline - time.monotonic()):
+                if self.owns(fileno):
+                    self.handle(fileno, eventmask)
+
+    def scrape(self) -> None:
+        """
+        Scrapes the first UDP tracker of every idle tier, results are shown by print()
+        """
+        for tier in self.tiers:
+            tracker = tier.trackers[0]
+            if tier.active is None and isinstance(tracker, UDPTracker):
+                tracker.scrape([tracker.info_hash])
+                if not tracker.failed:
+                    tier.current = 0
+                    tier.scraping = True
+                    self._register(tier, tracker)
+        self._arm()
+
+    def owns(self, fileno: int) -> bool:
+        return fileno == self.timer or fileno == self.resolver.fileno() or fileno in self.active or (self.udp is not None and fileno == self.udp.fileno())
+
+    def handle(self, fileno: int, eventmask: int) -> list[Peer]:
+        """
+        Returns peers from trackers that answered
+        """
+        if fileno == self.timer:
+            return self._expire()
+        if self.udp is not None and fileno == self.udp.fileno():
+            return self._receive()
+        if fileno == self.resolver.fileno():
+            return self._resolved()
+        tier = self.active[fileno]
+        tracker = tier.active
+        events = tracker.events
+        s = tracker.s
+        result = tracker.handle(eventmask)
+        if result is None:
+            if tracker.s is not s:
+                # the tracker replaced a stale keep-alive connection
+                self._unregister(tier)
+                self._register(tier, tracker)
+            elif tracker.events != events:
+                self.ep.modify(fileno, tracker.events)
+            self._arm()
+            return []
+        return self._finish(tier, result)
+
+    def close(self) -> None:
+        for tier in self.tiers:
+            if tier.active is not None:
+                self._unregister(tier)
+                tier.active.close()
+                tier.active = None
+        self.ep.unregister(self.timer)
+        os.close(self.timer)
+        self.ep.unregister(self.resolver.fileno())
+        if self.udp is not None:
+            # The UDP socket is shared, only this loop stops listening on it
+            self.ep.unregister(self.udp.fileno())
+
+    def _receive(self) -> list[Peer]:
+        peers = []
+        for tracker, data in self.udp.receive():
+            tier = self.tier_of.get(tracker)
+            if tier is None or tier.active is not tracker:
+                continue
+            result = tracker.receive(data)
+            if result is not None:
+                peers += self._finish(tier, result)
+        self._arm()
+        return peers
+
+    def _resolved(self) -> list[Peer]:
+        peers = []
+        for tracker in self.resolver.process():
+            tier = self.tier_of.get(tracker)
+            if tier is None or tier.active is not tracker or tracker.pending is None:
+                continue
+            result = tracker.resume()
+            if result is None:
+                self._register(tier, tracker)
+            else:
+                peers += self._finish(tier, result)
+        self._arm()
+        return peers
+
+    def _start(self, tier: Tier, event: str = None) -> list[Peer]:
+        tier.current = 0
+        return self._try(tier, event)
+
+    def _try(self, tier: Tier, event: str = None) -> list[Peer]:
+        tracker = tier.trackers[tier.current]
+        left, uploaded, downloaded = self.status()
+        if event is None and not tracker.started:
+            event = 'started'
+        tier.event = event
+        tracker.announce(left, uploaded, downloaded, False, event)
+        if tracker.failed:
+            return self._finish(tier, False)
+        self._register(tier, tracker)
+        return []
+
+    def _register(self, tier: Tier, tracker: Tracker) -> None:
+        tier.active = tracker
+        tier.fileno = tracker.fileno()
+        if tier.fileno is not None:
+            self.active[tier.fileno] = tier
+            self.ep.register(tier.fileno, tracker.events)
+
+    def _unregister(self, tier: Tier) -> None:
+        if tier.fileno is None:
+            return
+        try:
+            self.ep.unregister(tier.fileno)
+        except OSError:
+            # the tracker already closed its socket
+            pass
+        del self.active[tier.fileno]
+        tier.fileno = None
+
+    def _finish(self, tier: Tier, result: bool) -> list[Peer]:
+        peers = self._result(tier, result)
+        if tier.active is None and tier.pending_event is not None:
+            event = tier.pending_event
+            tier.pending_event = None
+            peers += self._start(tier, event)
+        return peers
+
+    def _result(self, tier: Tier, result: bool) -> list[Peer]:
+        tracker = tier.trackers[tier.current]
+        self._unregister(tier)
+        if result:
+            tracker.finish()
+        else:
+            tracker.close()
+        tier.active = None
+        if tier.scraping:
+            tier.scraping = False
+            return []
+        if result:
+            tracker.started = True
+            tier.trackers.remove(tracker)
+            tier.trackers.insert(0, tracker)
+            tier.failures = 0
+            interval = tracker.interval if tracker.interval else self.default_interval
+            if tracker.min_interval:
+                interval = max(interval, tracker.min_interval)
+            tier.next_announce = time.monotonic() + interval
+            # Every peer returned is dialled, so this is where its Peer object is made
+            peers = [Peer(None, ip, port) for ip, port in tracker.peers]
+            for peer in peers:
+                self.peers[(peer.peer_ip, peer.peer_port)] = peer
+            self._arm()
+            return peers
+        tier.current += 1
+        if tier.current < len(tier.trackers):
+            return self._try(tier, tier.event)
+        tier.failures += 1
+        retry = min(self.retry_interval * 2 ** (tier.failures - 1), self.max_retry_interval)
+        tier.next_announce = time.monotonic() + retry
+        self.logger.info(f'Every tracker in {tier} failed, retrying in {retry} s')
+        self._arm()
+        return []
+
+    def _expire(self) -> list[Peer]:
+        peers = []
+        now = time.monotonic()
+        for tier in self.tiers:
+            tracker = tier.active
+            if tracker is not None and tracker.deadline <= now:
+                result = tracker.expire()
+                if result is not None:
+                    peers += self._finish(tier, result)
+        for tier in self.tiers:
+            if tier.active is None and tier.next_announce <= now and not self.stopping:
+                peers += self._start(tier)
+        self._arm()
+        return peers
+
+    def _arm(self) -> None:
+        deadlines = [tier.active.deadline if tier.active is not None else tier.next_announce for tier in self.tiers]
+        if len(deadlines) == 0:
+            timerfd.settime(self.timer, 0, 0, 0)
+            return
+        timerfd.settime(self.timer, 0, max(min(deadlines) - time.monotonic(), 0.001), 0)
+
+    def print(self):
+        for tier in self.tiers:
+            tracker = tier.trackers[0]
+            print(tier, 'failures:', tier.failures, 'next announce in:', round(max(tier.next_announce - time.monotonic(), 0)), 's')
+            if isinstance(tracker, UDPTracker) and tracker.info_hash in tracker.scrapes:
+                seeders, completed, leechers = tracker.scrapes[tracker.info_hash]
+                print('Seeders:', seeders, 'Completed:', completed, 'Leechers:', leechers)
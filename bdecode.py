@@ -0,0 +1,99 @@
+from collections import OrderedDict
+
+# Deeper nesting than any torrent, DHT or extension message needs, it would only exhaust the stack
+MAX_DEPTH = 100
+
+class DecodeError(ValueError):
+    pass
+
+class Decoder:
+    """
+    Bencode decoder that records the byte span of every value in the top-level
+    dict, so the info hash is taken over the original bytes. Strings stored under
+    one of raw_keys are returned as memoryview slices of the input without a copy,
+    other strings are decoded to str when they are valid utf-8 like bencode.decode.
+    With text=False only dict keys are decoded and every value string stays bytes.
+    """
+    data: bytes
+    spans: dict
+
+    def __init__(self, data: bytes, raw_keys: tuple = (), text: bool = True) -> None:
+        self.data = bytes(data)
+        self.view = memoryview(self.data)
+        self.raw_keys = set(raw_keys)
+        self.text = text
+        self.spans = {}
+
+    def decode(self):
+        value, end = self.decode_prefix()
+        if end != len(self.data):
+            raise DecodeError(f'Trailing data at offset {end}')
+        return value
+
+    def decode_prefix(self) -> tuple:
+        """
+        Decodes the value at the start of the data and returns it with the offset where it ends
+        """
+        try:
+            return self._decode(0, 0, None)
+        except DecodeError:
+            raise
+        except (IndexError, ValueError) as e:
+            raise DecodeError(f'Invalid bencoded data: {e}')
+
+    def _decode(self, pos: int, depth: int, key):
+        if depth > MAX_DEPTH:
+            raise DecodeError(f'Nesting deeper than {MAX_DEPTH} at offset {pos}')
+        c = self.data[pos]
+        if c == 0x64: # d
+            return self._dict(pos + 1, depth)
+        if c == 0x6c: # l
+            values = []
+            pos += 1
+            while self.data[pos] != 0x65:
+                value, pos = self._decode(pos, depth + 1, None)
+                values.append(value)
+            return values, pos + 1
+        if c == 0x69: # i
+            end = self.data.index(b'e', pos)
+            return int(self.data[pos + 1:end]), end + 1
+        return self._string(pos, key in self.raw_keys, self.text)
+
+    def _string(self, pos: int, raw: bool = False, text: bool = True):
+        colon = self.data.index(b':', pos)
+        start = colon + 1
+        end = start + int(self.data[pos:colon])
+        if end > len(self.data) or end < start:
+            raise DecodeError(f'String at offset {pos} runs past the end of the data')
+        if raw:
+            return self.view[start:end], end
+        value = self.data[start:end]
+        if not text:
+            return value, end
+        try:
+            return value.decode('utf-8'), end
+        except UnicodeDecodeError:
+            return value, end
+
+    def _dict(self, pos: int, depth: int):
+        values = OrderedDict()
+        while self.data[pos] != 0x65:
+            key, pos = self._string(pos)
+            start = pos
+            values[key], pos = self._decode(pos, depth + 1, key)
+            if depth == 0:
+                self.spans[key] = (start, pos)
+        return values, pos + 1
+
+    def raw(self, key) -> memoryview:
+        """
+        Original bytes of a value in the top-level dict
+        """
+        start, end = self.spans[key]
+        return self.view[start:end]
+
+def decode(data: bytes, raw_keys: tuple = (), text: bool = True):
+    return Decoder(data, raw_keys, text).decode()
+
+def decode_prefix(data: bytes) -> tuple:
+    return Decoder(data).decode_prefix()
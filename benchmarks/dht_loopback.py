@@ -0,0 +1,64 @@
+import os
+import sys
+import time
+import select
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from dht import DHT
+
+# Runs a DHT of many nodes on loopback in one event loop. One node announces a torrent and
+# another looks it up, reporting how long the lookup took and how many queries it sent.
+
+def run(nodes: list, ep: select.epoll, seconds: float, until=None) -> list:
+    found = []
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline and (until is None or not until(found)):
+        for fileno, eventmask in ep.poll(0.1):
+            for node in nodes:
+                if node.owns(fileno):
+                    found += node.handle(fileno, eventmask)
+                    break
+    return found
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Local multi-node DHT on loopback')
+    parser.add_argument('--nodes', type=int, default=50)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    ep = select.epoll()
+    nodes = [DHT('127.0.0.1', 0, ep, os.path.join(directory, '0.dat'), bootstrap=[])]
+    router = ('127.0.0.1', nodes[0].s.getsockname()[1])
+    for i in range(1, args.nodes):
+        nodes.append(DHT('127.0.0.1', 0, ep, os.path.join(directory, f'{i}.dat'), bootstrap=[router]))
+        run(nodes, ep, 0.01)
+    run(nodes, ep, 2, lambda found: all(len(node.lookups) == 0 for node in nodes))
+    sizes = [len(node.table) for node in nodes]
+    print(f'{args.nodes} nodes, routing table size min {min(sizes)} avg {sum(sizes) / len(sizes):.1f} max {max(sizes)}')
+
+    info_hash = os.urandom(20)
+    announcer, seeker = nodes[1], nodes[-1]
+    announcer.search(info_hash, 6881)
+    run(nodes, ep, 5, lambda found: len(announcer.lookups) == 0 and len(announcer.transactions) == 0)
+    stored = sum(len(node.storage.get(info_hash, {})) for node in nodes)
+    print(f'announced to {stored} nodes')
+
+    sent = seeker.queries
+    start = time.monotonic()
+    seeker.search(info_hash)
+    peers = run(nodes, ep, 10, lambda found: len(found) > 0)
+    elapsed = time.monotonic() - start
+    print(f'lookup found {[(peer.peer_ip, peer.peer_port) for peer in peers]} in {elapsed * 1000:.1f} ms with {seeker.queries - sent} queries')
+
+    # A restarted node loads its table instead of bootstrapping
+    seeker.close()
+    restarted = DHT('127.0.0.1', 0, ep, seeker.path, bootstrap=[])
+    print(f'restarted node pinged {len(restarted.transactions)} saved nodes, same id: {restarted.id == seeker.id}')
+    for node in nodes[:-1] + [restarted]:
+        node.close()
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
@@ -0,0 +1,89 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import bencode
+
+from swarm import LocalTracker, Instance, free_port, make_synthetic_torrent, parse_size
+
+# Streams the file of a torrent through a named pipe while it downloads from rate limited
+# seeders, reading it at a fixed bitrate like a player would. Reports time to first byte
+# and stalls for each deadline window size, 0 leaves the picker random.
+
+def run(args, window: int) -> None:
+    workdir = tempfile.mkdtemp(prefix='stream-')
+    tracker = LocalTracker()
+    instances = []
+    try:
+        seed_dir = os.path.join(workdir, 'seed0')
+        os.makedirs(seed_dir)
+        torrent = make_synthetic_torrent(seed_dir, tracker.url('http'), args.size, args.piece_length, 1)
+        encoded = bencode.encode(torrent)
+        for i in range(args.seeders + 1):
+            name = f'seed{i}' if i < args.seeders else 'leech'
+            directory = os.path.join(workdir, name)
+            if 0 < i < args.seeders:
+                shutil.copytree(seed_dir, directory)
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, 'swarm.torrent'), 'wb') as f:
+                f.write(encoded)
+            instances.append(Instance(name, directory, free_port()))
+        for instance in instances[:-1]:
+            instance.start(args.rate)
+            time.sleep(0.2)
+        leech = instances[-1]
+        pipe = os.path.join(leech.directory, 'stream')
+        os.mkfifo(pipe)
+        leech.start(0)
+        start = time.monotonic()
+        leech.command(f'stream 0 {pipe} {window}')
+
+        first_byte = None
+        played = None
+        stalls = 0
+        stall_time = 0
+        received = 0
+        chunk = 64 * 1024
+        with open(pipe, 'rb') as f:
+            while received < args.size and time.monotonic() - start < args.timeout:
+                # Playback wants the next chunk at a fixed rate once the first byte is in, and pauses while it stalls
+                due = None if played is None else played + received / args.bitrate
+                if due is not None and due > time.monotonic():
+                    time.sleep(due - time.monotonic())
+                data = f.read(chunk)
+                if not data:
+                    break
+                now = time.monotonic()
+                if first_byte is None:
+                    first_byte = now - start
+                    played = now
+                elif now - due > args.stall / 1000:
+                    stalls += 1
+                    stall_time += now - due
+                    played += now - due
+                received += len(data)
+        elapsed = time.monotonic() - start
+        first = f'{first_byte * 1000:7.0f} ms' if first_byte is not None else '    none'
+        print(f'window {window:>3}: first byte {first}, stalls {stalls:>3}, stall time {stall_time:6.2f} s, {received}/{args.size} bytes in {elapsed:6.2f} s')
+    finally:
+        for instance in instances:
+            instance.stop()
+        tracker.close()
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Streaming time to first byte and stalls on loopback')
+    parser.add_argument('--size', type=parse_size, default='8m')
+    parser.add_argument('--piece-length', type=parse_size, default='64k')
+    parser.add_argument('--seeders', type=int, default=2)
+    parser.add_argument('--rate', type=parse_size, default='512k', help='upload limit per seeder in bytes/s')
+    parser.add_argument('--bitrate', type=parse_size, default='512k', help='playback rate in bytes/s')
+    parser.add_argument('--stall', type=float, default=200, help='lateness in ms that counts as a stall')
+    parser.add_argument('--windows', default='0,8', help='comma separated window sizes in pieces')
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    print(f'{args.size} bytes, {args.piece_length} byte pieces, {args.seeders} seeders at {args.rate} bytes/s, playback at {args.bitrate} bytes/s')
+    for window in args.windows.split(','):
+        run(args, int(window))
@@ -0,0 +1,69 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import bencode
+
+from swarm import LocalTracker, Instance, free_port, make_synthetic_torrent, parse_size
+
+# Publishes a torrent from one rate limited seeder to a swarm of leechers on loopback, with and
+# without super seeding. Reports how many copies of the torrent the seeder uploaded until every
+# leecher completed, and how long that took.
+
+def run(args, superseed: bool) -> None:
+    workdir = tempfile.mkdtemp(prefix='superseed-')
+    tracker = LocalTracker()
+    instances = []
+    try:
+        for i in range(args.leechers + 1):
+            name = 'seed' if i == 0 else f'leech{i - 1}'
+            directory = os.path.join(workdir, name)
+            os.makedirs(directory)
+            if i == 0:
+                encoded = bencode.encode(make_synthetic_torrent(directory, tracker.url('http'), args.size, args.piece_length, 1))
+            with open(os.path.join(directory, 'swarm.torrent'), 'wb') as f:
+                f.write(encoded)
+            instances.append(Instance(name, directory, free_port()))
+        seed = instances[0]
+        leechers = instances[1:]
+        seed.start(args.rate)
+        # The client reads one command per wakeup, so the limit has to be taken first
+        time.sleep(0.5)
+        if superseed:
+            seed.command('superseed on')
+        time.sleep(0.2)
+        for instance in leechers:
+            instance.start(0)
+            time.sleep(0.2)
+
+        start = time.monotonic()
+        while time.monotonic() - start < args.timeout:
+            for instance in leechers:
+                instance.poll()
+            if all(instance.completed is not None for instance in leechers):
+                break
+            time.sleep(0.1)
+        elapsed = time.monotonic() - start
+        uploaded = seed.uploaded()
+        done = sum(instance.completed is not None for instance in leechers)
+        copies = f'{uploaded / args.size:5.2f}' if uploaded is not None else ' none'
+        print(f'super seeding {"on " if superseed else "off"}: {done}/{len(leechers)} completed in {elapsed:6.2f} s, seed uploaded {copies} copies')
+    finally:
+        for instance in instances:
+            instance.stop()
+        tracker.close()
+        shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Seeder upload with and without super seeding on loopback')
+    parser.add_argument('--leechers', type=int, default=4)
+    parser.add_argument('--size', type=parse_size, default='8m')
+    parser.add_argument('--piece-length', type=parse_size, default='256k')
+    parser.add_argument('--rate', type=parse_size, default='1m', help='upload limit of the seeder in bytes/s')
+    parser.add_argument('--timeout', type=float, default=300)
+    args = parser.parse_args()
+
+    print(f'1 seeder at {args.rate} bytes/s, {args.leechers} leechers, {args.size} bytes, {args.piece_length} byte pieces')
+    for superseed in (False, True):
+        run(args, superseed)
@@ -0,0 +1,311 @@
+import os
+import re
+import sys
+import time
+import queue
+import random
+import socket
+import struct
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import urllib.parse
+import http.server
+import bencode
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import maketorrent
+
+# Runs a swarm of client processes on loopback against a local tracker and reports
+# time to complete, throughput, CPU per MB and peak RSS. Needs no network access.
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CLIENT = os.path.join(ROOT, 'bittorrent.py')
+
+class LocalTracker:
+    """
+    HTTP and UDP tracker stand-in, every announce gets the compact list of the other peers
+    """
+    interval = 5
+
+    def __init__(self) -> None:
+        self.swarms = {}
+        self.address_of = {}
+        self.lock = threading.Lock()
+
+        tracker = self
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query, keep_blank_values=True, encoding='latin-1')
+                info_hash = query['info_hash'][0].encode('latin-1')
+                peers = tracker.announce(info_hash, int(query['port'][0]))
+                body = bencode.encode({'interval': tracker.interval, 'peers': peers})
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.http = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(('127.0.0.1', 0))
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+        threading.Thread(target=self._serve_udp, daemon=True).start()
+
+    def url(self, kind: str) -> str:
+        if kind == 'udp':
+            return f'udp://127.0.0.1:{self.udp.getsockname()[1]}'
+        return f'http://127.0.0.1:{self.http.server_address[1]}/announce'
+
+    def announce(self, info_hash: bytes, port: int) -> bytes:
+        with self.lock:
+            swarm = self.swarms.setdefault(info_hash, set())
+            swarm.add(port)
+            # peers are handed out through their shaping proxy when they have one
+            return b''.join(socket.inet_aton('127.0.0.1') + struct.pack('!H', self.address_of.get(p, p)) for p in swarm if p != port)
+
+    def _serve_udp(self) -> None:
+        while True:
+            data, address = self.udp.recvfrom(4096)
+            connection_id, action, transaction_id = struct.unpack('!qii', data[:16])
+            if action == 0:
+                self.udp.sendto(struct.pack('!iiq', 0, transaction_id, random.getrandbits(63)), address)
+            elif action == 1:
+                info_hash = data[16:36]
+                port = struct.unpack('!H', data[96:98])[0]
+                peers = self.announce(info_hash, port)
+                self.udp.sendto(struct.pack('!iiiii', 1, transaction_id, self.interval, 0, len(self.swarms[info_hash])) + peers, address)
+            elif action == 2:
+                counts = b''.join(struct.pack('!iii', len(self.swarms.get(data[i:i + 20], ())), 0, 0) for i in range(16, len(data), 20))
+                self.udp.sendto(struct.pack('!ii', 2, transaction_id) + counts, address)
+
+    def close(self) -> None:
+        self.http.shutdown()
+        self.udp.close()
+
+class LatencyProxy:
+    """
+    Forwards connections to a client, delaying data by the one-way latency in each direction
+    """
+    def __init__(self, target_port: int, latency: float) -> None:
+        self.target_port = target_port
+        self.latency = latency
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.s.bind(('127.0.0.1', 0))
+        self.s.listen(50)
+        self.port = self.s.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self) -> None:
+        while True:
+            client, _ = self.s.accept()
+            try:
+                upstream = socket.create_connection(('127.0.0.1', self.target_port))
+            except OSError:
+                client.close()
+                continue
+            self._pipe(client, upstream)
+            self._pipe(upstream, client)
+
+    def _pipe(self, src: socket.socket, dst: socket.socket) -> None:
+        delayed = queue.Queue()
+
+        def read():
+            while True:
+                try:
+                    data = src.recv(65536)
+                except OSError:
+                    data = b''
+                delayed.put((time.monotonic() + self.latency, data))
+                if not data:
+                    return
+
+        def write():
+            while True:
+                due, data = delayed.get()
+                time.sleep(max(due - time.monotonic(), 0))
+                try:
+                    if not data:
+                        dst.shutdown(socket.SHUT_WR)
+                        return
+                    dst.sendall(data)
+                except OSError:
+                    return
+
+        threading.Thread(target=read, daemon=True).start()
+        threading.Thread(target=write, daemon=True).start()
+
+class Instance:
+    def __init__(self, name: str, directory: str, port: int) -> None:
+        self.name = name
+        self.directory = directory
+        self.port = port
+        self.started = None
+        self.completed = None
+        self.cpu = 0
+        self.peak_rss = 0
+        self.proc = None
+
+    def start(self, rate: int) -> None:
+        self.started = time.monotonic()
+        self.errors = open(os.path.join(self.directory, 'stderr.log'), 'wb')
+        self.output = open(os.path.join(self.directory, 'stdout.log'), 'wb')
+        self.proc = subprocess.Popen([sys.executable, CLIENT, 'swarm.torrent', str(self.port)], cwd=self.directory,
+                                     stdin=subprocess.PIPE, stdout=self.output, stderr=self.errors)
+        if rate > 0:
+            self.command(f'limit up torrent {rate}')
+
+    def command(self, line: str) -> None:
+        self.proc.stdin.write(line.encode() + b'\n')
+        self.proc.stdin.flush()
+
+    def uploaded(self) -> int:
+        # Bytes uploaded for the torrent so far, from the client's print output
+        self.command('print')
+        time.sleep(0.5)
+        total = None
+        with open(os.path.join(self.directory, 'stdout.log')) as f:
+            for line in f:
+                match = re.match(r'Torrent upload: .*total (\d+) b\) download', line)
+                if match:
+                    total = int(match.group(1))
+        return total
+
+    def poll(self) -> None:
+        # CPU seconds and peak RSS from /proc, completion from the client log
+        try:
+            with open(f'/proc/{self.proc.pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            self.cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+            with open(f'/proc/{self.proc.pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        self.peak_rss = int(line.split()[1]) * 1024
+        except (OSError, IndexError):
+            pass
+        if self.completed is None:
+            log = os.path.join(self.directory, 'bittorrent.log')
+            if os.path.exists(log):
+                with open(log) as f:
+                    if 'Download complete' in f.read():
+                        self.completed = time.monotonic()
+
+    def stop(self) -> None:
+        if self.proc is not None and self.proc.poll() is None:
+            self.proc.terminate()
+            self.proc.wait()
+        if self.proc is not None:
+            self.errors.close()
+            self.output.close()
+
+def free_port() -> int:
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def make_synthetic_torrent(directory: str, announce: str, size: int, piece_length: int, files: int) -> dict:
+    """
+    Writes random data into directory and returns the decoded torrent
+    """
+    name = 'swarm'
+    data = random.randbytes(size)
+    if files == 1:
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(data)
+    else:
+        step = size // files
+        os.makedirs(os.path.join(directory, name), exist_ok=True)
+        for i in range(files):
+            with open(os.path.join(directory, name, f'file{i}'), 'wb') as f:
+                f.write(data[i * step:size if i == files - 1 else (i + 1) * step])
+    return maketorrent.make_torrent(os.path.join(directory, name), announce, piece_length)
+
+def parse_size(value: str) -> int:
+    units = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    if value[-1].lower() in units:
+        return int(float(value[:-1]) * units[value[-1].lower()])
+    return int(value)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Offline swarm benchmark on loopback')
+    parser.add_argument('--seeders', type=int, default=1)
+    parser.add_argument('--leechers', type=int, default=3)
+    parser.add_argument('--size', type=parse_size, default='8m', help='torrent size, accepts k/m/g suffixes')
+    parser.add_argument('--piece-length', type=parse_size, default='256k')
+    parser.add_argument('--files', type=int, default=1)
+    parser.add_argument('--rate', type=parse_size, default='0', help='upload limit per peer in bytes/s, 0 for none')
+    parser.add_argument('--latency', type=float, default=0, help='one-way latency per peer in ms')
+    parser.add_argument('--tracker', choices=['http', 'udp'], default='http')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--keep', action='store_true', help='keep the working directory')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='swarm-')
+    tracker = LocalTracker()
+    instances = []
+    try:
+        seed_dir = os.path.join(workdir, 'seed0')
+        os.makedirs(seed_dir)
+        torrent = make_synthetic_torrent(seed_dir, tracker.url(args.tracker), args.size, args.piece_length, args.files)
+        encoded = bencode.encode(torrent)
+
+        for i in range(args.seeders + args.leechers):
+            seeder = i < args.seeders
+            name = f'seed{i}' if seeder else f'leech{i - args.seeders}'
+            directory = os.path.join(workdir, name)
+            if seeder and i > 0:
+                shutil.copytree(seed_dir, directory)
+            os.makedirs(directory, exist_ok=True)
+            with open(os.path.join(directory, 'swarm.torrent'), 'wb') as f:
+                f.write(encoded)
+            instance = Instance(name, directory, free_port())
+            if args.latency > 0:
+                tracker.address_of[instance.port] = LatencyProxy(instance.port, args.latency / 1000).port
+            instances.append(instance)
+
+        # Seeders first so every leecher finds them on its first announce
+        for instance in instances:
+            instance.start(args.rate)
+            time.sleep(0.2)
+        leechers = instances[args.seeders:]
+
+        start = time.monotonic()
+        while time.monotonic() - start < args.timeout:
+            for instance in instances:
+                instance.poll()
+            if all(instance.completed is not None for instance in leechers):
+                break
+            time.sleep(0.1)
+        for instance in instances:
+            instance.poll()
+
+        done = [instance for instance in leechers if instance.completed is not None]
+        elapsed = max([instance.completed for instance in done], default=time.monotonic()) - start
+        downloaded = args.size * len(done)
+        cpu = sum(instance.cpu for instance in instances)
+
+        print(f'{args.seeders} seeders, {args.leechers} leechers, {args.size} bytes, {args.piece_length} byte pieces, {args.files} files, {args.tracker} tracker')
+        for instance in leechers:
+            status = f'{instance.completed - instance.started:7.2f} s' if instance.completed is not None else ' timeout'
+            print(f'{instance.name:>8}: {status}, cpu {instance.cpu:6.2f} s, peak rss {instance.peak_rss / 1024 ** 2:6.1f} MiB')
+        print(f'completed: {len(done)}/{len(leechers)}')
+        print(f'time to complete: {elapsed:.2f} s')
+        print(f'aggregate throughput: {downloaded / elapsed / 1024 ** 2:.2f} MiB/s')
+        if downloaded > 0:
+            print(f'cpu per MB: {cpu / (downloaded / 1024 ** 2) * 1000:.1f} ms')
+        print(f'peak rss: {max(instance.peak_rss for instance in instances) / 1024 ** 2:.1f} MiB')
+    finally:
+        for instance in instances:
+            instance.stop()
+        tracker.close()
+        if args.keep:
+            print('working directory:', workdir)
+        else:
+            shutil.rmtree(workdir)
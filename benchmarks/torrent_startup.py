@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+import struct
+import hashlib
+import tempfile
+import bencode
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from torrentfile import TorrentFile
+
+# Compares loading a torrent and building its piece hash list with bencode.decode and a
+# per-byte copy loop against the span-recording decoder and zero-copy piece hashes
+PIECE_COUNTS = [100000, 1000000]
+
+def make_torrent(path: str, piece_count: int) -> None:
+    info = {'name': 'startup', 'piece length': 16384, 'length': 16384 * piece_count, 'pieces': os.urandom(20 * piece_count)}
+    with open(path, 'wb') as f:
+        f.write(bencode.encode({'announce': 'http://127.0.0.1/announce', 'info': info}))
+
+def load_previous(path: str) -> list:
+    with open(path, 'rb') as f:
+        torrent = bencode.decode(f.read())
+    info = torrent['info']
+    hashlib.sha1(bencode.encode(info)).digest()
+    pieces = info['pieces']
+    hashes = []
+    for x in range(0, len(pieces), 20):
+        temp = bytes()
+        for y in range(x, x + 20):
+            temp = temp + struct.pack("B", pieces[y] & 0xff)
+        hashes.append(temp)
+    return hashes
+
+def load_current(path: str):
+    return TorrentFile(path).pieces
+
+def measure(load, path: str) -> float:
+    start = time.perf_counter()
+    hashes = load(path)
+    # Touch every hash, the way Torrent builds its piece list
+    for i in range(len(hashes)):
+        hashes[i]
+    return time.perf_counter() - start
+
+if __name__ == "__main__":
+    directory = tempfile.mkdtemp()
+    try:
+        for piece_count in PIECE_COUNTS:
+            path = os.path.join(directory, f'{piece_count}.torrent')
+            make_torrent(path, piece_count)
+            previous = measure(load_previous, path)
+            current = measure(load_current, path)
+            print(f'{piece_count} pieces: bencode.decode and copy loop {previous * 1000:.0f} ms, span decoder and piece views {current * 1000:.0f} ms, {previous / current:.0f}x')
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
@@ -0,0 +1,29 @@
+import os
+import sys
+import socket
+import struct
+import timeit
+import bencode
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tracker import HTTPTracker
+
+# Compares decoding a tracker response in the dictionary and compact (BEP 23) peer formats. The
+# peers step ends with (ip, port) tuples, Peer objects are only made for the peers that are dialled
+PEERS = 10000
+RUNS = 20
+
+if __name__ == "__main__":
+    addresses = [(socket.inet_ntoa(os.urandom(4)), struct.unpack('!H', os.urandom(2))[0]) for i in range(PEERS)]
+
+    dictionary = bencode.encode({'interval': 1800, 'peers': [{'peer id': os.urandom(20), 'ip': ip, 'port': port} for ip, port in addresses]})
+    compact = bencode.encode({'interval': 1800, 'peers': b''.join(socket.inet_aton(ip) + struct.pack('!H', port) for ip, port in addresses)})
+
+    tracker = HTTPTracker('http://127.0.0.1/announce', os.urandom(20), os.urandom(20), 6881)
+    for name, response in (('dictionary', dictionary), ('compact', compact)):
+        decode = timeit.timeit(lambda: bencode.decode(response), number=RUNS) / RUNS
+        data = bencode.decode(response)
+        process = timeit.timeit(lambda: tracker._process_data(data), number=RUNS) / RUNS
+        assert len(tracker.peers) == PEERS
+        print(f'{name:>10}: {len(response):>8} bytes, bdecode {decode * 1000:7.2f} ms, peers {process * 1000:7.2f} ms, total {(decode + process) * 1000:7.2f} ms')
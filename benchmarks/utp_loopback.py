@@ -0,0 +1,68 @@
+import os
+import sys
+import time
+import select
+import argparse
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from utp import UTP
+
+# Sends data over one uTP connection between two endpoints on loopback in one event loop.
+# Both ends delay and drop their outgoing packets to simulate a slow, lossy link.
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='uTP transfer on loopback with simulated delay and loss')
+    parser.add_argument('--size', type=int, default=16 * 1024 * 1024, help='bytes to send')
+    parser.add_argument('--delay', type=float, default=0, help='one way delay in ms')
+    parser.add_argument('--loss', type=float, default=0, help='packet loss in percent')
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    ep = select.epoll()
+    sender = UTP('127.0.0.1', 0, ep, args.delay / 1000, args.loss / 100)
+    receiver = UTP('127.0.0.1', 0, ep, args.delay / 1000, args.loss / 100)
+    endpoints = [sender, receiver]
+
+    # connect blocks until the handshake is done, which needs the loop running
+    result = []
+    t = threading.Thread(target=lambda: result.append(sender.connect('127.0.0.1', receiver.s.getsockname()[1])))
+    t.start()
+    accepted = []
+    while t.is_alive():
+        for fileno, eventmask in ep.poll(0.01):
+            for endpoint in endpoints:
+                if endpoint.owns(fileno):
+                    accepted += endpoint.handle(fileno, eventmask)
+    conn = result[0]
+    if conn is None or len(accepted) == 0:
+        sys.exit('uTP connect failed')
+    peer = accepted[0]
+    ep.register(peer.fileno(), select.EPOLLIN)
+
+    data = os.urandom(args.size)
+    start = time.monotonic()
+    conn.sendall(data)
+    received = bytearray()
+    delays = []
+    deadline = start + args.timeout
+    while len(received) < len(data) and time.monotonic() < deadline:
+        for fileno, eventmask in ep.poll(0.1):
+            if fileno == peer.fileno():
+                received += peer.recv(65536)
+            else:
+                for endpoint in endpoints:
+                    if endpoint.owns(fileno):
+                        endpoint.handle(fileno, eventmask)
+        delays.append(conn.queuing_delay)
+    elapsed = time.monotonic() - start
+
+    print(f'{len(received)}/{len(data)} bytes in {elapsed:.2f} s, {len(received) / elapsed / 1024 / 1024:.2f} MiB/s, intact: {bytes(received) == data}')
+    print(f'delay {args.delay} ms, loss {args.loss} %')
+    print(conn)
+    print(f'packets sent {sender.packets_sent} received {receiver.packets_received}, average queuing delay {sum(delays) / max(len(delays), 1) / 1000:.1f} ms')
+    conn.close()
+    peer.close()
+    for endpoint in endpoints:
+        endpoint.close()
@@ -1,69 +1,182 @@
+import os
 import sys
+import time
 import socket
 import select
 import re
-import struct
-import timerfd
 import random
 import threading
 import logging
 
+import bencode
+
+import bdecode
+import metadata
 import peermanager
-from torrent import Torrent
+import shard
+import stream
+from torrent import Torrent, PRIORITIES, PRIORITY_SKIP, PRIORITY_NORMAL
 from torrentfile import TorrentFile
-from tracker import Tracker
+from announcer import Announcer
+from dht import DHT
+from utp import UTP
+from lsd import LSD
 from peer import Peer
 
-def connect_to_tracker(announce_list, info_hash, peer_id, port, torrent_size, encoding) -> Tracker:
-    for announce in announce_list:
-            url = announce[0]
-            logging.info(f'Sending request to tracker {url}')
-            tracker = Tracker.create_tracker(url, info_hash, peer_id, port, encoding)
-            if tracker.make_request(torrent_size, 0, 0, False, 'started'):
-                logging.info("Request successful")
-                return tracker
-    return None
+def add_peer(peer):
+    # In multi-process mode each peer belongs to exactly one worker
+    if shared is not None and not shared.owns(peer):
+        shared.dispatch(peer)
+        return
+    t = threading.Thread(target=connect_to_peer, args=(peer,))
+    t.start()
 
 def connect_to_peer(peer):
     #print('Found peer:', peer)
     ps = pm.connPeer(peer)
     if ps != None:
         #print('Connected to peer:', peer)
-        ep.register(ps.fileno(), select.EPOLLIN)
+        # The loop may see data as soon as the socket is registered
         fileno_to_socket[ps.fileno()] = ps
+        ep.register(ps.fileno(), select.EPOLLIN)
+
+def fetch_metadata(magnet_link, peer_id, host, port):
+    # Get the info dict from peers before anything else can start and save it as a .torrent file
+    ep = select.epoll()
+    session = metadata.MetadataSession(magnet_link.info_hash, peer_id, port, ep)
+    # The size is unknown until the metadata arrives, a nonzero left keeps us a leecher
+    announcer = Announcer([[url] for url in magnet_link.trackers], magnet_link.info_hash, peer_id, port, 'utf-8', ep, lambda: (1, 0, 0))
+    dht = DHT(host, port, ep)
+    dht.search(magnet_link.info_hash, port)
+    for peer in magnet_link.peers + announcer.announce():
+        session.add_peer(peer)
+    received = 0
+    progressed = time.monotonic()
+    logged = progressed
+    while not session.metadata.complete():
+        for fileno, eventmask in ep.poll(1):
+            if announcer.owns(fileno):
+                for peer in announcer.handle(fileno, eventmask):
+                    session.add_peer(peer)
+            elif dht.owns(fileno):
+                for peer in dht.handle(fileno, eventmask):
+                    session.add_peer(peer)
+            elif session.owns(fileno):
+                session.handle(fileno, eventmask)
+        session.expire()
+        now = time.monotonic()
+        if session.metadata.received() != received:
+            received = session.metadata.received()
+            progressed = now
+        elif now - progressed > metadata.IDLE_TIMEOUT:
+            break
+        if now - logged > 30:
+            logged = now
+            logging.info(f'Fetching metadata: {session.metadata}, {len(session.connections)} connections, {len(session.seen)} peers seen')
+    session.close()
+    announcer.close()
+    dht.close()
+    ep.close()
+    if not session.metadata.complete():
+        sys.exit(f'No metadata received for {magnet_link.info_hash.hex()} in {metadata.IDLE_TIMEOUT} s from {len(session.seen)} peers')
+    logging.info(f'Fetched {session.metadata.size} bytes of metadata')
+
+    info = bdecode.decode(session.metadata.data)
+    name = info['name'] if 'name' in info and isinstance(info['name'], str) else magnet_link.info_hash.hex()
+    torrent = {}
+    if len(magnet_link.trackers) > 0:
+        torrent['announce'] = magnet_link.trackers[0]
+    if len(magnet_link.trackers) > 1:
+        torrent['announce-list'] = [[url] for url in magnet_link.trackers]
+    path = os.path.basename(name) + '.torrent'
+    # info sorts after the other keys, so the raw dict goes last and keeps its exact bytes
+    with open(path, 'wb') as f:
+        f.write(bencode.encode(torrent)[:-1] + b'4:info' + session.metadata.data + b'e')
+    return path
+
+def stream_file(reader, path):
+    # Copies a file of the torrent in order while it downloads, path can be a named pipe a player reads
+    try:
+        with open(path, 'wb') as f:
+            while True:
+                data = reader.read(1024 * 1024)
+                if not data:
+                    break
+                f.write(data)
+    except (OSError, ValueError) as e:
+        logging.info(f'Streaming to {path} stopped: {e}')
+    reader.close()
+    print(reader)
+
+def start_stream(fs, pm, index, path, window):
+    # A skipped file would never be downloaded, streaming it makes it wanted
+    if fs.file_list[index].priority == PRIORITY_SKIP:
+        print(f"File {index} was skipped, its priority is now normal")
+        pm.setFilePriority(index, PRIORITY_NORMAL)
+    reader = stream.TorrentReader(fs, index, window)
+    threading.Thread(target=stream_file, args=(reader, path), daemon=True).start()
 
 if __name__ == "__main__":
     if (len(sys.argv) < 2):
-        sys.exit("Usage: bittorrent.py <.torrent file> [port]")
+        sys.exit("Usage: bittorrent.py <.torrent file | magnet link> [port] [workers] [bind address]")
 
-    # arg1 = torrent file path
+    # arg1 = torrent file path or magnet link
     path = sys.argv[1]
-    if (path.endswith('.torrent') == False):
-        sys.exit("Must be a path to a torrent file")
+    magnet_link = None
+    if path.startswith('magnet:'):
+        try:
+            magnet_link = metadata.Magnet(path)
+        except ValueError as e:
+            sys.exit(str(e))
+    elif (path.endswith('.torrent') == False):
+        sys.exit("Must be a path to a torrent file or a magnet link")
 
     # arg2 = port
     port = 0
     if (len(sys.argv) > 2):
         port = int(sys.argv[2])
 
+    # arg3 = number of worker processes
+    workers = 1
+    if (len(sys.argv) > 3):
+        workers = int(sys.argv[3])
+
+    # arg4 = address to listen on, every interface by default (IPv4 and IPv6 when the host has it)
+    bind = "::" if socket.has_ipv6 else "0.0.0.0"
+    if (len(sys.argv) > 4):
+        bind = sys.argv[4]
+
     # Config logger
     logging.basicConfig(filename='bittorrent.log', level=logging.INFO)
     logging.info("Starting bittorrent")
 
+    # Generate Peer ID
+    peer_id = '-Rn4829-'
+    for x in range(0,12):
+        peer_id += str(random.randint(0,9))
+    peer_id = bytes(peer_id, 'ascii')
+
+    # Set up TCP server
+    fileno_to_socket = {}
+
+    try:
+        s = shard.listen_socket(bind, port, workers > 1)
+    except OSError:
+        if bind != "::":
+            raise
+        # IPv6 is disabled on the host
+        bind = "0.0.0.0"
+        s = shard.listen_socket(bind, port, workers > 1)
+    port = s.getsockname()[1]
+    # uTP, the DHT and local service discovery are IPv4 only, IPv6 peers use TCP
+    udp_host = s.getsockname()[0] if s.family == socket.AF_INET else "0.0.0.0"
+
+    if magnet_link is not None:
+        path = fetch_metadata(magnet_link, peer_id, udp_host, port)
+
     # Load bencoded data from torrent file
     torrent_file = TorrentFile(path)
 
-    # Create hash list
-    pieces = torrent_file.info['pieces']
-    hashes = []
-    for x in range (0, len(pieces),20):
-        temp = bytes()
-        for y in range (x, x + 20):
-            val = pieces[y] & 0xff
-            val = struct.pack("B",val)
-            temp = temp + val
-        hashes.append(temp)
-    
     # Initialize torrent
     if 'files' in torrent_file.info:
         files = torrent_file.info['files']
@@ -77,48 +190,68 @@ if __name__ == "__main__":
     else: 
         files = [dict(length = torrent_file.info['length'], path = torrent_file.info['name'])]
 
-    fs = Torrent(torrent_file.info['piece length'], hashes, files)
+    fs = Torrent(torrent_file.info['piece length'], torrent_file.pieces, files)
 
     # Check local files
     fs.check_local_files()
 
-    # Generate Peer ID
-    peer_id = '-Rn4829-'
-    for x in range(0,12):
-        peer_id += str(random.randint(0,9))
-    peer_id = bytes(peer_id, 'ascii')
+    # Share piece state between worker processes
+    shared = None
+    if workers > 1:
+        shared = shard.SharedPieceState(fs.piece_count, workers)
+        fs.attach_shared(shared)
 
-    # Set up TCP server
-    fileno_to_socket = {}
-
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.bind(("127.0.0.1", port))
-    s.listen(50)
+    # Fork workers, each accepts on its own SO_REUSEPORT socket bound to the same port
+    worker_id = 0
+    if shared is not None:
+        worker_id = shared.fork_workers()
+        if worker_id != 0:
+            s.close()
+            s = shard.listen_socket(bind, port, True)
+        logging.info(f'Worker {worker_id} started')
 
     ep = select.epoll()
-    ep.register(sys.stdin.fileno(), select.EPOLLIN)
+    if worker_id == 0:
+        ep.register(sys.stdin.fileno(), select.EPOLLIN)
     ep.register(s.fileno(), select.EPOLLIN)
+    ep.register(fs.disk.fileno(), select.EPOLLIN)
+    if shared is not None:
+        ep.register(shared.peer_pipe(), select.EPOLLIN)
 
     # Initialize peer manager
-    pm = peermanager.PeerManager(torrent_file.info_hash, peer_id, fs)
-
-    # Initialize tracker
-    if torrent_file.announce_list is not None:
-        tracker = connect_to_tracker(torrent_file.announce_list, torrent_file.info_hash, peer_id, 6881, fs.torrent_size, torrent_file.encoding)
-    else:
-        tracker = connect_to_tracker([[torrent_file.announce]], torrent_file.info_hash, peer_id, 6881, fs.torrent_size, torrent_file.encoding)
-    if tracker == None:
-        sys.exit("Failed to connect to tracker")
-    for peer in tracker.peers:
-        t = threading.Thread(target=connect_to_peer, args=(peer,))
-        t.start()
-
-    tracker_update_timer = timerfd.create(timerfd.CLOCK_REALTIME,0)
-    timerfd.settime(tracker_update_timer,0,30,0)
-    ep.register(tracker_update_timer, select.EPOLLIN)
+    pm = peermanager.PeerManager(torrent_file.info_hash, peer_id, fs, shared, torrent_file.info_bytes, port)
+
+    # Only the first worker announces, other workers get their peers through a pipe
+    announcer = None
+    dht = None
+    utp = None
+    lsd = None
+    completed = fs.finished()
+    if worker_id == 0:
+        # uTP and the DHT share the UDP port with the same number as the TCP port
+        utp = UTP(udp_host, port, ep)
+        Peer.context['utp'] = utp
+        if torrent_file.announce_list is not None:
+            announce_list = torrent_file.announce_list
+        elif torrent_file.announce is not None:
+            announce_list = [[torrent_file.announce]]
+        else:
+            announce_list = []
+        announcer = Announcer(announce_list, torrent_file.info_hash, peer_id, port, torrent_file.encoding, ep, lambda: (fs.left(), pm.upload.total, pm.download.total))
+        for peer in announcer.announce():
+            add_peer(peer)
+        if magnet_link is not None:
+            for peer in magnet_link.peers:
+                add_peer(peer)
+        # Private torrents only get peers from their trackers
+        if torrent_file.info.get('private') != 1:
+            dht = DHT(udp_host, port, ep, s=utp.s)
+            dht.search(torrent_file.info_hash, port)
+            pm.dht_port = port
+            lsd = LSD(udp_host, port, [torrent_file.info_hash], ep)
 
     while True:
-        for fileno, eventmask in ep.poll(-1):
+        for fileno, eventmask in ep.poll(pm.timeout()):
             if fileno == sys.stdin.fileno():
                 l = sys.stdin.readline()
                 args = re.split(' +', l)
@@ -126,15 +259,59 @@ if __name__ == "__main__":
                     if args[0] == "print\n":
                         print(fs)
                         pm.print()
+                        if announcer is not None:
+                            announcer.print()
+                        if dht is not None:
+                            dht.print()
+                        if utp is not None:
+                            utp.print()
+                        if lsd is not None:
+                            lsd.print()
+                        for reader in fs.readers:
+                            print(reader)
+                    elif args[0] == "scrape\n" and announcer is not None:
+                        announcer.scrape()
                     elif args[0] == "exit\n":
+                        if announcer is not None:
+                            announcer.stop()
+                        if shared is not None:
+                            shared.stop()
+                        if dht is not None:
+                            dht.close()
+                        if utp is not None:
+                            utp.close()
+                        if lsd is not None:
+                            lsd.close()
                         exit()
                     else:
                         print("Invalid input")
+                elif len(args) == 2:
+                    if args[0] == "cache":
+                        fs.cache.resize(int(args[1]))
+                    elif args[0] == "fsync" and args[1].strip() in ("never", "write", "complete"):
+                        fs.disk.fsync_policy = args[1].strip()
+                    elif args[0] == "superseed" and args[1].strip() in ("on", "off"):
+                        if not pm.setSuperSeeding(args[1].strip() == "on"):
+                            print("Super seeding needs every piece")
+                    else:
+                        print("Invalid syntax")
+                elif len(args) == 3:
+                    if args[0] == "dht" and dht is not None:
+                        dht.add_node(args[1], int(args[2]))
+                    elif args[0] == "priority" and args[1].isdigit() and int(args[1]) < len(fs.file_list) and args[2].strip() in PRIORITIES:
+                        pm.setFilePriority(int(args[1]), PRIORITIES[args[2].strip()])
+                    elif args[0] == "stream" and args[1].isdigit() and int(args[1]) < len(fs.file_list):
+                        start_stream(fs, pm, int(args[1]), args[2].strip(), stream.DEFAULT_WINDOW)
+                    else:
+                        print("Invalid syntax")
                 elif len(args) == 4:
                     if args[0] == "peer":
                         peer = Peer(args[1], args[2], int(args[3]))
-                        t = threading.Thread(target=connect_to_peer, args=(peer,))
-                        t.start()
+                        add_peer(peer)
+                    elif args[0] == "limit" and args[1] in ("up", "down") and args[2] in ("global", "torrent", "peer"):
+                        pm.setLimit(args[1], args[2], int(args[3]))
+                    elif args[0] == "stream" and args[1].isdigit() and int(args[1]) < len(fs.file_list) and args[3].strip().isdigit():
+                        start_stream(fs, pm, int(args[1]), args[2], int(args[3]))
                     else:
                         print("Invalid syntax")
                 else:
@@ -143,12 +320,29 @@ if __name__ == "__main__":
                 ps, _ = s.accept()
                 ep.register(ps.fileno(), select.EPOLLIN)
                 fileno_to_socket[ps.fileno()] = ps
-            elif fileno == tracker_update_timer:
-                if tracker.make_request(fs.torrent_size, 0, 0, False):
-                    for peer in tracker.peers:
-                        t = threading.Thread(target=connect_to_peer, args=(peer,))
-                        t.start()
-                timerfd.settime(tracker_update_timer,0,30,0)
+            elif utp is not None and utp.owns(fileno):
+                for ps in utp.handle(fileno, eventmask):
+                    fileno_to_socket[ps.fileno()] = ps
+                    ep.register(ps.fileno(), select.EPOLLIN)
+                for data, address in utp.take_datagrams():
+                    if dht is not None:
+                        for peer in dht.receive(data, address):
+                            add_peer(peer)
+            elif lsd is not None and lsd.owns(fileno):
+                for peer in lsd.handle(fileno, eventmask):
+                    pm.local_ips.add(peer.peer_ip)
+                    add_peer(peer)
+            elif announcer is not None and announcer.owns(fileno):
+                for peer in announcer.handle(fileno, eventmask):
+                    add_peer(peer)
+            elif dht is not None and dht.owns(fileno):
+                for peer in dht.handle(fileno, eventmask):
+                    add_peer(peer)
+            elif fileno == fs.disk.fileno():
+                fs.disk.process()
+            elif shared is not None and fileno == shared.peer_pipe():
+                for peer in shared.read_peers():
+                    add_peer(peer)
             else: # Message from existing peer
                 ps = fileno_to_socket[fileno]
                 try:
@@ -157,10 +351,29 @@ if __name__ == "__main__":
                         ep.unregister(fileno)
                         del fileno_to_socket[fileno]
                         pm.dropPeer(ps)
+                        ps.close()
                     else:
                         pm.recvMessage(message, ps)
                 except ConnectionResetError:
                     ep.unregister(fileno)
                     del fileno_to_socket[fileno]
                     pm.dropPeer(ps)
-        pm.update()
\ No newline at end of file
+                    ps.close()
+        pm.update()
+        fs.retry_writes()
+        for ps in pm.takeClosed():
+            if ps.fileno() in fileno_to_socket:
+                ep.unregister(ps.fileno())
+                del fileno_to_socket[ps.fileno()]
+            ps.close()
+        for peer in pm.takeDiscovered():
+            add_peer(peer)
+        for ip, dht_port in pm.takeDhtNodes():
+            if dht is not None:
+                dht.add_node(ip, dht_port)
+        if fs.finished() and not completed:
+            completed = True
+            logging.info("Download complete")
+            if announcer is not None:
+                for peer in announcer.announce('completed'):
+                    add_peer(peer)
\ No newline at end of file
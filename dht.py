@@ -0,0 +1,488 @@
+import os
+import time
+import select
+import socket
+import struct
+import hashlib
+import logging
+import timerfd
+import bencode
+
+import bdecode
+from peer import Peer
+
+# Mainline DHT (BEP 5)
+K = 8
+ALPHA = 3
+ID_SPACE = 2 ** 160
+BOOTSTRAP = [('router.bittorrent.com', 6881), ('dht.transmissionbt.com', 6881), ('router.utorrent.com', 6881)]
+
+def distance(a: bytes, b: bytes) -> int:
+    return int.from_bytes(a, 'big') ^ int.from_bytes(b, 'big')
+
+def compact_nodes(nodes: list) -> bytes:
+    return b''.join(node.id + socket.inet_aton(node.ip) + struct.pack('!H', node.port) for node in nodes)
+
+def parse_nodes(data: bytes) -> list:
+    nodes = []
+    for i in range(0, len(data) - len(data) % 26, 26):
+        node_id, ip, port = struct.unpack('!20s4sH', data[i:i + 26])
+        if port != 0:
+            nodes.append(Node(node_id, socket.inet_ntoa(ip), port))
+    return nodes
+
+class Node:
+    failures: int = 0
+    last_seen: float = 0
+
+    def __init__(self, node_id: bytes, ip: str, port: int) -> None:
+        self.id = node_id
+        self.ip = ip
+        self.port = port
+
+    def __repr__(self) -> str:
+        return f'Node({self.id.hex() if self.id else None}, {self.ip}, {self.port})'
+
+    @property
+    def address(self) -> tuple:
+        return (self.ip, self.port)
+
+class Bucket:
+    def __init__(self, low: int, high: int) -> None:
+        self.low = low
+        self.high = high
+        self.nodes = []
+
+    def covers(self, node_id: bytes) -> bool:
+        return self.low <= int.from_bytes(node_id, 'big') < self.high
+
+class RoutingTable:
+    """
+    K-buckets over the id space. Only the bucket holding our own id is split, so the
+    table knows many nodes close to us and a few from every other region.
+    """
+    max_failures = 2
+
+    def __init__(self, own_id: bytes) -> None:
+        self.own_id = own_id
+        self.buckets = [Bucket(0, ID_SPACE)]
+
+    def __len__(self) -> int:
+        return sum(len(bucket.nodes) for bucket in self.buckets)
+
+    def _bucket(self, node_id: bytes) -> Bucket:
+        for bucket in self.buckets:
+            if bucket.covers(node_id):
+                return bucket
+
+    def add(self, node: Node) -> bool:
+        if node.id is None or len(node.id) != 20 or node.id == self.own_id:
+            return False
+        bucket = self._bucket(node.id)
+        for existing in bucket.nodes:
+            if existing.id == node.id:
+                existing.ip, existing.port = node.ip, node.port
+                existing.last_seen = time.monotonic()
+                existing.failures = 0
+                bucket.nodes.remove(existing)
+                bucket.nodes.append(existing)
+                return True
+        node.last_seen = time.monotonic()
+        if len(bucket.nodes) < K:
+            bucket.nodes.append(node)
+            return True
+        # A full bucket makes room by dropping a node that stopped answering
+        for i, existing in enumerate(bucket.nodes):
+            if existing.failures >= self.max_failures:
+                bucket.nodes[i] = node
+                return True
+        if bucket.covers(self.own_id) and bucket.high - bucket.low > K:
+            self._split(bucket)
+            return self.add(node)
+        return False
+
+    def _split(self, bucket: Bucket) -> None:
+        middle = (bucket.low + bucket.high) // 2
+        low, high = Bucket(bucket.low, middle), Bucket(middle, bucket.high)
+        for node in bucket.nodes:
+            (low if low.covers(node.id) else high).nodes.append(node)
+        i = self.buckets.index(bucket)
+        self.buckets[i:i + 1] = [low, high]
+
+    def fail(self, address: tuple) -> None:
+        for node in self.nodes():
+            if node.address == address:
+                node.failures += 1
+
+    def nodes(self) -> list:
+        return [node for bucket in self.buckets for node in bucket.nodes]
+
+    def closest(self, target: bytes, count: int = K) -> list:
+        nodes = [node for node in self.nodes() if node.failures < self.max_failures]
+        return sorted(nodes, key=lambda node: distance(node.id, target))[:count]
+
+class Lookup:
+    """
+    Iterative get_peers or find_node towards target. At most ALPHA queries are in flight,
+    answers add closer nodes to the candidates, and the lookup is done once the K closest
+    candidates have all answered or failed.
+    """
+    def __init__(self, kind: str, target: bytes, nodes: list, announce_port: int = None) -> None:
+        self.kind = kind
+        self.target = target
+        self.announce_port = announce_port
+        self.candidates = {}
+        self.queried = set()
+        self.failed = set()
+        self.tokens = {}
+        self.in_flight = 0
+        self.peers = set()
+        self.add(nodes)
+
+    def __repr__(self) -> str:
+        return f'Lookup({self.kind}, {self.target.hex()}, candidates={len(self.candidates)}, queried={len(self.queried)}, peers={len(self.peers)})'
+
+    def _distance(self, node: Node) -> int:
+        # Bootstrap routers are only known by address
+        return distance(node.id, self.target) if node.id is not None else ID_SPACE
+
+    def add(self, nodes: list) -> None:
+        for node in nodes:
+            if node.address not in self.candidates:
+                self.candidates[node.address] = node
+
+    def _closest(self) -> list:
+        nodes = [node for node in self.candidates.values() if node.address not in self.failed]
+        return sorted(nodes, key=self._distance)[:K]
+
+    def next_nodes(self) -> list:
+        nodes = []
+        for node in self._closest():
+            if self.in_flight + len(nodes) >= ALPHA:
+                break
+            if node.address not in self.queried:
+                nodes.append(node)
+        return nodes
+
+    def done(self) -> bool:
+        return self.in_flight == 0 and all(node.address in self.queried for node in self._closest())
+
+    def closest_with_tokens(self) -> list:
+        return [node for node in self._closest() if node.address in self.tokens]
+
+class DHT:
+    """
+    DHT node on a UDP socket in the event loop. Answers ping, find_node, get_peers and
+    announce_peer, and looks up peers for the torrents it searches for every 15 minutes,
+    announcing itself to the closest nodes. The routing table is saved to path so a
+    restart does not have to bootstrap again.
+    """
+    query_timeout = 5
+    search_interval = 15 * 60
+    retry_interval = 30
+    save_interval = 5 * 60
+    secret_interval = 5 * 60
+    peer_lifetime = 30 * 60
+    max_values = 50
+    queries = 0
+
+    def __init__(self, ip: str, port: int, ep: select.epoll, path: str = 'dht.dat', bootstrap: list = BOOTSTRAP, s: socket.socket = None) -> None:
+        self.ep = ep
+        self.path = path
+        self.logger = logging.getLogger(__name__)
+        # With s given the socket belongs to someone else, who passes our datagrams to receive
+        self.shared = s is not None
+        if s is None:
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.setblocking(False)
+            s.bind((ip, port))
+        self.s = s
+        self.id = None
+        nodes = self._load()
+        if self.id is None:
+            self.id = os.urandom(20)
+        self.table = RoutingTable(self.id)
+        self.transactions = {}
+        self.lookups = []
+        self.searches = {}
+        self.unanswered = set()
+        self.storage = {}
+        self.secrets = [os.urandom(16), os.urandom(16)]
+        now = time.monotonic()
+        self.next_secret = now + self.secret_interval
+        self.next_save = now + self.save_interval
+        self.timer = timerfd.create(timerfd.CLOCK_MONOTONIC, 0)
+        ep.register(self.timer, select.EPOLLIN)
+        if not self.shared:
+            ep.register(self.s.fileno(), select.EPOLLIN)
+        # Saved nodes are used right away and pinged so dead ones drop out, the routers are only asked when none was saved
+        for node in nodes:
+            self.table.add(node)
+            self._query(node.address, 'ping', {})
+        if len(nodes) == 0:
+            self.bootstrap(bootstrap)
+        self._arm()
+
+    def __repr__(self) -> str:
+        return f'DHT(id={self.id.hex()}, nodes={len(self.table)}, lookups={len(self.lookups)}, searches={len(self.searches)}, queries={self.queries}, stored={sum(len(peers) for peers in self.storage.values())})'
+
+    def owns(self, fileno: int) -> bool:
+        return fileno == self.timer or not self.shared and fileno == self.s.fileno()
+
+    def handle(self, fileno: int, eventmask: int) -> list[Peer]:
+        """
+        Returns peers found by running lookups
+        """
+        if fileno == self.timer:
+            peers = self._expire()
+        else:
+            peers = self._receive()
+        self._arm()
+        return peers
+
+    def receive(self, data: bytes, address: tuple) -> list[Peer]:
+        """
+        Handles a datagram read from a shared socket, returns peers found by running lookups
+        """
+        peers = self._process(data, address)
+        self._arm()
+        return peers
+
+    def bootstrap(self, addresses: list) -> None:
+        nodes = []
+        for host, port in addresses:
+            try:
+                ip = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_DGRAM)[0][4][0]
+            except OSError:
+                continue
+            nodes.append(Node(None, ip, port))
+        self._lookup(Lookup('find_node', self.id, nodes))
+
+    def add_node(self, ip: str, port: int) -> None:
+        """
+        Asks a node we were told about for the nodes closest to us
+        """
+        self._lookup(Lookup('find_node', self.id, [Node(None, ip, port)]))
+        self._arm()
+
+    def search(self, info_hash: bytes, announce_port: int = None) -> None:
+        """
+        Looks up peers for info_hash now and every search_interval, announcing announce_port if given
+        """
+        self.searches[info_hash] = [announce_port, 0]
+        self._expire()
+        self._arm()
+
+    def close(self) -> None:
+        self.save()
+        self.ep.unregister(self.timer)
+        os.close(self.timer)
+        if not self.shared:
+            self.ep.unregister(self.s.fileno())
+            self.s.close()
+
+    def save(self) -> None:
+        data = bencode.encode({'id': self.id, 'nodes': compact_nodes(self.table.nodes())})
+        try:
+            with open(self.path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            self.logger.info(f'Could not save the DHT routing table: {e}')
+
+    def _load(self) -> list:
+        try:
+            with open(self.path, 'rb') as f:
+                state = bdecode.decode(f.read(), text=False)
+            if len(state['id']) == 20:
+                self.id = state['id']
+                return parse_nodes(state['nodes'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return []
+
+    def print(self) -> None:
+        print(self)
+        for lookup in self.lookups:
+            print(lookup)
+
+    def _token(self, ip: str, secret: bytes) -> bytes:
+        return hashlib.sha1(secret + socket.inet_aton(ip)).digest()[:8]
+
+    def _send(self, address: tuple, message: dict) -> None:
+        try:
+            self.s.sendto(bencode.encode(message), address)
+        except OSError as e:
+            self.logger.info(f'DHT send to {address} failed: {e}')
+
+    def _query(self, address: tuple, query: str, args: dict, lookup: Lookup = None) -> None:
+        tid = os.urandom(2)
+        while tid in self.transactions:
+            tid = os.urandom(2)
+        args['id'] = self.id
+        self.queries += 1
+        self.transactions[tid] = (query, address, lookup, time.monotonic() + self.query_timeout)
+        if lookup is not None:
+            lookup.queried.add(address)
+            lookup.in_flight += 1
+        self._send(address, {'t': tid, 'y': 'q', 'q': query, 'a': args})
+
+    def _receive(self) -> list[Peer]:
+        peers = []
+        while True:
+            try:
+                data, address = self.s.recvfrom(65536)
+            except BlockingIOError:
+                return peers
+            except OSError:
+                # ICMP errors from earlier sends, the query will time out
+                continue
+            peers += self._process(data, address)
+
+    def _process(self, data: bytes, address: tuple) -> list[Peer]:
+        try:
+            message = bdecode.decode(data, text=False)
+            kind = message['y']
+            tid = message['t']
+        except (ValueError, KeyError, TypeError, RecursionError):
+            # Anyone can send to the port, so nothing in a datagram may escape to the event loop
+            return []
+        if kind == b'q':
+            self._respond(message, address)
+        elif kind in (b'r', b'e') and tid in self.transactions:
+            return self._response(tid, message, address)
+        return []
+
+    def _respond(self, message: dict, address: tuple) -> None:
+        try:
+            query = message['q']
+            args = message['a']
+            node_id = args['id']
+        except (KeyError, TypeError):
+            return
+        if not isinstance(node_id, bytes) or len(node_id) != 20:
+            return
+        ip, port = address
+        self.table.add(Node(node_id, ip, port))
+        response = {'id': self.id}
+        if query == b'ping':
+            pass
+        elif query == b'find_node' and isinstance(args.get('target'), bytes):
+            response['nodes'] = compact_nodes(self.table.closest(args['target']))
+        elif query == b'get_peers' and isinstance(args.get('info_hash'), bytes):
+            info_hash = args['info_hash']
+            response['token'] = self._token(ip, self.secrets[0])
+            stored = self._stored(info_hash)
+            if len(stored) > 0:
+                response['values'] = [socket.inet_aton(peer_ip) + struct.pack('!H', peer_port) for peer_ip, peer_port in stored[:self.max_values]]
+            else:
+                response['nodes'] = compact_nodes(self.table.closest(info_hash))
+        elif query == b'announce_peer' and isinstance(args.get('info_hash'), bytes) and isinstance(args.get('port'), int):
+            if args.get('token') not in [self._token(ip, secret) for secret in self.secrets]:
+                self._send(address, {'t': message['t'], 'y': 'e', 'e': [203, 'Bad token']})
+                return
+            peer_port = port if args.get('implied_port') == 1 else args['port']
+            self.storage.setdefault(args['info_hash'], {})[(ip, peer_port)] = time.monotonic()
+        else:
+            self._send(address, {'t': message['t'], 'y': 'e', 'e': [204, 'Method unknown']})
+            return
+        self._send(address, {'t': message['t'], 'y': 'r', 'r': response})
+
+    def _stored(self, info_hash: bytes) -> list:
+        now = time.monotonic()
+        peers = self.storage.get(info_hash, {})
+        for address in [address for address, seen in peers.items() if seen + self.peer_lifetime <= now]:
+            del peers[address]
+        return list(peers)
+
+    def _response(self, tid: bytes, message: dict, address: tuple) -> list[Peer]:
+        query, queried, lookup, _ = self.transactions.pop(tid)
+        response = message.get('r')
+        if message['y'] == b'e' or not isinstance(response, dict) or not isinstance(response.get('id'), bytes):
+            self.table.fail(queried)
+            if lookup is not None:
+                lookup.in_flight -= 1
+                lookup.failed.add(queried)
+                return self._advance(lookup)
+            return []
+        node = Node(response['id'], *address)
+        self.table.add(node)
+        if lookup is None:
+            return []
+        lookup.in_flight -= 1
+        # Routers answer from an id we did not know before
+        if queried in lookup.candidates:
+            lookup.candidates[queried].id = response['id']
+        if isinstance(response.get('nodes'), bytes):
+            lookup.add(parse_nodes(response['nodes']))
+        peers = []
+        if isinstance(response.get('token'), bytes):
+            lookup.tokens[queried] = response['token']
+        if isinstance(response.get('values'), list):
+            for value in response['values']:
+                if isinstance(value, bytes) and len(value) == 6:
+                    ip, port = socket.inet_ntoa(value[:4]), struct.unpack('!H', value[4:])[0]
+                    if (ip, port) not in lookup.peers:
+                        lookup.peers.add((ip, port))
+                        peers.append(Peer(None, ip, port))
+        return peers + self._advance(lookup)
+
+    def _lookup(self, lookup: Lookup) -> None:
+        self.lookups.append(lookup)
+        self._advance(lookup)
+
+    def _advance(self, lookup: Lookup) -> list[Peer]:
+        for node in lookup.next_nodes():
+            args = {'target': lookup.target} if lookup.kind == 'find_node' else {'info_hash': lookup.target}
+            self._query(node.address, lookup.kind, args, lookup)
+        if lookup.done() and lookup in self.lookups:
+            self.lookups.remove(lookup)
+            if lookup.announce_port is not None:
+                for node in lookup.closest_with_tokens():
+                    args = {'info_hash': lookup.target, 'port': lookup.announce_port, 'token': lookup.tokens[node.address]}
+                    self._query(node.address, 'announce_peer', args)
+            answered = len(lookup.queried - lookup.failed) > 0
+            if lookup.kind == 'get_peers' and not answered and lookup.target in self.searches:
+                # Nobody answered, likely because the table is still filling, try again soon
+                self.unanswered.add(lookup.target)
+                search = self.searches[lookup.target]
+                search[1] = min(search[1], time.monotonic() + self.retry_interval)
+            elif lookup.kind == 'get_peers':
+                self.unanswered.discard(lookup.target)
+            elif answered:
+                # The table just gained nodes, searches that found nobody can run now
+                for info_hash in self.unanswered:
+                    self.searches[info_hash][1] = 0
+            self.logger.info(f'DHT {lookup} finished')
+        return []
+
+    def _expire(self) -> list[Peer]:
+        peers = []
+        now = time.monotonic()
+        for tid, (query, address, lookup, deadline) in list(self.transactions.items()):
+            if deadline <= now:
+                del self.transactions[tid]
+                self.table.fail(address)
+                if lookup is not None:
+                    lookup.in_flight -= 1
+                    lookup.failed.add(address)
+                    peers += self._advance(lookup)
+        for info_hash, search in self.searches.items():
+            announce_port, next_search = search
+            if next_search <= now:
+                search[1] = now + self.search_interval
+                self._lookup(Lookup('get_peers', info_hash, self.table.closest(info_hash), announce_port))
+        if self.next_secret <= now:
+            # Tokens stay valid for one rotation
+            self.secrets = [os.urandom(16), self.secrets[0]]
+            self.next_secret = now + self.secret_interval
+        if self.next_save <= now:
+            self.save()
+            self.next_save = now + self.save_interval
+        return peers
+
+    def _arm(self) -> None:
+        deadlines = [self.next_secret, self.next_save]
+        deadlines += [deadline for _, _, _, deadline in self.transactions.values()]
+        deadlines += [next_search for _, next_search in self.searches.values()]
+        timerfd.settime(self.timer, 0, max(min(deadlines) - time.monotonic(), 0.001), 0)
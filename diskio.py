@@ -0,0 +1,209 @@
+import os
+import threading
+import logging
+from collections import deque
+from typing import Callable
+
+FSYNC_NEVER = 'never'
+FSYNC_WRITE = 'write'
+FSYNC_COMPLETE = 'complete'
+
+class Job:
+    def __init__(self, kind: str, file, offset: int, data=None, length: int = 0, batch=None, slot: int = 0) -> None:
+        self.kind = kind
+        self.file = file
+        self.offset = offset
+        self.data = data
+        self.length = length if data is None else len(data)
+        self.batch = batch
+        self.slot = slot
+
+class Batch:
+    """
+    Jobs submitted together, the callback runs on the event loop once all are done
+    """
+    def __init__(self, kind: str, callback: Callable, count: int) -> None:
+        self.kind = kind
+        self.callback = callback
+        self.remaining = count
+        self.results = [None] * count
+        self.error = None
+
+class DiskIO:
+    """
+    Worker threads for file reads, writes and fsyncs. Completions are posted to a
+    pipe that the event loop polls, and callbacks run in process() on the loop thread.
+    """
+    workers: int
+    max_queued_bytes: int
+    fsync_policy: str
+    queued_bytes: int = 0
+
+    writes: int = 0
+    coalesced: int = 0
+
+    def __init__(self, workers: int = 2, max_queued_bytes: int = 64 * 1024 * 1024, fsync_policy: str = FSYNC_COMPLETE) -> None:
+        self.workers = workers
+        self.max_queued_bytes = max_queued_bytes
+        self.fsync_policy = fsync_policy
+        self.logger = logging.getLogger(__name__)
+        self.pid = None
+
+    def __repr__(self) -> str:
+        return f"DiskIO(workers={self.workers}, queued_bytes={self.queued_bytes}, writes={self.writes}, coalesced={self.coalesced}, fsync_policy={self.fsync_policy})"
+
+    def _start(self) -> None:
+        # Threads do not survive fork, so each worker process starts its own pool
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.cond = threading.Condition()
+        self.fdlock = threading.Lock()
+        self.jobs = deque()
+        self.done = deque()
+        self.fds = {}
+        self.queued_bytes = 0
+        self.rfd, self.wfd = os.pipe()
+        os.set_blocking(self.rfd, False)
+        os.set_blocking(self.wfd, False)
+        for i in range(self.workers):
+            t = threading.Thread(target=self._work, daemon=True)
+            t.start()
+
+    def fileno(self) -> int:
+        self._start()
+        return self.rfd
+
+    def full(self) -> bool:
+        return self.queued_bytes >= self.max_queued_bytes
+
+    def write(self, extents: list[tuple], callback: Callable = None) -> None:
+        """
+        extents is a list of (file, offset, data), callback gets True once all are written and False if one failed
+        """
+        self._start()
+        batch = Batch('write', callback, len(extents))
+        with self.cond:
+            for slot, (file, offset, data) in enumerate(extents):
+                self.jobs.append(Job('write', file, offset, data=data, batch=batch, slot=slot))
+                self.queued_bytes += len(data)
+            self.cond.notify_all()
+
+    def read(self, extents: list[tuple], callback: Callable) -> None:
+        """
+        extents is a list of (file, offset, length), callback gets the joined data or None
+        """
+        self._start()
+        batch = Batch('read', callback, len(extents))
+        with self.cond:
+            for slot, (file, offset, length) in enumerate(extents):
+                self.jobs.append(Job('read', file, offset, length=length, batch=batch, slot=slot))
+            self.cond.notify_all()
+
+    def sync(self, files: list, callback: Callable = None) -> None:
+        """
+        callback gets True once every file is flushed and False if one failed
+        """
+        self._start()
+        batch = Batch('sync', callback, len(files))
+        with self.cond:
+            for slot, file in enumerate(files):
+                self.jobs.append(Job('sync', file, 0, batch=batch, slot=slot))
+            self.cond.notify_all()
+
+    def process(self) -> None:
+        try:
+            os.read(self.rfd, 4096)
+        except BlockingIOError:
+            pass
+        while len(self.done) > 0:
+            batch = self.done.popleft()
+            if batch.error is not None:
+                self.logger.info(f'Disk operation failed: {batch.error}')
+            if batch.callback is None:
+                continue
+            if batch.kind == 'read':
+                batch.callback(None if batch.error is not None else b''.join(batch.results))
+            else:
+                batch.callback(batch.error is None)
+
+    def _work(self) -> None:
+        while True:
+            with self.cond:
+                while len(self.jobs) == 0:
+                    self.cond.wait()
+                job = self.jobs.popleft()
+                jobs = [job]
+                if job.kind == 'write':
+                    jobs = self._coalesce(job)
+            try:
+                if job.kind == 'write':
+                    self._write(jobs)
+                elif job.kind == 'read':
+                    fd = self._open(job.file, os.O_RDONLY)
+                    job.batch.results[job.slot] = os.pread(fd, job.length, job.offset)
+                elif job.kind == 'sync':
+                    if os.path.exists(job.file.path):
+                        os.fsync(self._open(job.file, os.O_RDWR))
+            except OSError as e:
+                for failed in jobs:
+                    failed.batch.error = e
+            self._finish(jobs)
+
+    def _coalesce(self, job: Job) -> list[Job]:
+        # Pull queued writes that continue this one in the same file
+        jobs = [job]
+        end = job.offset + job.length
+        found = True
+        while found:
+            found = False
+            for other in self.jobs:
+                if other.kind == 'write' and other.file.path == job.file.path and other.offset == end:
+                    self.jobs.remove(other)
+                    jobs.append(other)
+                    end += other.length
+                    found = True
+                    break
+        return jobs
+
+    def _write(self, jobs: list[Job]) -> None:
+        fd = self._open(jobs[0].file, os.O_RDWR | os.O_CREAT)
+        data = jobs[0].data if len(jobs) == 1 else b''.join(job.data for job in jobs)
+        view = memoryview(data)
+        offset = jobs[0].offset
+        while len(view) > 0:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+        if self.fsync_policy == FSYNC_WRITE:
+            os.fsync(fd)
+        self.writes += 1
+        self.coalesced += len(jobs) - 1
+
+    def _open(self, file, flags: int) -> int:
+        key = (file.path, flags)
+        with self.fdlock:
+            if key not in self.fds:
+                if flags & os.O_CREAT:
+                    directory = os.path.dirname(file.path)
+                    if directory != '':
+                        os.makedirs(directory, exist_ok=True)
+                fd = os.open(file.path, flags, 0o644)
+                if flags & os.O_CREAT and os.fstat(fd).st_size != file.length:
+                    os.ftruncate(fd, file.length)
+                self.fds[key] = fd
+            return self.fds[key]
+
+    def _finish(self, jobs: list[Job]) -> None:
+        with self.cond:
+            for job in jobs:
+                if job.kind == 'write':
+                    self.queued_bytes -= job.length
+                job.batch.remaining -= 1
+                if job.batch.remaining == 0:
+                    self.done.append(job.batch)
+        try:
+            os.write(self.wfd, b'\0')
+        except BlockingIOError:
+            # The loop has not drained earlier wakeups yet, it will see this batch too
+            pass
@@ -0,0 +1,40 @@
+import struct
+import bencode
+
+import bdecode
+
+# Extension protocol (BEP 10), negotiated with bit 0x10 of reserved byte 5
+EXTENDED = 20
+HANDSHAKE = 0
+RESERVED = bytes([0, 0, 0, 0, 0, 0x10, 0, 0])
+
+# Ids we assign to the extensions we support, peers send these messages to us with them
+LOCAL_IDS = {'ut_metadata': 1, 'ut_pex': 2}
+
+def supported(reserved: bytes) -> bool:
+    return len(reserved) == 8 and reserved[5] & 0x10 != 0
+
+def message(ext_id: int, payload: bytes) -> bytes:
+    return struct.pack('!IBB', 2 + len(payload), EXTENDED, ext_id) + payload
+
+def handshake(port: int = None, metadata_size: int = None) -> bytes:
+    data = {'m': LOCAL_IDS, 'v': 'bittorrent.py'}
+    if port:
+        data['p'] = port
+    if metadata_size is not None:
+        data['metadata_size'] = metadata_size
+    return message(HANDSHAKE, bencode.encode(data))
+
+def parse_handshake(payload: bytes) -> dict:
+    """
+    Returns the peer's handshake dict, or an empty one if it is malformed
+    """
+    try:
+        data = bdecode.decode(payload)
+    except bdecode.DecodeError:
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    if not isinstance(data.get('m'), dict):
+        data['m'] = {}
+    return data
@@ -0,0 +1,36 @@
+import socket
+import hashlib
+
+# Fast extension (BEP 6), negotiated with bit 0x04 of reserved byte 7
+SUGGEST = 0x0D
+HAVE_ALL = 0x0E
+HAVE_NONE = 0x0F
+REJECT = 0x10
+ALLOWED_FAST = 0x11
+
+ALLOWED_FAST_COUNT = 10
+
+def supported(reserved: bytes) -> bool:
+    return len(reserved) == 8 and reserved[7] & 0x04 != 0
+
+def allowed_fast_set(ip: str, info_hash: bytes, piece_count: int, count: int = ALLOWED_FAST_COUNT) -> list[int]:
+    """
+    Canonical allowed fast set for a peer, the same on every client so it cannot be
+    grown by reconnecting from another port
+    """
+    try:
+        address = socket.inet_aton(ip)
+    except OSError:
+        return []
+    count = min(count, piece_count)
+    pieces = []
+    x = bytes([address[0], address[1], address[2], 0]) + info_hash
+    while len(pieces) < count:
+        x = hashlib.sha1(x).digest()
+        for i in range(0, 20, 4):
+            if len(pieces) >= count:
+                break
+            index = int.from_bytes(x[i:i + 4], 'big') % piece_count
+            if index not in pieces:
+                pieces.append(index)
+    return pieces
@@ -0,0 +1,139 @@
+import os
+import time
+import select
+import socket
+import logging
+import timerfd
+
+from peer import Peer
+
+# Local service discovery (BEP 14), announces go to a multicast group that only reaches the local network
+GROUP = '239.192.152.143'
+PORT = 6771
+
+def message(info_hashes: list, port: int, cookie: str) -> bytes:
+    lines = ['BT-SEARCH * HTTP/1.1', f'Host: {GROUP}:{PORT}', f'Port: {port}']
+    lines += [f'Infohash: {info_hash.hex()}' for info_hash in info_hashes]
+    lines += [f'cookie: {cookie}', '', '']
+    return '\r\n'.join(lines).encode()
+
+def parse(data: bytes) -> tuple:
+    """
+    Returns (port, info hashes, cookie) of an announce, raises ValueError if it is malformed
+    """
+    lines = data.decode('ascii', 'replace').split('\r\n')
+    if not lines[0].startswith('BT-SEARCH * HTTP/1.1'):
+        raise ValueError('Not a local service discovery announce')
+    port = None
+    info_hashes = []
+    cookie = None
+    for line in lines[1:]:
+        name, _, value = line.partition(':')
+        name = name.strip().lower()
+        value = value.strip()
+        if name == 'port' and value.isdigit() and 0 < int(value) < 65536:
+            port = int(value)
+        elif name == 'infohash' and len(value) == 40:
+            info_hashes.append(bytes.fromhex(value))
+        elif name == 'cookie':
+            cookie = value
+    if port is None:
+        raise ValueError('Announce has no port')
+    return port, info_hashes, cookie
+
+class LSD:
+    """
+    Announces our torrents on the local network and finds peers announcing them. The cookie
+    tells our own announces apart when the group loops them back
+    """
+    interval = 5 * 60
+    min_interval = 60
+    announces = 0
+
+    def __init__(self, ip: str, port: int, info_hashes: list, ep: select.epoll) -> None:
+        self.ep = ep
+        self.port = port
+        self.info_hashes = info_hashes
+        self.logger = logging.getLogger(__name__)
+        self.cookie = os.urandom(8).hex()
+        # Every client on the host listens on the group port
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.s.setblocking(False)
+        self.s.bind(('', PORT))
+        interface = socket.inet_aton(ip)
+        self.s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(GROUP) + interface)
+        self.s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, interface)
+        self.s.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        self.last_announce = -self.min_interval
+        self.next_announce = 0
+        self.seen = set()
+        self.timer = timerfd.create(timerfd.CLOCK_MONOTONIC, 0)
+        ep.register(self.timer, select.EPOLLIN)
+        ep.register(self.s.fileno(), select.EPOLLIN)
+        self.announce()
+
+    def __repr__(self) -> str:
+        return f'LSD(port={self.port}, torrents={len(self.info_hashes)}, announces={self.announces}, next announce in {max(self.next_announce - time.monotonic(), 0):.0f} s)'
+
+    def owns(self, fileno: int) -> bool:
+        return fileno == self.timer or fileno == self.s.fileno()
+
+    def handle(self, fileno: int, eventmask: int) -> list[Peer]:
+        """
+        Returns peers on the local network that announced one of our torrents
+        """
+        peers = []
+        if fileno == self.timer:
+            self.announce()
+        else:
+            peers = self._receive()
+        return peers
+
+    def announce(self) -> None:
+        now = time.monotonic()
+        if now - self.last_announce < self.min_interval:
+            # At most one announce a minute, a later one is sent when the minute is up
+            self.next_announce = min(self.next_announce, self.last_announce + self.min_interval)
+        else:
+            try:
+                self.s.sendto(message(self.info_hashes, self.port, self.cookie), (GROUP, PORT))
+                self.announces += 1
+            except OSError as e:
+                self.logger.info(f'Local service discovery announce failed: {e}')
+            self.last_announce = now
+            self.next_announce = now + self.interval
+        timerfd.settime(self.timer, 0, max(self.next_announce - now, 0.001), 0)
+
+    def close(self) -> None:
+        self.ep.unregister(self.timer)
+        self.ep.unregister(self.s.fileno())
+        os.close(self.timer)
+        self.s.close()
+
+    def print(self) -> None:
+        print(self)
+
+    def _receive(self) -> list[Peer]:
+        peers = []
+        while True:
+            try:
+                data, (ip, _) = self.s.recvfrom(65536)
+            except BlockingIOError:
+                return peers
+            except OSError:
+                continue
+            try:
+                port, info_hashes, cookie = parse(data)
+            except ValueError:
+                continue
+            if cookie == self.cookie or not any(info_hash in self.info_hashes for info_hash in info_hashes):
+                continue
+            peer = Peer(None, ip, port)
+            peer.local = True
+            peers.append(peer)
+            # Answer peers we have not heard from so they do not wait for our next announce
+            if (ip, port) not in self.seen:
+                self.seen.add((ip, port))
+                self.announce()
@@ -0,0 +1,129 @@
+import os
+import sys
+import time
+import hashlib
+import argparse
+import bencode
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+MIN_PIECE_LENGTH = 16 * 1024
+MAX_PIECE_LENGTH = 16 * 1024 * 1024
+TARGET_PIECES = 1500
+READ_SIZE = 8 * 1024 * 1024
+
+def piece_length_for(size: int) -> int:
+    """
+    Smallest power of two that keeps the torrent near TARGET_PIECES pieces
+    """
+    length = MIN_PIECE_LENGTH
+    while length < MAX_PIECE_LENGTH and size / length > TARGET_PIECES:
+        length *= 2
+    return length
+
+def list_files(path: str) -> list[tuple]:
+    """
+    Returns (full path, path components relative to the torrent root, length) in torrent order
+    """
+    if os.path.isfile(path):
+        return [(path, [os.path.basename(path)], os.path.getsize(path))]
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs.sort()
+        for name in sorted(names):
+            full = os.path.join(root, name)
+            if os.path.isfile(full):
+                files.append((full, os.path.relpath(full, path).split(os.sep), os.path.getsize(full)))
+    return files
+
+def read_chunks(files: list[tuple], size: int):
+    """
+    Yields the concatenated file contents in chunks of size bytes, the last one may be shorter
+    """
+    chunk = bytearray()
+    for full, _, _ in files:
+        with open(full, 'rb', buffering=0) as f:
+            while True:
+                data = f.read(size - len(chunk))
+                if not data:
+                    break
+                chunk += data
+                if len(chunk) == size:
+                    yield bytes(chunk)
+                    chunk = bytearray()
+    if len(chunk) > 0:
+        yield bytes(chunk)
+
+def hash_pieces(chunk: bytes, piece_length: int) -> bytes:
+    # hashlib releases the GIL on large buffers, so worker threads hash on separate cores
+    view = memoryview(chunk)
+    return b''.join(hashlib.sha1(view[i:i + piece_length]).digest() for i in range(0, len(view), piece_length))
+
+def hash_files(files: list[tuple], piece_length: int, workers: int = None, window: int = None) -> bytes:
+    """
+    Reads the files sequentially in large chunks and hashes the chunks on a thread pool,
+    with at most window chunks read but not yet hashed
+    """
+    workers = workers if workers is not None else os.cpu_count() or 1
+    window = window if window is not None else workers * 2
+    # Every chunk is a whole number of pieces so no piece straddles two jobs
+    chunk_size = max(READ_SIZE // piece_length, 1) * piece_length
+    pieces = []
+    pending = deque()
+    with ThreadPoolExecutor(workers) as pool:
+        for chunk in read_chunks(files, chunk_size):
+            if len(pending) >= window:
+                pieces.append(pending.popleft().result())
+            pending.append(pool.submit(hash_pieces, chunk, piece_length))
+        while len(pending) > 0:
+            pieces.append(pending.popleft().result())
+    return b''.join(pieces)
+
+def make_torrent(path: str, announce: str, piece_length: int = None, workers: int = None, comment: str = None, announce_list: list = None) -> dict:
+    """
+    Builds the torrent dict for a single file or a directory
+    """
+    path = os.path.normpath(path)
+    files = list_files(path)
+    size = sum(length for _, _, length in files)
+    if size == 0:
+        raise ValueError(f'Nothing to share in {path}')
+    if piece_length is None:
+        piece_length = piece_length_for(size)
+    info = {'name': os.path.basename(path), 'piece length': piece_length, 'pieces': hash_files(files, piece_length, workers)}
+    if os.path.isfile(path):
+        info['length'] = size
+    else:
+        info['files'] = [{'length': length, 'path': components} for _, components, length in files]
+    torrent = {'announce': announce, 'info': info, 'creation date': int(time.time()), 'created by': 'bittorrent.py'}
+    if announce_list is not None:
+        torrent['announce-list'] = announce_list
+    if comment is not None:
+        torrent['comment'] = comment
+    return torrent
+
+def write_torrent(torrent: dict, output: str) -> None:
+    with open(output, 'wb') as f:
+        f.write(bencode.encode(torrent))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Create a .torrent file for a file or directory')
+    parser.add_argument('path')
+    parser.add_argument('announce', nargs='+', help='tracker URLs, each one becomes its own tier')
+    parser.add_argument('-o', '--output', help='defaults to <name>.torrent')
+    parser.add_argument('-l', '--piece-length', type=int, help='power of two in bytes, picked from the size by default')
+    parser.add_argument('-w', '--workers', type=int, help='hashing threads, defaults to the number of cores')
+    parser.add_argument('-c', '--comment')
+    args = parser.parse_args()
+
+    if args.piece_length is not None and (args.piece_length < MIN_PIECE_LENGTH or args.piece_length & (args.piece_length - 1) != 0):
+        sys.exit(f'Piece length must be a power of two of at least {MIN_PIECE_LENGTH}')
+    announce_list = [[url] for url in args.announce] if len(args.announce) > 1 else None
+    start = time.monotonic()
+    torrent = make_torrent(args.path, args.announce[0], args.piece_length, args.workers, args.comment, announce_list)
+    output = args.output if args.output is not None else torrent['info']['name'] + '.torrent'
+    write_torrent(torrent, output)
+    info = torrent['info']
+    size = info['length'] if 'length' in info else sum(file['length'] for file in info['files'])
+    elapsed = time.monotonic() - start
+    print(f'{output}: {size} bytes, {len(info["pieces"]) // 20} pieces of {info["piece length"]} bytes, hashed in {elapsed:.2f} s ({size / max(elapsed, 1e-9) / 1024 ** 2:.0f} MiB/s)')
@@ -0,0 +1,293 @@
+import time
+import errno
+import base64
+import socket
+import select
+import struct
+import hashlib
+import logging
+import urllib.parse
+import bencode
+
+import bdecode
+import extension
+from peer import Peer
+
+# Metadata exchange (BEP 9), the info dict travels in 16 KiB pieces over ut_metadata
+PIECE_SIZE = 16384
+MAX_SIZE = 16 * 1024 * 1024
+REQUEST = 0
+DATA = 1
+REJECT = 2
+# Seconds without a new metadata piece before a magnet link is given up
+IDLE_TIMEOUT = 300
+
+class Magnet:
+    """
+    Info hash, display name, trackers and peer addresses of a magnet URI (BEP 9)
+    """
+    info_hash: bytes
+    name: str = None
+    trackers: list
+    peers: list
+
+    def __init__(self, uri: str) -> None:
+        parsed = urllib.parse.urlparse(uri)
+        if parsed.scheme != 'magnet':
+            raise ValueError(f'Not a magnet link: {uri}')
+        query = urllib.parse.parse_qs(parsed.query)
+        self.info_hash = None
+        for xt in query.get('xt', []):
+            if xt.startswith('urn:btih:'):
+                self.info_hash = self._parse_hash(xt[len('urn:btih:'):])
+        if self.info_hash is None:
+            raise ValueError(f'Magnet link has no BitTorrent info hash: {uri}')
+        if 'dn' in query:
+            self.name = query['dn'][0]
+        self.trackers = query.get('tr', [])
+        self.peers = []
+        for address in query.get('x.pe', []):
+            host, _, port = address.rpartition(':')
+            if host != '' and port.isdigit():
+                self.peers.append(Peer(None, host.strip('[]'), int(port)))
+
+    def __repr__(self) -> str:
+        return f'Magnet(info_hash={self.info_hash.hex()}, name={self.name}, trackers={self.trackers}, peers={len(self.peers)})'
+
+    @staticmethod
+    def _parse_hash(value: str) -> bytes:
+        if len(value) == 40:
+            return bytes.fromhex(value)
+        if len(value) == 32:
+            return base64.b32decode(value.upper())
+        raise ValueError(f'Invalid info hash in magnet link: {value}')
+
+def request_message(ext_id: int, piece: int) -> bytes:
+    return extension.message(ext_id, bencode.encode({'msg_type': REQUEST, 'piece': piece}))
+
+def data_message(ext_id: int, piece: int, metadata: bytes) -> bytes:
+    header = bencode.encode({'msg_type': DATA, 'piece': piece, 'total_size': len(metadata)})
+    return extension.message(ext_id, header + metadata[piece * PIECE_SIZE:(piece + 1) * PIECE_SIZE])
+
+def reject_message(ext_id: int, piece: int) -> bytes:
+    return extension.message(ext_id, bencode.encode({'msg_type': REJECT, 'piece': piece}))
+
+def parse_message(payload: bytes) -> tuple:
+    """
+    Returns the message dict and the piece data that follows it, raises ValueError if malformed
+    """
+    header, end = bdecode.decode_prefix(payload)
+    if not isinstance(header, dict) or not isinstance(header.get('msg_type'), int) or not isinstance(header.get('piece'), int):
+        raise ValueError('Invalid ut_metadata message')
+    return header, payload[end:]
+
+class Metadata:
+    """
+    Assembles the info dict from pieces fetched from several peers at once, each piece
+    is requested from one peer and handed to another one if it does not answer in time
+    """
+    size: int = None
+    data: bytes = None
+    request_timeout = 10
+
+    def __init__(self, info_hash: bytes) -> None:
+        self.info_hash = info_hash
+        self.pieces = []
+        self.requested = {}
+
+    def __repr__(self) -> str:
+        return f'Metadata(size={self.size}, pieces={self.received()}/{len(self.pieces)}, requested={len(self.requested)})'
+
+    def received(self) -> int:
+        return sum(piece is not None for piece in self.pieces)
+
+    def set_size(self, size) -> bool:
+        if self.size is None and isinstance(size, int) and 0 < size <= MAX_SIZE:
+            self.size = size
+            self.pieces = [None] * ((size + PIECE_SIZE - 1) // PIECE_SIZE)
+        return self.size is not None and self.size == size
+
+    def next_piece(self) -> int:
+        """
+        Returns a piece nobody is fetching and marks it requested, or None
+        """
+        now = time.monotonic()
+        for i, piece in enumerate(self.pieces):
+            if piece is None and self.requested.get(i, 0) <= now:
+                self.requested[i] = now + self.request_timeout
+                return i
+        return None
+
+    def cancel(self, piece: int) -> None:
+        self.requested.pop(piece, None)
+
+    def receive(self, piece: int, data: bytes) -> bool:
+        """
+        Stores a piece, returns True once every piece is in and the hash matches
+        """
+        if self.complete() or piece < 0 or piece >= len(self.pieces):
+            return False
+        expected = min(PIECE_SIZE, self.size - piece * PIECE_SIZE)
+        self.requested.pop(piece, None)
+        if len(data) != expected:
+            return False
+        self.pieces[piece] = bytes(data)
+        if any(piece is None for piece in self.pieces):
+            return False
+        data = b''.join(self.pieces)
+        if hashlib.sha1(data).digest() != self.info_hash:
+            # Some peer sent bad data or a wrong size, start over
+            logging.getLogger(__name__).info('Metadata did not match the info hash')
+            self.size = None
+            self.pieces = []
+            self.requested = {}
+            return False
+        self.data = data
+        return True
+
+    def complete(self) -> bool:
+        return self.data is not None
+
+class MetadataPeer:
+    def __init__(self, peer: Peer, s: socket.socket) -> None:
+        self.peer = peer
+        self.s = s
+        self.state = 'connect'
+        self.buffer = b''
+        self.ut_metadata = None
+        self.metadata_size = None
+        self.piece = None
+
+class MetadataSession:
+    """
+    Fetches the metadata for a magnet link over its own non-blocking connections,
+    before the torrent and the peer manager can be built
+    """
+    max_connections = 8
+
+    def __init__(self, info_hash: bytes, peer_id: bytes, port: int, ep: select.epoll) -> None:
+        self.metadata = Metadata(info_hash)
+        self.info_hash = info_hash
+        self.peer_id = peer_id
+        self.port = port
+        self.ep = ep
+        self.logger = logging.getLogger(__name__)
+        self.connections = {}
+        self.candidates = []
+        self.seen = set()
+
+    def add_peer(self, peer: Peer) -> None:
+        if (peer.peer_ip, peer.peer_port) not in self.seen:
+            self.seen.add((peer.peer_ip, peer.peer_port))
+            self.candidates.append(peer)
+        self._connect()
+
+    def owns(self, fileno: int) -> bool:
+        return fileno in self.connections
+
+    def handle(self, fileno: int, eventmask: int) -> None:
+        conn = self.connections[fileno]
+        try:
+            if conn.state == 'connect':
+                error = conn.s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if error != 0:
+                    raise OSError(error, 'connect failed')
+                conn.state = 'handshake'
+                conn.s.sendall(b'\x13BitTorrent protocol' + extension.RESERVED + self.info_hash + self.peer_id)
+                self.ep.modify(fileno, select.EPOLLIN)
+                return
+            data = conn.s.recv(65536)
+            if len(data) == 0:
+                raise OSError(errno.ECONNRESET, 'connection closed')
+            conn.buffer += data
+            self._process(conn)
+        except (OSError, ValueError) as e:
+            self.logger.info(f'Metadata peer {conn.peer.peer_ip}:{conn.peer.peer_port} dropped: {e}')
+            self._close(conn)
+
+    def expire(self) -> None:
+        # Requests that timed out or were freed by a dropped peer go to whichever peer is idle
+        for conn in list(self.connections.values()):
+            try:
+                if conn.piece is not None and self.metadata.requested.get(conn.piece, 0) <= time.monotonic():
+                    raise ValueError('metadata request timed out')
+                self._request(conn)
+            except (OSError, ValueError) as e:
+                self.logger.info(f'Metadata peer {conn.peer.peer_ip}:{conn.peer.peer_port} dropped: {e}')
+                self._close(conn)
+        self._connect()
+
+    def close(self) -> None:
+        for conn in list(self.connections.values()):
+            self._close(conn)
+
+    def _connect(self) -> None:
+        while len(self.connections) < self.max_connections and len(self.candidates) > 0:
+            peer = self.candidates.pop(0)
+            s = socket.socket(socket.AF_INET6 if ':' in peer.peer_ip else socket.AF_INET, socket.SOCK_STREAM)
+            s.setblocking(False)
+            result = s.connect_ex((peer.peer_ip, peer.peer_port))
+            if result not in (0, errno.EINPROGRESS):
+                s.close()
+                continue
+            self.connections[s.fileno()] = MetadataPeer(peer, s)
+            self.ep.register(s.fileno(), select.EPOLLOUT)
+
+    def _close(self, conn: MetadataPeer) -> None:
+        if conn.piece is not None:
+            self.metadata.cancel(conn.piece)
+        fileno = conn.s.fileno()
+        if fileno in self.connections:
+            del self.connections[fileno]
+            self.ep.unregister(fileno)
+        conn.s.close()
+        self._connect()
+
+    def _process(self, conn: MetadataPeer) -> None:
+        if conn.state == 'handshake':
+            if len(conn.buffer) < 68:
+                return
+            if conn.buffer[:20] != b'\x13BitTorrent protocol' or conn.buffer[28:48] != self.info_hash:
+                raise ValueError('bad handshake')
+            if not extension.supported(conn.buffer[20:28]):
+                raise ValueError('no extension protocol')
+            conn.buffer = conn.buffer[68:]
+            conn.state = 'messages'
+            conn.s.sendall(extension.handshake(self.port))
+        while len(conn.buffer) >= 4:
+            length = struct.unpack('!I', conn.buffer[:4])[0]
+            if len(conn.buffer) < 4 + length:
+                return
+            message = conn.buffer[4:4 + length]
+            conn.buffer = conn.buffer[4 + length:]
+            if length >= 2 and message[0] == extension.EXTENDED:
+                self._extended(conn, message[1], message[2:])
+
+    def _extended(self, conn: MetadataPeer, ext_id: int, payload: bytes) -> None:
+        if ext_id == extension.HANDSHAKE:
+            handshake = extension.parse_handshake(payload)
+            conn.ut_metadata = handshake['m'].get('ut_metadata')
+            conn.metadata_size = handshake.get('metadata_size')
+            if not conn.ut_metadata or not self.metadata.set_size(conn.metadata_size):
+                raise ValueError('peer cannot send metadata')
+            self._request(conn)
+        elif ext_id == extension.LOCAL_IDS['ut_metadata']:
+            header, data = parse_message(payload)
+            if header['msg_type'] == DATA and header['piece'] == conn.piece:
+                conn.piece = None
+                self.metadata.receive(header['piece'], data)
+                self._request(conn)
+            elif header['msg_type'] == REJECT and header['piece'] == conn.piece:
+                raise ValueError('metadata request rejected')
+            elif header['msg_type'] == REQUEST:
+                conn.s.sendall(reject_message(conn.ut_metadata, header['piece']))
+
+    def _request(self, conn: MetadataPeer) -> None:
+        if conn.ut_metadata is None or conn.piece is not None or self.metadata.complete():
+            return
+        if not self.metadata.set_size(conn.metadata_size):
+            # After a bad hash the size is taken again from the next peer that asks
+            raise ValueError('metadata size does not match')
+        conn.piece = self.metadata.next_piece()
+        if conn.piece is not None:
+            conn.s.sendall(request_message(conn.ut_metadata, conn.piece))
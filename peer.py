@@ -1,7 +1,31 @@
+import time
 import socket
 import datetime
+import ipaddress
 import numpy as np
 
+import ratelimit
+
+# Bounds of the request timeout, the first requests to a peer wait INITIAL_REQUEST_TIMEOUT
+INITIAL_REQUEST_TIMEOUT = 5
+MIN_REQUEST_TIMEOUT = 2
+MAX_REQUEST_TIMEOUT = 60
+
+def normalize_ip(ip: str) -> str:
+    """
+    One spelling per address so a peer is not connected twice, IPv4-mapped IPv6 addresses
+    (from a dual-stack socket) become IPv4 and IPv6 addresses are compressed
+    """
+    if not isinstance(ip, str) or ':' not in ip:
+        return ip
+    try:
+        address = ipaddress.IPv6Address(ip)
+    except ValueError:
+        return ip
+    if address.ipv4_mapped is not None:
+        return str(address.ipv4_mapped)
+    return str(address)
+
 class Peer(object):
     context = {} # class wide variable, set with Peer.context['key'] = value
 
@@ -23,18 +47,67 @@ class Peer(object):
 
     bf = ''
 
+    # Extension protocol (BEP 10), extensions maps names to the ids the peer wants
+    extended = False
+    extensions: dict = None
+    # Port the peer accepts connections on, and what we last told it with ut_pex
+    outgoing = False
+    listen_port: int = None
+    pex_sent: set = None
+    pextime: datetime.time = None
+
+    # Found through local service discovery, on the same network as us
+    local = False
+
+    # Fast extension (BEP 6), pieces either side may request while choked and pieces suggested to us
+    fast = False
+    allowed_fast: set
+    peer_allowed_fast: set
+    suggested: list
+
+    # Super seeding (BEP 16), the pieces we told the peer we have and the ones we wait to see spread
+    superseeded = False
+    revealed: set
+    spreading: set
+
     expiretime: datetime.time
 
     downloadrate = 0
     downloadrates = []
 
+    upload: ratelimit.TokenBucket = None
+    download: ratelimit.TokenBucket = None
+    upload_queue: list
+    request_queue: list
+    # Haves for pieces we verified since the last tick, sent in one write
+    pending_haves: list
+
+    # Block requests sent and not answered yet, mapped to when they were sent. They time out after the
+    # peer's smoothed request latency plus four times its variation, like a TCP retransmit timer
+    outstanding: dict
+    srtt: float = None
+    rttvar: float = 0
+    rto: float = INITIAL_REQUEST_TIMEOUT
+    # Set when a request times out and cleared by the next block, a snubbed peer gets one request at a time
+    snubbed = False
+    request_timeouts = 0
+
     def __init__(self, peer_id: str, peer_ip: str, peer_port: int) -> None:
         self.peer_id = peer_id
-        self.peer_ip = peer_ip
+        self.peer_ip = normalize_ip(peer_ip)
         self.peer_port = peer_port
+        self.upload_queue = []
+        self.request_queue = []
+        self.pending_haves = []
+        self.outstanding = {}
+        self.allowed_fast = set()
+        self.peer_allowed_fast = set()
+        self.suggested = []
+        self.revealed = set()
+        self.spreading = set()
     
     def __str__(self) -> str:
-        return ('Connected' if self.connected else '') + f'Peer{str(tuple(self))}' + f' {self.downloadrate} b/s'
+        return ('Connected' if self.connected else '') + f'Peer{str(tuple(self))}' + f' {self.downloadrate} b/s' + f' up {self.upload} down {self.download}' + f' request timeout {self.rto:.2f} s' + (' snubbed' if self.snubbed else '')
 
     def __repr__(self) -> str:
         ret = ''
@@ -52,8 +125,16 @@ class Peer(object):
 
 
     def connect(self) -> bool:
+        # uTP first when the client runs it, it backs off when the link gets congested. Local
+        # peers go straight to TCP, which is faster on a LAN where backing off does not matter
+        utp = Peer.context.get('utp')
+        if utp is not None and not self.local:
+            self.s = utp.connect(self.peer_ip, self.peer_port)
+            if self.s is not None:
+                self.connected = True
+                return self.connected
         try:
-            self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.s = socket.socket(socket.AF_INET6 if ':' in self.peer_ip else socket.AF_INET, socket.SOCK_STREAM)
             self.s.settimeout(1)
             self.s.connect((self.peer_ip, self.peer_port))
             self.connected = True
@@ -67,4 +148,54 @@ class Peer(object):
         self.downloadrates.append(downloadbytes/seconds)
         if len(self.downloadrates) > 100:
             self.downloadrates.pop(0)
-        self.downloadrate = np.average(self.downloadrates)
\ No newline at end of file
+        self.downloadrate = np.average(self.downloadrates)
+
+    def request_sent(self, block: tuple) -> None:
+        # Moved to the end if it was sent before, the dict stays in sending order
+        self.outstanding.pop(block, None)
+        self.outstanding[block] = time.monotonic()
+
+    def block_received(self, block: tuple) -> None:
+        sent = self.outstanding.pop(block, None)
+        if sent is None:
+            return
+        latency = time.monotonic() - sent
+        if self.srtt is None:
+            self.srtt = latency
+            self.rttvar = latency / 2
+        else:
+            self.rttvar += (abs(self.srtt - latency) - self.rttvar) / 4
+            self.srtt += (latency - self.srtt) / 8
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_REQUEST_TIMEOUT), MAX_REQUEST_TIMEOUT)
+        self.snubbed = False
+
+    def forget_requests(self, index: int) -> list:
+        """
+        Drops the outstanding and queued requests for a piece, returns the outstanding ones
+        """
+        blocks = [block for block in self.outstanding if block[0] == index]
+        for block in blocks:
+            del self.outstanding[block]
+        self.request_queue = [block for block in self.request_queue if block[0] != index]
+        return blocks
+
+    def expired_requests(self, now: float) -> list:
+        # Requests are kept in the order they were sent, so the first unexpired one ends the scan
+        expired = []
+        for block, sent in self.outstanding.items():
+            if now - sent < self.rto:
+                break
+            expired.append(block)
+        return expired
+
+    def request_deadline(self) -> float:
+        # Monotonic time the oldest outstanding request times out, None without one
+        for sent in self.outstanding.values():
+            return sent + self.rto
+        return None
+
+    def request_timed_out(self) -> None:
+        # Back off like a retransmit timer so a slow but working peer is not timed out again right away
+        self.rto = min(self.rto * 2, MAX_REQUEST_TIMEOUT)
+        self.snubbed = True
+        self.request_timeouts += 1
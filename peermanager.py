@@ -1,3 +1,5 @@
+import os
+import time
 import socket
 import select
 import struct
@@ -7,7 +9,13 @@ from datetime import datetime
 from datetime import timedelta
 from bitarray import bitarray
 
-from peer import Peer
+from peer import Peer, normalize_ip
+import extension
+import fast
+import metadata
+import pex
+import ratelimit
+import smartban
 import strategy
 import torrent
 
@@ -22,7 +30,21 @@ class PeerManager:
     requesttime : datetime.time
     requestdelta = timedelta(seconds=10)
 
+    synctime : datetime.time
+    syncdelta = timedelta(seconds=1)
+    # Position in the shared log of verified pieces
+    synced = 0
+
+    pexdelta = timedelta(seconds=60)
+    max_pex_connections = 50
+
+    # UDP port of our DHT node, None when the DHT is off
+    dht_port = None
+    # Addresses of peers found through local service discovery, they are unchoked first
+    local_ips: set
+
     bf = bitarray
+    wanted = bitarray
     fs: torrent.Torrent
 
     pieces = []
@@ -30,37 +52,81 @@ class PeerManager:
     max_requests = 50
     requests = 0
 
+    upload: ratelimit.TokenBucket
+    download: ratelimit.TokenBucket
+    peer_upload_rate = 0
+    peer_download_rate = 0
+    max_queued_requests = 250
+    max_suggested = 16
+    suggest_count = 4
+
+    use_sendfile = hasattr(os, 'sendfile')
+
+    # Have messages sent, the writes they took and the ones left out because the peer had the piece
+    haves_sent = 0
+    have_writes = 0
+    haves_suppressed = 0
+
+    # Super seeding (BEP 16), how often each piece was handed out and in total
+    super_seeding = False
+    superseed_counts: list
+    superseed_reveals = 0
+    # Pieces each peer may be waiting on to spread, one leaves the seed idle while it does
+    superseed_slots = 2
+
     downloaders = []
 
     peerslock = threading.Lock()
 
-    def __init__(self, info_hash, peer_id, fs) -> None:
+    def __init__(self, info_hash, peer_id, fs, shared=None, metadata=None, port=None) -> None:
         self.info_hash = info_hash
         self.peer_id = peer_id
         self.fs = fs
+        self.shared = shared
+        # Raw info dict, served to peers that fetch it with ut_metadata
+        self.metadata = metadata
+        self.port = port
+        # Peers learned from ut_pex, picked up by the connection path
+        self.discovered = []
+        # DHT nodes of peers that sent a port message
+        self.dht_nodes = []
+        self.local_ips = set()
+        # Sockets of banned peers, closed by the connection path
+        self.closing = []
+        self.smartban = smartban.SmartBan()
+        self.upload = ratelimit.TokenBucket()
+        self.download = ratelimit.TokenBucket()
 
         bits =  ""
         for i in range(0, fs.piece_count):
-            self.pieces.append(strategy.Piece(i))
+            self.pieces.append(strategy.Piece(i, shared))
             if fs.verify_piece(i):
                 bits += '1'
             else:
                 bits += '0'
         self.bf = bitarray(bits)
         self.bf.fill()
+        self.updateWanted()
+        self.superseed_counts = [0] * fs.piece_count
 
         self.keepalivetime = datetime.now() + self.keepalivedelta
         self.requesttime = datetime.now()
+        self.synctime = datetime.now()
 
     def connPeer(self, peerobj):
+        if self.smartban.is_banned(peerobj.peer_ip):
+            return None
         peerscopy = self.peers.copy()
         for k in peerscopy:
             if peerscopy[k].peer_ip == peerobj.peer_ip and peerscopy[k].peer_port == peerobj.peer_port:
                 return None
         connected = peerobj.connect()
         if connected:
+            peerobj.outgoing = True
+            peerobj.listen_port = peerobj.peer_port
             peerobj.bf = bitarray(self.fs.piece_count)
             peerobj.bf.fill()
+            self.initLimits(peerobj)
             peerobj.expiretime = datetime.now() + timedelta(minutes=2)
             self.peerslock.acquire()
             self.peers[peerobj.s.fileno()] = peerobj
@@ -70,18 +136,83 @@ class PeerManager:
         else:
             return None
 
+    def initLimits(self, peerobj):
+        # Buckets are only created for connected peers, tracker responses can hold thousands
+        if peerobj.upload is None:
+            peerobj.upload = ratelimit.TokenBucket()
+            peerobj.download = ratelimit.TokenBucket()
+        peerobj.upload.set_rate(self.peer_upload_rate)
+        peerobj.download.set_rate(self.peer_download_rate)
+
+    def setFilePriority(self, index, priority):
+        self.fs.set_file_priority(index, priority)
+        self.updateWanted()
+        self.peerslock.acquire()
+        peerscopy = self.peers.copy()
+        self.peerslock.release()
+        for k in peerscopy:
+            if peerscopy[k].state == 3:
+                self.updateInterest(peerscopy[k])
+        self.requestFromIdlePeers()
+
+    def updateWanted(self):
+        # Pieces of skipped files are never picked and do not make us interested
+        for i, piece in enumerate(self.pieces):
+            piece.priority = self.fs.priorities[i]
+        self.wanted = bitarray([priority > torrent.PRIORITY_SKIP for priority in self.fs.priorities])
+        self.wanted.fill()
+
+    def updateInterest(self, peer):
+        pieces = ~self.bf & peer.bf & self.wanted
+        if 1 in pieces and peer.am_interested == 0:
+            self.sendInterested(peer)
+        elif not 1 in pieces and peer.am_interested == 1:
+            self.sendNotInterested(peer)
+
+    def setLimit(self, direction, scope, rate):
+        # direction is 'up' or 'down', scope is 'global', 'torrent' or 'peer'
+        if scope == 'global':
+            bucket = ratelimit.global_upload if direction == 'up' else ratelimit.global_download
+            bucket.set_rate(rate)
+        elif scope == 'torrent':
+            bucket = self.upload if direction == 'up' else self.download
+            bucket.set_rate(rate)
+        elif scope == 'peer':
+            if direction == 'up':
+                self.peer_upload_rate = rate
+            else:
+                self.peer_download_rate = rate
+            self.peerslock.acquire()
+            peerscopy = self.peers.copy()
+            self.peerslock.release()
+            for k in peerscopy:
+                self.initLimits(peerscopy[k])
+        else:
+            raise ValueError(f'Invalid limit scope: {scope}')
+
+    def uploadBuckets(self, peerobj):
+        return [ratelimit.global_upload, self.upload, peerobj.upload]
+
+    def downloadBuckets(self, peerobj):
+        return [ratelimit.global_download, self.download, peerobj.download]
+
     def dropPeer(self, ps):
         self.peerslock.acquire()
         if ps.fileno() in self.peers:
             #print('Dropping', self.peers[ps.fileno()].peer_ip)
             if self.peers[ps.fileno()] in self.downloaders:
                 self.downloaders.remove(self.peers[ps.fileno()])
-            del self.peers[ps.fileno()]
+            peerobj = self.peers.pop(ps.fileno())
+            self.releasePieces(peerobj)
         self.peerslock.release()
 
     def sendHandshake(self, peerobj):
         peerobj.state = 1
-        data = (b'\x13', bytes("BitTorrent protocol", 'utf-8'), bytes("\0\0\0\0\0\0\0\0", 'utf-8'), self.info_hash, self.peer_id)
+        reserved = bytearray(extension.RESERVED)
+        reserved[7] |= 0x04
+        if self.dht_port is not None:
+            reserved[7] |= 0x01
+        data = (b'\x13', bytes("BitTorrent protocol", 'utf-8'), bytes(reserved), self.info_hash, self.peer_id)
         self.sendMessage(peerobj, data)
 
     def sendKeepalive(self, peerobj):
@@ -90,6 +221,11 @@ class PeerManager:
 
     def sendChoke(self, peerobj):
         peerobj.am_choking = 1
+        # Fast peers keep their allowed fast requests and get a reject for the rest
+        for index, begin, length in peerobj.upload_queue:
+            if index not in peerobj.allowed_fast:
+                self.sendReject(peerobj, index, begin, length)
+        peerobj.upload_queue = [request for request in peerobj.upload_queue if peerobj.fast and request[0] in peerobj.allowed_fast]
         data = (struct.pack('!I', 1), b'\x00')
         self.sendMessage(peerobj, data)
 
@@ -97,6 +233,11 @@ class PeerManager:
         peerobj.am_choking = 0
         data = (struct.pack('!I', 1), b'\x01')
         self.sendMessage(peerobj, data)
+        if peerobj.fast and peerobj.state == 3 and not peerobj.superseeded:
+            # Point the peer at pieces we can serve from memory
+            for index in list(self.fs.cache.pieces)[-self.suggest_count:]:
+                if peerobj.bf[index] == 0:
+                    self.sendSuggest(peerobj, index)
 
     def sendInterested(self, peerobj):
         peerobj.am_interested = 1
@@ -112,24 +253,134 @@ class PeerManager:
         data = (struct.pack('!I', 5), b'\x04', struct.pack('!I', index))
         self.sendMessage(peerobj, data)
 
+    def sendHaves(self, peerobj):
+        # Pieces the peer got since they were queued are left out
+        indexes = [index for index in peerobj.pending_haves if peerobj.bf[index] == 0]
+        self.haves_suppressed += len(peerobj.pending_haves) - len(indexes)
+        peerobj.pending_haves = []
+        if len(indexes) > 0:
+            data = (b''.join(struct.pack('!IBI', 5, 4, index) for index in indexes),)
+            self.sendMessage(peerobj, data)
+            self.haves_sent += len(indexes)
+            self.have_writes += 1
+
     def sendBitfield(self, peerobj):
         peerobj.state = 2
-        bf = bytes(self.bf)
-        data = (struct.pack('!I', (1 + len(bf))), b'\x05', bf)
+        # A super seed looks like a peer with nothing and tells each peer about one piece at a time
+        peerobj.superseeded = self.super_seeding
+        have = self.bf.count(1) if not peerobj.superseeded else 0
+        if peerobj.fast and have == self.fs.piece_count:
+            data = (struct.pack('!I', 1), bytes([fast.HAVE_ALL]))
+        elif peerobj.fast and have == 0:
+            data = (struct.pack('!I', 1), bytes([fast.HAVE_NONE]))
+        else:
+            bf = bytes(self.bf) if not peerobj.superseeded else bytes(len(bytes(self.bf)))
+            data = (struct.pack('!I', (1 + len(bf))), b'\x05', bf)
         self.sendMessage(peerobj, data)
 
+    def sendSuggest(self, peerobj, index):
+        data = (struct.pack('!IBI', 5, fast.SUGGEST, index),)
+        self.sendMessage(peerobj, data)
+
+    def sendReject(self, peerobj, index, begin, length):
+        # Without the fast extension a dropped request is left for the peer to time out
+        if peerobj.fast:
+            data = (struct.pack('!IBIII', 13, fast.REJECT, index, begin, length),)
+            self.sendMessage(peerobj, data)
+
+    def sendAllowedFast(self, peerobj):
+        # Only pieces we have are worth allowing, and a super seed does not show them
+        if peerobj.superseeded:
+            return
+        for index in fast.allowed_fast_set(peerobj.peer_ip, self.info_hash, self.fs.piece_count):
+            if self.bf[index] == 1:
+                peerobj.allowed_fast.add(index)
+                data = (struct.pack('!IBI', 5, fast.ALLOWED_FAST, index),)
+                self.sendMessage(peerobj, data)
+
     def sendRequest(self, peerobj, index, begin, length):
         data = (struct.pack('!I', 13), b'\x06', struct.pack('!I', index), struct.pack('!I', begin), struct.pack('!I', length))
         self.sendMessage(peerobj, data)
 
+    def sendCancel(self, peerobj, index, begin, length):
+        data = (struct.pack('!I', 13), b'\x08', struct.pack('!I', index), struct.pack('!I', begin), struct.pack('!I', length))
+        self.sendMessage(peerobj, data)
+
     def sendPiece(self, peerobj, index, begin, block):
         #print('Sending piece to', peerobj)
-        data = (struct.pack('!I', (9 + len(block))), b'\x07', struct.pack('!I', index), struct.pack('!I', begin), block)
+        data = (struct.pack('!IBII', 9 + len(block), 7, index, begin), block)
+        self.sendMessage(peerobj, data)
+        ratelimit.record(self.uploadBuckets(peerobj), len(block))
+
+    def sendExtendedHandshake(self, peerobj):
+        metadata_size = len(self.metadata) if self.metadata is not None else None
+        data = [extension.handshake(self.port, metadata_size)]
+        self.sendMessage(peerobj, data)
+
+    def sendMetadata(self, peerobj, piece):
+        ext_id = peerobj.extensions.get('ut_metadata')
+        if not ext_id:
+            return
+        if self.metadata is not None and 0 <= piece * metadata.PIECE_SIZE < len(self.metadata):
+            data = [metadata.data_message(ext_id, piece, self.metadata)]
+        else:
+            data = [metadata.reject_message(ext_id, piece)]
+        self.sendMessage(peerobj, data)
+
+    def sendPex(self, peerobj):
+        # The first message lists every connected peer, later ones only the changes
+        peerobj.pextime = datetime.now() + self.pexdelta
+        current = {}
+        self.peerslock.acquire()
+        peerscopy = self.peers.copy()
+        self.peerslock.release()
+        for k in peerscopy:
+            other = peerscopy[k]
+            if other is not peerobj and other.state == 3 and other.listen_port:
+                current[(other.peer_ip, other.listen_port)] = pex.REACHABLE if other.outgoing else 0
+        sent = peerobj.pex_sent if peerobj.pex_sent is not None else set()
+        added = [address for address in current if address not in sent][:pex.MAX_PEERS]
+        dropped = [address for address in sent if address not in current][:pex.MAX_PEERS]
+        if peerobj.pex_sent is not None and len(added) == 0 and len(dropped) == 0:
+            return
+        peerobj.pex_sent = (sent | set(added)) - set(dropped)
+        data = [pex.message(peerobj.extensions['ut_pex'], added, [current[address] for address in added], dropped)]
         self.sendMessage(peerobj, data)
 
+    def sendPort(self, peerobj):
+        data = (struct.pack('!I', 3), b'\x09', struct.pack('!H', self.dht_port))
+        self.sendMessage(peerobj, data)
+
+    def takeDiscovered(self):
+        discovered = self.discovered
+        self.discovered = []
+        return discovered
+
+    def takeClosed(self):
+        closing = self.closing
+        self.closing = []
+        return closing
+
+    def takeDhtNodes(self):
+        dht_nodes = self.dht_nodes
+        self.dht_nodes = []
+        return dht_nodes
+
+    def sendPieceFile(self, peerobj, index, begin, length, f, offset):
+        # Only the 13 byte header goes through Python, the payload is sent with sendfile
+        header = struct.pack('!IBII', 9 + length, 7, index, begin)
+        try:
+            peerobj.s.sendall(header)
+            peerobj.s.sendfile(f, offset, length)
+        except OSError:
+            self.dropPeer(peerobj.s)
+            return
+        ratelimit.record(self.uploadBuckets(peerobj), length)
+
     def processHandshake(self, message, peerobj):
         pstrlen = message[0]
         pstr = message[1:pstrlen+1]
+        reserved = message[pstrlen+1:pstrlen+9]
         info_hash = message[pstrlen+9:pstrlen+29]
         peer_id = message[pstrlen+29:pstrlen+49]
 
@@ -145,19 +396,39 @@ class PeerManager:
             #self.dropPeer(peerobj.s)
             #return
 
+        peerobj.peer_id = peer_id
         if peerobj.state == 0:
             self.sendHandshake(peerobj)
-        
+
+        peerobj.fast = fast.supported(reserved)
         self.sendBitfield(peerobj)
+        if peerobj.fast:
+            self.sendAllowedFast(peerobj)
+
+        peerobj.extended = extension.supported(reserved)
+        if peerobj.extended:
+            self.sendExtendedHandshake(peerobj)
+        if reserved[7] & 0x01 and self.dht_port is not None:
+            self.sendPort(peerobj)
 
     def processChoke(self, message, peerobj):
         peerobj.peer_choking = 1
+        # Without the fast extension a choke drops every request we sent, other peers can have the pieces now
+        if not peerobj.fast:
+            self.releasePieces(peerobj)
 
     def processUnchoke(self, message, peerobj):
         peerobj.peer_choking = 0
+        # Request right away instead of on the next request round
+        self.requestFromIdlePeers()
 
     def processInterested(self, message, peerobj):
         peerobj.peer_interested = 1
+        # A free upload slot is given out now, the choke round only rebalances. A peer connected
+        # more than once gets it on one connection only
+        if len(self.downloaders) < 4 and all(downloader.peer_id != peerobj.peer_id for downloader in self.downloaders):
+            self.downloaders.append(peerobj)
+            self.sendUnchoke(peerobj)
 
     def processNotInterested(self, message, peerobj):
         peerobj.peer_interested = 0
@@ -171,6 +442,11 @@ class PeerManager:
         except IndexError:
             pass
             #print('Received invalid index from', peerobj.peer_ip)
+            return
+        if peerobj.state == 3 and peerobj.am_interested == 0 and self.bf[index] == 0 and self.wanted[index] == 1:
+            self.sendInterested(peerobj)
+        if self.super_seeding:
+            self.superseedSpread(index, peerobj)
 
     def processBitfield(self, message, peerobj):
         mid = message[0]
@@ -187,6 +463,55 @@ class PeerManager:
 
         peerobj.bf = bf
         peerobj.state = 3
+        self.updateInterest(peerobj)
+        if peerobj.superseeded:
+            self.superseedReveal(peerobj)
+
+    def processHaveAll(self, message, peerobj):
+        peerobj.bf = bitarray(len(self.bf))
+        peerobj.bf.setall(0)
+        peerobj.bf[:self.fs.piece_count] = 1
+        peerobj.state = 3
+        self.updateInterest(peerobj)
+        if peerobj.superseeded:
+            self.superseedReveal(peerobj)
+
+    def processHaveNone(self, message, peerobj):
+        peerobj.bf = bitarray(len(self.bf))
+        peerobj.bf.setall(0)
+        peerobj.state = 3
+        if peerobj.superseeded:
+            self.superseedReveal(peerobj)
+
+    def processSuggest(self, message, peerobj):
+        mid = message[0]
+        index = int.from_bytes(message[1:5], "big")
+
+        if index < self.fs.piece_count and self.bf[index] == 0 and index not in peerobj.suggested:
+            peerobj.suggested.append(index)
+            del peerobj.suggested[:-self.max_suggested]
+
+    def processAllowedFast(self, message, peerobj):
+        mid = message[0]
+        index = int.from_bytes(message[1:5], "big")
+
+        if index < self.fs.piece_count:
+            peerobj.peer_allowed_fast.add(index)
+            # We may be choked, but this piece can be requested right away
+            if peerobj.peer_choking == 1:
+                self.requestFromIdlePeers()
+
+    def processReject(self, message, peerobj):
+        mid = message[0]
+        index = int.from_bytes(message[1:5], "big")
+
+        if index >= self.fs.piece_count:
+            return
+        # Give the piece back so another peer can be asked for it now
+        piece = self.pieces[index]
+        if piece.status == 1 and piece.peer is peerobj:
+            self.releasePiece(peerobj, index)
+            self.requestFromIdlePeers()
 
     def processRequest(self, message, peerobj):
         mid = message[0]
@@ -194,9 +519,108 @@ class PeerManager:
         begin = int.from_bytes(message[5:9], "big")
         length = int.from_bytes(message[9:], "big")
 
-        block = self.fs.retrieve(index, begin, length)
-        if block != None:
-            self.sendPiece(peerobj, index, begin, block)
+        choked = peerobj.am_choking == 1 and index not in peerobj.allowed_fast
+        hidden = peerobj.superseeded and index not in peerobj.revealed
+        # Longer blocks than 16 KiB are refused like other clients do, and blocks must lie inside the piece
+        invalid = index >= self.fs.piece_count or length == 0 or length > torrent.BLOCK_SIZE or begin + length > self.fs.piece_list[index].length
+        if choked or hidden or invalid or self.bf[index] == 0 or len(peerobj.upload_queue) >= self.max_queued_requests:
+            self.sendReject(peerobj, index, begin, length)
+            return
+        # Requests are queued and served as the upload buckets allow
+        peerobj.upload_queue.append((index, begin, length))
+        self.drainUploads(peerobj)
+
+    def processExtended(self, message, peerobj):
+        mid = message[0]
+        ext_id = message[1]
+        payload = message[2:]
+
+        if ext_id == extension.HANDSHAKE:
+            handshake = extension.parse_handshake(payload)
+            peerobj.extensions = handshake['m']
+            if isinstance(handshake.get('p'), int) and 0 < handshake['p'] < 65536:
+                peerobj.listen_port = handshake['p']
+            if peerobj.extensions.get('ut_pex'):
+                # Tell a new peer about the swarm right away, then once a minute
+                peerobj.pextime = datetime.now()
+        elif ext_id == extension.LOCAL_IDS['ut_pex'] and peerobj.extensions is not None:
+            if len(self.peers) + len(self.discovered) < self.max_pex_connections:
+                self.discovered += pex.parse(payload)
+        elif ext_id == extension.LOCAL_IDS['ut_metadata'] and peerobj.extensions is not None:
+            try:
+                header, _ = metadata.parse_message(payload)
+            except ValueError:
+                return
+            if header['msg_type'] == metadata.REQUEST:
+                self.sendMetadata(peerobj, header['piece'])
+
+    def processPort(self, message, peerobj):
+        mid = message[0]
+        port = int.from_bytes(message[1:3], "big")
+
+        # The DHT node only speaks IPv4
+        if self.dht_port is not None and port != 0 and ':' not in peerobj.peer_ip:
+            self.dht_nodes.append((peerobj.peer_ip, port))
+
+    def processCancel(self, message, peerobj):
+        mid = message[0]
+        index = int.from_bytes(message[1:5], "big")
+        begin = int.from_bytes(message[5:9], "big")
+        length = int.from_bytes(message[9:], "big")
+
+        if (index, begin, length) in peerobj.upload_queue:
+            peerobj.upload_queue.remove((index, begin, length))
+            self.sendReject(peerobj, index, begin, length)
+
+    def drainUploads(self, peerobj):
+        buckets = self.uploadBuckets(peerobj)
+        while len(peerobj.upload_queue) > 0:
+            index, begin, length = peerobj.upload_queue[0]
+            if not ratelimit.allow(buckets, length):
+                break
+            # Blocks inside a single file on disk skip the read cache, others fall back to it
+            extent = self.fs.block_extent(index, begin, length) if self.use_sendfile else None
+            if extent == None and not self.fs.readable(index):
+                # Read the piece on the disk pool instead of blocking the loop, the request stays queued
+                self.fs.prefetch(index, lambda ok: self.resumeUploads(peerobj, index, ok))
+                break
+            peerobj.upload_queue.pop(0)
+            if extent != None:
+                ratelimit.consume(buckets, length)
+                self.sendPieceFile(peerobj, index, begin, length, *extent)
+                continue
+            block = self.fs.retrieve(index, begin, length)
+            if block != None:
+                ratelimit.consume(buckets, length)
+                self.sendPiece(peerobj, index, begin, block)
+            else:
+                self.sendReject(peerobj, index, begin, length)
+
+    def resumeUploads(self, peerobj, index, ok):
+        if not ok:
+            for request in peerobj.upload_queue:
+                if request[0] == index:
+                    self.sendReject(peerobj, *request)
+            peerobj.upload_queue = [request for request in peerobj.upload_queue if request[0] != index]
+        if peerobj in self.peers.values():
+            self.drainUploads(peerobj)
+
+    def drainRequests(self, peerobj):
+        buckets = self.downloadBuckets(peerobj)
+        while len(peerobj.request_queue) > 0:
+            index, begin, length = peerobj.request_queue[0]
+            piece = self.pieces[index]
+            if piece.status != 1 or piece.peer is not peerobj:
+                # Piece expired or failed while the request was waiting
+                peerobj.request_queue.pop(0)
+                continue
+            # A snubbed peer has to answer its one request before it gets another
+            if not ratelimit.allow(buckets, length) or (peerobj.snubbed and len(peerobj.outstanding) > 0):
+                break
+            peerobj.request_queue.pop(0)
+            ratelimit.consume(buckets, length)
+            self.sendRequest(peerobj, index, begin, length)
+            peerobj.request_sent((index, begin, length))
 
     def processPiece(self, message, peerobj):
         mid = message[0]
@@ -206,19 +630,32 @@ class PeerManager:
 
         block = (index, begin, len(data))
         #print('Received block', block)
+        ratelimit.record(self.downloadBuckets(peerobj), len(data))
+        peerobj.block_received(block)
         if block in self.pieces[index].blocks:
             self.fs.store(index, begin, data)
+            self.smartban.received(index, begin, len(data), peerobj.peer_ip)
             self.pieces[index].recvBlock((index, begin, len(data)))
 
             if self.pieces[index].downloaded() == 1:
+                piece = self.pieces[index]
+                if piece.status == 1:
+                    self.requests -= 1
+                    # Late blocks from a peer the piece was taken from finished it, the peer it went to can stop
+                    if piece.peer is not peerobj:
+                        for request in piece.peer.forget_requests(index):
+                            self.sendCancel(piece.peer, *request)
                 if self.fs.verify_piece(index):
                     #print(index, 'verified')
                     self.pieces[index].verified()
                     self.bf[index] = 1
                     peerobj.record_download(self.fs.piece_length,  (datetime.now() - self.pieces[index].starttime))
                     self.makeHave(index)
-                    self.requests -= 1
+                    for ip in self.smartban.passed(index, self.fs.read_verified):
+                        self.banPeer(ip)
                 else:
+                    # The failed data is still in memory until the piece is downloaded again
+                    self.smartban.failed(index, self.fs.piece_list[index].blocks)
                     self.pieces[index].downloadFailed()
                     #print(index, 'did not match checksum')
 
@@ -227,36 +664,126 @@ class PeerManager:
             pass
             #print('Unexpected block received')
 
+    def banPeer(self, ip):
+        for peerobj in list(self.peers.values()):
+            if peerobj.peer_ip == ip:
+                self.dropPeer(peerobj.s)
+                self.closing.append(peerobj.s)
+
+    def setSuperSeeding(self, enabled):
+        # Only a seed can super seed. Peers connected before keep the full bitfield they were sent, and
+        # turning it off tells super seeded peers about every piece
+        if enabled and self.bf.count(1) < self.fs.piece_count:
+            return False
+        self.super_seeding = enabled
+        if not enabled:
+            for peerobj in self.peers.copy().values():
+                if peerobj.superseeded:
+                    peerobj.superseeded = False
+                    for index in range(self.fs.piece_count):
+                        if index not in peerobj.revealed and peerobj.bf[index] == 0:
+                            peerobj.pending_haves.append(index)
+        return True
+
+    def superseedReveal(self, peerobj):
+        peerscopy = self.peers.copy()
+        bitfields = [other.bf for other in peerscopy.values() if other.state == 3 and other.peer_id != self.peer_id]
+        # A peer connected more than once shares its pieces and slots between the connections
+        siblings = [other for other in peerscopy.values() if other.superseeded and other.peer_id == peerobj.peer_id]
+        while sum(len(other.spreading) for other in siblings) < self.superseed_slots:
+            known = peerobj.bf.copy()
+            for other in siblings:
+                for index in other.revealed:
+                    known[index] = 1
+            index = strategy.superseedPiece(known, bitfields, self.superseed_counts)
+            if index is None:
+                return
+            peerobj.revealed.add(index)
+            peerobj.spreading.add(index)
+            self.superseed_counts[index] += 1
+            self.superseed_reveals += 1
+            self.sendHave(peerobj, index)
+
+    def superseedSpread(self, index, announcer):
+        # A peer gets a new piece once another peer has one it was given, or when no one else needs it
+        peerscopy = self.peers.copy()
+        for peerobj in peerscopy.values():
+            if not peerobj.superseeded or index not in peerobj.spreading:
+                continue
+            others = [other for other in peerscopy.values() if other.state == 3 and other.peer_id not in (peerobj.peer_id, self.peer_id)]
+            if announcer.peer_id != peerobj.peer_id or all(other.bf[index] == 1 for other in others):
+                peerobj.spreading.discard(index)
+                self.superseedReveal(peerobj)
+
     def makeHave(self, index):
         self.peerslock.acquire()
         peerscopy = self.peers.copy()
         self.peerslock.release()
         for k in peerscopy:
-            if peerscopy[k].state == 3:
-                self.sendHave(peerscopy[k], index)
+            peerobj = peerscopy[k]
+            # Peers that were sent our bitfield hear about it on the next tick, unless they have it already
+            if peerobj.state < 2:
+                continue
+            if peerobj.bf[index] == 1:
+                self.haves_suppressed += 1
+            else:
+                peerobj.pending_haves.append(index)
 
     def makeRequest(self, peerobj):
-        self.requests += 1
-        piece = strategy.randomPiece(peerobj.bf, self.pieces)
-        if piece != None:
+        # Pieces a streaming reader is waiting on are not given to a peer that lets requests time out
+        deadline = self.fs.deadline_pieces() if not peerobj.snubbed else ()
+        piece = strategy.pickPiece(peerobj, self.pieces, deadline)
+        if piece != None and piece.claim():
+            self.requests += 1
             blocks = self.fs.get_free_blocks_in_piece(piece.index)
             piece.downloading(peerobj, blocks)
             #print('Requesting', piece.index, 'from', peerobj.peer_ip)
-            for block in blocks:
-                index, begin, length = block
-                self.sendRequest(peerobj, index, begin, length)
+            peerobj.request_queue.extend(blocks)
+            self.drainRequests(peerobj)
+
+    def releasePiece(self, peerobj, index, cancel=False):
+        # Hands a piece the peer was downloading back to the picker, cancel tells the peer to drop what we asked for
+        for block in peerobj.forget_requests(index):
+            if cancel:
+                self.sendCancel(peerobj, *block)
+        piece = self.pieces[index]
+        if piece.status == 1 and piece.peer is peerobj:
+            piece.downloadFailed()
+            self.requests -= 1
+
+    def releasePieces(self, peerobj):
+        for piece in self.pieces:
+            if piece.status == 1 and piece.peer is peerobj:
+                self.releasePiece(peerobj, piece.index)
 
     def makeRequests(self):
         self.requesttime = datetime.now() + self.requestdelta
-        self.requests -= strategy.cancelExpiredRequests(self.pieces)
+        self.requestFromIdlePeers()
+
+    def requestFromIdlePeers(self):
+        if self.fs.disk.full():
+            # Too much data waiting to be written, let the disk catch up first
+            return
         self.peerslock.acquire()
         peerscopy = self.peers.copy()
         self.peerslock.release()
-        for k in peerscopy:
-            peerobj = peerscopy[k]
-            if self.requests <= self.max_requests and peerobj.state == 3 and peerobj.am_interested == 1 and peerobj.peer_choking == 0 and not strategy.pieces_contains(self.pieces, peerobj):
+        # Snubbed peers are asked last
+        for peerobj in sorted(peerscopy.values(), key=lambda peerobj: peerobj.snubbed):
+            unchoked = peerobj.peer_choking == 0 or len(peerobj.peer_allowed_fast) > 0
+            if self.requests <= self.max_requests and peerobj.state == 3 and peerobj.am_interested == 1 and unchoked and not strategy.pieces_contains(self.pieces, peerobj):
                 self.makeRequest(peerobj)
 
+    def syncShared(self):
+        # Pick up pieces verified by other worker processes since the last sync
+        self.synctime = datetime.now() + self.syncdelta
+        indexes, self.synced = self.shared.verified_since(self.synced)
+        for i in indexes:
+            if self.bf[i] == 0:
+                self.fs.mark_verified(i)
+                self.pieces[i].verified()
+                self.bf[i] = 1
+                self.makeHave(i)
+
     def sendMessage(self, peerobj, data):
         message = b''
         for field in data:
@@ -264,19 +791,25 @@ class PeerManager:
 
         try:
             peerobj.s.send(message)
-        except socket.timeout:
+        except OSError:
             self.dropPeer(peerobj.s)
 
     def recvMessage(self, message, ps):
         #print('Recv from', ps.fileno(), message)
         self.peerslock.acquire()
         if ps.fileno() not in self.peers:
-            ip, port = ps.getpeername()
+            ip, port = ps.getpeername()[:2]
+            if self.smartban.is_banned(normalize_ip(ip)):
+                self.peerslock.release()
+                if ps not in self.closing:
+                    self.closing.append(ps)
+                return
             peerobj = Peer(None, ip, port)
             peerobj.s = ps
             peerobj.connected = True
             peerobj.bf = bitarray(self.fs.piece_count)
             peerobj.bf.fill()
+            self.initLimits(peerobj)
             self.peers[ps.fileno()] = peerobj
             #print('Peer connected to us:', peerobj)
         self.peerslock.release()
@@ -331,12 +864,31 @@ class PeerManager:
             elif mid == 5 and peerobj.state == 2:
                 #print("Bitfield from", peerobj.peer_ip)
                 self.processBitfield(message[4:], peerobj)
-            elif mid == 6 and peerobj.am_choking == 0:
+            elif mid == 6:
                 #print("Request from", peerobj.peer_ip)
                 self.processRequest(message[4:], peerobj)
             elif mid == 7:
                 #print("Piece from", peerobj.peer_ip)
                 self.processPiece(message[4:], peerobj)
+            elif mid == 8:
+                #print("Cancel from", peerobj.peer_ip)
+                self.processCancel(message[4:], peerobj)
+            elif mid == fast.SUGGEST and peerobj.fast:
+                self.processSuggest(message[4:], peerobj)
+            elif mid == fast.HAVE_ALL and peerobj.fast and peerobj.state == 2:
+                self.processHaveAll(message[4:], peerobj)
+            elif mid == fast.HAVE_NONE and peerobj.fast and peerobj.state == 2:
+                self.processHaveNone(message[4:], peerobj)
+            elif mid == fast.REJECT and peerobj.fast:
+                self.processReject(message[4:], peerobj)
+            elif mid == fast.ALLOWED_FAST and peerobj.fast:
+                self.processAllowedFast(message[4:], peerobj)
+            elif mid == 9 and len(message) == 7:
+                #print("Port from", peerobj.peer_ip)
+                self.processPort(message[4:], peerobj)
+            elif mid == extension.EXTENDED and len(message) > 5:
+                #print("Extended from", peerobj.peer_ip)
+                self.processExtended(message[4:], peerobj)
             else:
                 pass
                 #print('Unknown message from', peerobj.peer_ip)    
@@ -349,11 +901,7 @@ class PeerManager:
             peer = peerscopy[k]
             if peer.state == 3:
                 #Interested/Not interested
-                pieces = ~self.bf & peer.bf
-                if 1 in pieces and peer.am_interested == 0:
-                    self.sendInterested(peer)
-                elif not 1 in pieces and peer.am_interested == 1:
-                    self.sendNotInterested(peer)
+                self.updateInterest(peer)
 
                 #Choke/Unchoke
                 for downloader in self.downloaders:
@@ -361,11 +909,17 @@ class PeerManager:
                         #print('Choking', peer)
                         self.downloaders.remove(downloader)
                         self.sendChoke(downloader)
+                # Local peers take unchoke slots from remote ones
+                for peer1 in peerscopy.values():
+                    remote = [downloader for downloader in self.downloaders if downloader.peer_ip not in self.local_ips]
+                    if len(self.downloaders) >= 4 and len(remote) > 0 and peer1.peer_interested == 1 and peer1.peer_ip in self.local_ips and not peer1 in self.downloaders:
+                        self.downloaders.remove(remote[0])
+                        self.sendChoke(remote[0])
                 while len(self.downloaders) < 4:
                     downloader = None
                     for k1 in peerscopy:
                         peer1 = peerscopy[k1]
-                        if peer1.peer_interested == 1 and not peer1 in self.downloaders and (downloader == None or downloader.downloadrate > peer1.downloadrate):
+                        if peer1.peer_interested == 1 and not peer1 in self.downloaders and (downloader == None or (peer1.peer_ip not in self.local_ips, peer1.downloadrate) < (downloader.peer_ip not in self.local_ips, downloader.downloadrate)):
                             downloader = peer1
                     if downloader != None:
                         #print('Unchoking', downloader)
@@ -375,11 +929,43 @@ class PeerManager:
                         break
             
     def update(self):
+        if self.shared is not None and self.synctime <= datetime.now():
+            self.syncShared()
+
         # If it has been 10 seconds since our last request, send it again (or if we haven't sent a request yet). This is also the choke timer
         if self.requesttime <= datetime.now():
             self.choking()
             self.makeRequests()
 
+        # Send queued pieces and requests that were held back by the rate limits
+        self.peerslock.acquire()
+        peerscopy = self.peers.copy()
+        self.peerslock.release()
+        for k in peerscopy:
+            if len(peerscopy[k].pending_haves) > 0:
+                self.sendHaves(peerscopy[k])
+            self.drainUploads(peerscopy[k])
+            self.drainRequests(peerscopy[k])
+
+        # Requests that outlived the peer's request timeout are cancelled and their pieces asked from other peers
+        now = time.monotonic()
+        timedout = False
+        for peerobj in peerscopy.values():
+            expired = peerobj.expired_requests(now)
+            if len(expired) > 0:
+                peerobj.request_timed_out()
+                for index in set(block[0] for block in expired):
+                    self.releasePiece(peerobj, index, cancel=True)
+                timedout = True
+        if timedout:
+            self.requestFromIdlePeers()
+
+        # Exchange peers with everyone that supports ut_pex
+        for k in peerscopy:
+            peerobj = peerscopy[k]
+            if peerobj.pextime is not None and peerobj.pextime <= datetime.now():
+                self.sendPex(peerobj)
+
         # Send keepalives every 2 seconds
         if self.keepalivetime <= datetime.now():
             self.peerslock.acquire()
@@ -400,9 +986,29 @@ class PeerManager:
         for k in expired:
             del peerscopy[k]
 
+    def timeout(self):
+        # Wake up regularly while anything is waiting on a rate limit
+        for peerobj in self.peers.copy().values():
+            if len(peerobj.upload_queue) > 0 or len(peerobj.request_queue) > 0:
+                return 0.05
+        # Otherwise sleep until the next choke round, keepalive, shared sync or request timeout
+        deadlines = [self.requesttime, self.keepalivetime]
+        if self.shared is not None:
+            deadlines.append(self.synctime)
+        seconds = (min(deadlines) - datetime.now()).total_seconds()
+        for peerobj in self.peers.copy().values():
+            deadline = peerobj.request_deadline()
+            if deadline is not None:
+                seconds = min(seconds, deadline - time.monotonic())
+        return max(seconds, 0)
+
     def print(self):
         self.printBitfield()
         self.printPeers()
+        self.printRates()
+        self.smartban.print()
+        if self.super_seeding:
+            print('Super seeding: pieces revealed', self.superseed_reveals, 'uploaded', self.upload.total, 'b,', round(self.upload.total / self.fs.torrent_size, 2), 'copies')
 
     def printBitfield(self):
         print(self.bf)
@@ -417,3 +1023,8 @@ class PeerManager:
         print('Connected peers:', len(peerscopy), 'Download rate:', totaldownloadrate, 'b/s')
         for k in peerscopy:
             print(peerscopy[k])
+
+    def printRates(self):
+        print('Global upload:', ratelimit.global_upload, 'download:', ratelimit.global_download)
+        print('Torrent upload:', self.upload, 'download:', self.download)
+        print('Haves sent:', self.haves_sent, 'in', self.have_writes, 'writes, suppressed:', self.haves_suppressed)
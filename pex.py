@@ -0,0 +1,52 @@
+import socket
+import struct
+import bencode
+
+import bdecode
+import extension
+from peer import Peer
+
+# Peer exchange (ut_pex), at most this many added and dropped peers go in one message
+MAX_PEERS = 50
+# added.f flag for peers that accept incoming connections
+REACHABLE = 0x10
+
+def compact(addresses: list[tuple], family: int = socket.AF_INET) -> bytes:
+    return b''.join(socket.inet_pton(family, ip) + struct.pack('!H', port) for ip, port in addresses)
+
+def message(ext_id: int, added: list[tuple], flags: list[int], dropped: list[tuple]) -> bytes:
+    """
+    added and dropped are lists of (ip, port), flags has one byte per added peer. IPv6
+    peers go in added6 and dropped6
+    """
+    added4 = [(address, flag) for address, flag in zip(added, flags) if ':' not in address[0]]
+    added6 = [(address, flag) for address, flag in zip(added, flags) if ':' in address[0]]
+    payload = {'added': compact([address for address, _ in added4]), 'added.f': bytes(flag for _, flag in added4),
+               'dropped': compact([address for address in dropped if ':' not in address[0]])}
+    dropped6 = [address for address in dropped if ':' in address[0]]
+    if len(added6) > 0 or len(dropped6) > 0:
+        payload['added6'] = compact([address for address, _ in added6], socket.AF_INET6)
+        payload['added6.f'] = bytes(flag for _, flag in added6)
+        payload['dropped6'] = compact(dropped6, socket.AF_INET6)
+    return extension.message(ext_id, bencode.encode(payload))
+
+def parse(payload: bytes) -> list[Peer]:
+    """
+    Returns the added peers of a ut_pex message, or an empty list if it is malformed
+    """
+    try:
+        data = bdecode.decode(payload, raw_keys=('added', 'dropped', 'added6', 'dropped6'))
+    except bdecode.DecodeError:
+        return []
+    if not isinstance(data, dict):
+        return []
+    peers = []
+    if isinstance(data.get('added'), memoryview):
+        added = data['added']
+        added = added[:len(added) - len(added) % 6]
+        peers += [Peer(None, socket.inet_ntoa(ip), port) for ip, port in struct.iter_unpack('!4sH', added) if port != 0]
+    if isinstance(data.get('added6'), memoryview):
+        added = data['added6']
+        added = added[:len(added) - len(added) % 18]
+        peers += [Peer(None, socket.inet_ntop(socket.AF_INET6, ip), port) for ip, port in struct.iter_unpack('!16sH', added) if port != 0]
+    return peers
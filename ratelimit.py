@@ -0,0 +1,76 @@
+import time
+
+class TokenBucket:
+    """
+    Token bucket in bytes per second. A rate of 0 means unlimited.
+    """
+    rate: int
+    burst: int
+    tokens: float
+    total: int = 0
+    window = 5
+
+    def __init__(self, rate: int = 0, burst: int = None) -> None:
+        self.set_rate(rate, burst)
+        self.last = time.monotonic()
+        self.window_start = self.last
+        self.window_bytes = 0
+        self.measured = 0
+
+    def __str__(self) -> str:
+        limit = f'{self.rate} b/s' if self.rate > 0 else 'unlimited'
+        return f'{round(self.measured_rate())} b/s (limit {limit}, total {self.total} b)'
+
+    def set_rate(self, rate: int, burst: int = None) -> None:
+        self.rate = rate
+        # default burst is one second worth of tokens, at least one block
+        self.burst = burst if burst is not None else max(rate, 16384)
+        self.tokens = self.burst
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def available(self, n: int) -> bool:
+        if self.rate <= 0:
+            return True
+        self._refill()
+        # A full bucket lets anything through and goes into debt, so a request larger than the burst is not stuck
+        return self.tokens >= min(n, self.burst)
+
+    def consume(self, n: int) -> None:
+        if self.rate > 0:
+            self._refill()
+            self.tokens -= n
+
+    def record(self, n: int) -> None:
+        self.total += n
+        now = time.monotonic()
+        if now - self.window_start >= self.window:
+            self.measured = self.window_bytes / (now - self.window_start)
+            self.window_start = now
+            self.window_bytes = 0
+        self.window_bytes += n
+
+    def measured_rate(self) -> float:
+        self.record(0)
+        return self.measured
+
+# Limits shared by every torrent in the process
+global_upload = TokenBucket()
+global_download = TokenBucket()
+
+def allow(buckets: list[TokenBucket], n: int) -> bool:
+    for bucket in buckets:
+        if not bucket.available(n):
+            return False
+    return True
+
+def consume(buckets: list[TokenBucket], n: int) -> None:
+    for bucket in buckets:
+        bucket.consume(n)
+
+def record(buckets: list[TokenBucket], n: int) -> None:
+    for bucket in buckets:
+        bucket.record(n)
@@ -0,0 +1,57 @@
+from collections import OrderedDict
+from typing import Callable
+
+class ReadCache:
+    """
+    LRU cache of whole pieces read from disk. A miss reads the entire piece in
+    one pass, so the following block requests for that piece are hits.
+    """
+    size: int
+    used: int = 0
+
+    hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+
+    def __init__(self, read_piece: Callable[[int], bytes], size: int) -> None:
+        self.read_piece = read_piece
+        self.size = size
+        self.pieces = OrderedDict()
+
+    def __repr__(self) -> str:
+        return f"ReadCache(size={self.size}, used={self.used}, hits={self.hits}, misses={self.misses}, evictions={self.evictions}, hit_rate={self.hit_rate():.2f})"
+
+    def get(self, index: int, begin: int, length: int) -> bytes:
+        piece = self.pieces.get(index)
+        if piece is None:
+            self.misses += 1
+            piece = self.read_piece(index)
+            self.insert(index, piece)
+        else:
+            self.hits += 1
+            self.pieces.move_to_end(index)
+        return piece[begin:begin + length]
+
+    def contains(self, index: int) -> bool:
+        return index in self.pieces
+
+    def resize(self, size: int) -> None:
+        self.size = size
+        self._evict()
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0
+
+    def insert(self, index: int, piece: bytes) -> None:
+        if len(piece) > self.size or index in self.pieces:
+            return
+        self.pieces[index] = piece
+        self.used += len(piece)
+        self._evict()
+
+    def _evict(self) -> None:
+        while self.used > self.size:
+            _, piece = self.pieces.popitem(last=False)
+            self.used -= len(piece)
+            self.evictions += 1
@@ -0,0 +1,130 @@
+import os
+import signal
+import socket
+import zlib
+import multiprocessing
+
+from peer import Peer
+
+FREE = 0
+CLAIMED = 1
+VERIFIED = 2
+
+class SharedPieceState:
+    """
+    Piece state shared between forked worker processes: claims, owners and the verified
+    bitfield. Piece data is not shared, a piece is marked verified once it is on disk and
+    the other workers serve it from there.
+    """
+    workers: int
+    worker_id: int = 0
+    children: list
+
+    def __init__(self, piece_count: int, workers: int) -> None:
+        self.piece_count = piece_count
+        self.workers = workers
+        self.children = []
+        self.lock = multiprocessing.Lock()
+        self.status = multiprocessing.RawArray('B', piece_count)
+        self.owner = multiprocessing.RawArray('i', piece_count)
+        self.complete = multiprocessing.RawValue('B', 0)
+        # Pieces in the order they were verified, so workers pick up new ones without a scan
+        self.verified_log = multiprocessing.RawArray('i', max(piece_count, 1))
+        self.verified_count = multiprocessing.RawValue('i', 0)
+        # one pipe per worker, used to hand it peers learned by worker 0
+        self.pipes = [os.pipe() for i in range(workers)]
+
+    def claim(self, index: int) -> bool:
+        with self.lock:
+            if self.status[index] != FREE:
+                return False
+            self.status[index] = CLAIMED
+            self.owner[index] = self.worker_id
+            return True
+
+    def release(self, index: int) -> None:
+        with self.lock:
+            if self.status[index] == CLAIMED and self.owner[index] == self.worker_id:
+                self.status[index] = FREE
+
+    def mark_verified(self, index: int) -> None:
+        with self.lock:
+            if self.status[index] != VERIFIED:
+                self.status[index] = VERIFIED
+                self.verified_log[self.verified_count.value] = index
+                self.verified_count.value += 1
+
+    def verified_since(self, position: int) -> tuple[list[int], int]:
+        """
+        Returns the pieces verified after the first position ones and the new position
+        """
+        with self.lock:
+            count = self.verified_count.value
+            return self.verified_log[position:count], count
+
+    def is_free(self, index: int) -> bool:
+        return self.status[index] == FREE
+
+    def is_verified(self, index: int) -> bool:
+        return self.status[index] == VERIFIED
+
+    def claim_complete(self) -> bool:
+        # only one worker writes the finished torrent to disk
+        with self.lock:
+            if self.complete.value:
+                return False
+            self.complete.value = 1
+            return True
+
+    def owns(self, peer: Peer) -> bool:
+        return self.owner_of(peer) == self.worker_id
+
+    def owner_of(self, peer: Peer) -> int:
+        key = f'{peer.peer_ip}:{peer.peer_port}'.encode()
+        return zlib.crc32(key) % self.workers
+
+    def dispatch(self, peer: Peer) -> None:
+        line = f'{peer.peer_ip} {peer.peer_port}\n'.encode()
+        os.write(self.pipes[self.owner_of(peer)][1], line)
+
+    def peer_pipe(self) -> int:
+        return self.pipes[self.worker_id][0]
+
+    def read_peers(self) -> list[Peer]:
+        peers = []
+        data = os.read(self.peer_pipe(), 65536)
+        for line in data.decode().splitlines():
+            ip, port = line.split(' ')
+            peers.append(Peer(None, ip, int(port)))
+        return peers
+
+    def fork_workers(self) -> int:
+        """
+        Forks workers 1..N-1, returns the worker id of the calling process
+        """
+        for worker_id in range(1, self.workers):
+            pid = os.fork()
+            if pid == 0:
+                self.worker_id = worker_id
+                self.children = []
+                return worker_id
+            self.children.append(pid)
+        return 0
+
+    def stop(self) -> None:
+        for pid in self.children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+def listen_socket(ip: str, port: int, reuseport: bool) -> socket.socket:
+    # '::' is dual-stack and takes IPv4 connections too
+    s = socket.socket(socket.AF_INET6 if ':' in ip else socket.AF_INET, socket.SOCK_STREAM)
+    if ip == '::':
+        s.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+    if reuseport:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind((ip, port))
+    s.listen(50)
+    return s
@@ -0,0 +1,84 @@
+import os
+import hashlib
+import logging
+import bencode
+import bdecode
+
+class SmartBan:
+    """
+    Finds the peers that send corrupt data. The sender of every block is remembered until its piece
+    is checked. When the piece fails, each block's digest is kept with its sender, and once the piece
+    passes, the senders of blocks that differ from the good data are banned. Bans are saved to path
+    and loaded on the next start
+    """
+    hash_failures = 0
+
+    def __init__(self, path: str = 'bans.dat') -> None:
+        self.path = path
+        self.logger = logging.getLogger(__name__)
+        # Piece index -> {begin: (ip, length)} for pieces being downloaded
+        self.sources = {}
+        # Piece index -> {(begin, ip): (length, digest)} for blocks of pieces that failed
+        self.suspects = {}
+        self.banned = self._load()
+
+    def __repr__(self) -> str:
+        return f'SmartBan(banned={len(self.banned)}, hash_failures={self.hash_failures}, suspect_pieces={len(self.suspects)})'
+
+    def is_banned(self, ip: str) -> bool:
+        return ip in self.banned
+
+    def received(self, index: int, begin: int, length: int, ip: str) -> None:
+        self.sources.setdefault(index, {})[begin] = (ip, length)
+
+    def failed(self, index: int, data) -> None:
+        """
+        Keeps the digest of every block of a piece that failed its hash check, data is the piece as received
+        """
+        self.hash_failures += 1
+        suspects = self.suspects.setdefault(index, {})
+        for begin, (ip, length) in self.sources.pop(index, {}).items():
+            suspects[(begin, ip)] = (length, hashlib.sha1(data[begin:begin + length]).digest())
+
+    def passed(self, index: int, read) -> list:
+        """
+        Returns the addresses that sent a block of the piece that differs from its verified data,
+        read(index, begin, length) returns the verified data. They are banned
+        """
+        self.sources.pop(index, None)
+        suspects = self.suspects.pop(index, None)
+        if suspects is None:
+            return []
+        good = {}
+        corrupt = set()
+        for (begin, ip), (length, digest) in suspects.items():
+            if (begin, length) not in good:
+                good[(begin, length)] = hashlib.sha1(read(index, begin, length)).digest()
+            if digest != good[(begin, length)]:
+                corrupt.add(ip)
+        for ip in corrupt - self.banned:
+            self.logger.info(f'Banned {ip}, it sent corrupt data for piece {index}')
+            self.banned.add(ip)
+        if len(corrupt) > 0:
+            self.save()
+        return list(corrupt)
+
+    def save(self) -> None:
+        data = bencode.encode({'banned': sorted(self.banned)})
+        try:
+            with open(self.path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(self.path + '.tmp', self.path)
+        except OSError as e:
+            self.logger.info(f'Could not save the ban list: {e}')
+
+    def print(self) -> None:
+        print(self)
+
+    def _load(self) -> set:
+        try:
+            with open(self.path, 'rb') as f:
+                state = bdecode.decode(f.read(), text=False)
+            return set(ip.decode() for ip in state['banned'])
+        except (OSError, ValueError, KeyError, TypeError, AttributeError, UnicodeDecodeError):
+            return set()
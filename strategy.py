@@ -1,28 +1,33 @@
 import random
+import numpy as np
 from datetime import datetime
-from datetime import timedelta
 import bitfield
 
 class Piece:
     starttime: datetime.time
-    expiretime: datetime.time
-    expiredelta = timedelta(seconds=5)
-    def __init__(self, index):
+    # Priority of the files the piece overlaps, 0 when they are all skipped
+    priority = 1
+    def __init__(self, index, shared=None):
         self.index = index
         self.status = 0
         self.peer = None
         self.blocks = []
+        self.shared = shared
+
+    def available(self):
+        return self.status == 0 and self.priority > 0 and (self.shared is None or self.shared.is_free(self.index))
+
+    def claim(self):
+        return self.shared is None or self.shared.claim(self.index)
 
     def downloading(self, peer, blocks):
         self.status = 1
         self.peer = peer
         self.blocks = blocks
         self.starttime = datetime.now()
-        self.expiretime = datetime.now() + self.expiredelta
 
     def recvBlock(self, block):
         self.blocks.remove(block)
-        self.expiretime = datetime.now() + self.expiredelta
 
     def downloaded(self):
         return self.blocks == []
@@ -31,6 +36,8 @@ class Piece:
         if self.status == 1:
             self.status = 0
             self.peer = None
+            if self.shared is not None:
+                self.shared.release(self.index)
     
     def verified(self):
         self.status = 2
@@ -38,26 +45,53 @@ class Piece:
 
 def randomPiece(bf, pieces):
     eligible_pieces = []
-    if len(bf) != len(pieces):
+    # Bitfields are padded to a whole number of bytes
+    if len(bf) < len(pieces):
         return None
-    for i in range(len(bf)):
-        if bf[i] == 1 and pieces[i].status == 0:
+    for i in range(len(pieces)):
+        if bf[i] == 1 and pieces[i].available():
             eligible_pieces.append(pieces[i])
     if len(eligible_pieces) > 0:
-        return random.choice(eligible_pieces)
+        return highestPriority(eligible_pieces)
     else:
         return None
 
+def highestPriority(eligible_pieces):
+    # Random pick among the pieces of the most important files
+    top = max(piece.priority for piece in eligible_pieces)
+    return random.choice([piece for piece in eligible_pieces if piece.priority == top])
+
+def pickPiece(peer, pieces, deadline=()):
+    # Pieces a streaming reader needs soon come first, then the ones the peer suggested. While it chokes us
+    # only its allowed fast pieces can be requested
+    allowed = None if peer.peer_choking == 0 else peer.peer_allowed_fast
+    for index in deadline:
+        if peer.bf[index] == 1 and pieces[index].available() and (allowed is None or index in allowed):
+            return pieces[index]
+    for index in peer.suggested:
+        if index < len(pieces) and peer.bf[index] == 1 and pieces[index].available() and (allowed is None or index in allowed):
+            return pieces[index]
+    if allowed is None:
+        return randomPiece(peer.bf, pieces)
+    eligible_pieces = [pieces[i] for i in allowed if i < len(pieces) and peer.bf[i] == 1 and pieces[i].available()]
+    if len(eligible_pieces) > 0:
+        return highestPriority(eligible_pieces)
+    return None
+
 def pieces_contains(pieces, peer):
     for piece in pieces:
         if piece.peer == peer:
             return True
     return False
 
-def cancelExpiredRequests(pieces):
-    expired = 0
-    for piece in pieces:
-        if piece.status == 1 and piece.expiretime <= datetime.now():
-            piece.downloadFailed()
-            expired += 1
-    return expired
\ No newline at end of file
+def superseedPiece(bf, bitfields, revealed):
+    # A super seed hands out a piece the peer lacks and no other peer has, the one handed out least. The
+    # rest the peer can get from other peers
+    count = len(revealed)
+    candidates = np.frombuffer(bf[:count].unpack(), dtype=np.uint8) == 0
+    for other in bitfields:
+        candidates &= np.frombuffer(other[:count].unpack(), dtype=np.uint8) == 0
+    if not candidates.any():
+        return None
+    times = np.where(candidates, np.array(revealed, dtype=np.int64), np.iinfo(np.int64).max)
+    return int(random.choice(np.flatnonzero(times == times.min())))
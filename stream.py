@@ -0,0 +1,118 @@
+import io
+import time
+import logging
+
+from torrent import PRIORITY_SKIP
+
+DEFAULT_WINDOW = 8
+
+class TorrentReader(io.RawIOBase):
+    """
+    Read-only file object over one file of a torrent, usable while the torrent downloads.
+    A read blocks until the piece under the position is verified, and the pieces in the
+    window ahead of the position are picked before any other. Runs on its own thread,
+    the event loop verifies the pieces it waits for.
+    """
+    window: int
+    timeout: float
+    position: int = 0
+
+    # Seconds from open to the first byte, then reads that had to wait after it
+    first_byte: float = None
+    stalls: int = 0
+    stall_time: float = 0
+    longest_stall: float = 0
+
+    def __init__(self, fs, index: int, window: int = DEFAULT_WINDOW, timeout: float = None) -> None:
+        super().__init__()
+        if index >= len(fs.file_list) or index < 0:
+            raise ValueError(f'File index out of bounds: index={index}, file_count={len(fs.file_list)}')
+        if fs.file_list[index].priority == PRIORITY_SKIP:
+            raise ValueError(f'File {index} is skipped, its pieces would never be downloaded')
+        self.fs = fs
+        self.file = fs.file_list[index]
+        self.window = window
+        self.timeout = timeout
+        self.logger = logging.getLogger(__name__)
+        self.opened = time.monotonic()
+        fs.readers.append(self)
+
+    def __repr__(self) -> str:
+        first_byte = f'{self.first_byte * 1000:.0f} ms' if self.first_byte is not None else None
+        return f'TorrentReader(path={self.file.path}, position={self.position}/{self.file.length}, window={self.window}, first_byte={first_byte}, stalls={self.stalls}, stall_time={self.stall_time:.2f} s, longest_stall={self.longest_stall:.2f} s)'
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.file.length + offset
+        else:
+            raise ValueError(f'Invalid whence: {whence}')
+        if position < 0:
+            raise ValueError(f'Negative seek position: {position}')
+        self.position = position
+        return position
+
+    def pieces(self) -> range:
+        # Pieces from the one under the position to the end of the window
+        if self.closed or self.position >= self.file.length:
+            return range(0)
+        first = (self.file.offset + self.position) // self.fs.piece_length
+        last = (self.file.offset + self.file.length - 1) // self.fs.piece_length
+        return range(first, min(first + self.window, last + 1))
+
+    def readinto(self, b) -> int:
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if self.position >= self.file.length or len(b) == 0:
+            return 0
+        start = self.file.offset + self.position
+        index = start // self.fs.piece_length
+        begin = start - index * self.fs.piece_length
+        length = min(len(b), self.file.length - self.position, self.fs.piece_list[index].length - begin)
+        self._wait(index)
+        data = self.fs.read_verified(index, begin, length)
+        memoryview(b).cast('B')[:len(data)] = data
+        self.position += len(data)
+        if self.first_byte is None:
+            self.first_byte = time.monotonic() - self.opened
+            self.logger.info(f'First byte of {self.file.path} after {self.first_byte * 1000:.0f} ms')
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed:
+            if self in self.fs.readers:
+                self.fs.readers.remove(self)
+            self.logger.info(f'Closed {self}')
+        super().close()
+        # Wake a read blocked on another thread
+        with self.fs.verified_cond:
+            self.fs.verified_cond.notify_all()
+
+    def _wait(self, index: int) -> None:
+        piece = self.fs.piece_list[index]
+        if piece.verified:
+            return
+        started = time.monotonic()
+        with self.fs.verified_cond:
+            if not self.fs.verified_cond.wait_for(lambda: piece.verified or self.closed, self.timeout):
+                raise TimeoutError(f'Piece {index} was not verified within {self.timeout} s')
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        # Waiting for the first byte is counted as time to first byte, not as a stall
+        if self.first_byte is not None:
+            stall = time.monotonic() - started
+            self.stalls += 1
+            self.stall_time += stall
+            self.longest_stall = max(self.longest_stall, stall)
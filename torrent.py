@@ -1,11 +1,25 @@
 import hashlib
 import math
 import os
+import time
+import threading
 from typing import List
 
 from bitarray import bitarray
 
+from readcache import ReadCache
+from diskio import DiskIO, FSYNC_COMPLETE
+
 BLOCK_SIZE = 16384
+CACHE_SIZE = 64 * 1024 * 1024
+# Seconds before a piece whose write failed is written again
+WRITE_RETRY = 5
+
+# File priorities, a piece gets the highest priority of the files it overlaps
+PRIORITY_SKIP = 0
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 2
+PRIORITIES = {'skip': PRIORITY_SKIP, 'normal': PRIORITY_NORMAL, 'high': PRIORITY_HIGH}
 
 class ErrorTorrent(Exception):
     pass
@@ -14,8 +28,10 @@ class ErrorPiece(Exception):
     pass
 
 class File:
-    def __init__(self, file):
+    def __init__(self, file, offset: int = 0):
         self.length = file['length']
+        self.offset = offset
+        self.priority = PRIORITY_NORMAL
         self.path = file['path']
         if type(self.path) != str:
             self.path = os.path.join(*file['path'])
@@ -23,8 +39,10 @@ class File:
     @staticmethod
     def init_file_list(files) -> List:
         file_list = []
+        offset = 0
         for file in files:
-            file_list.append(File(file))
+            file_list.append(File(file, offset))
+            offset += file['length']
 
         return file_list
     
@@ -32,7 +50,7 @@ class File:
         return self.length
     
     def __repr__(self) -> str:
-            return f"File(length={self.length}, path={self.path})"
+            return f"File(length={self.length}, offset={self.offset}, path={self.path}, priority={self.priority})"
     
 class Piece:
     def __init__(self, length: int, hash: bytes):
@@ -69,6 +87,15 @@ class Piece:
         else:
             raise ErrorPiece(f"Attempting to overwrite data in verified piece")
 
+    def release(self) -> None:
+        # Data is on disk, drop the in-memory copy
+        if self.verified:
+            self.blocks = None
+            self._stored_blocks = None
+
+    def in_memory(self) -> bool:
+        return self.blocks is not None
+
     def get_block(self, begin: int, length: int) -> bytearray:
         if length + begin > self.length:
             raise ValueError(f"Requested block outside of bounds: begin={begin}, length={length}, piece_length={self.length}")
@@ -114,18 +141,109 @@ class Piece:
         return f"Piece(length={self.length}, hash={self.hash}, verified={self.verified})"
     
 class Torrent:
-    def __init__(self, piece_length: int, hash_list: List[bytes], files: List[dict]):
+    def __init__(self, piece_length: int, hash_list: List[bytes], files: List[dict], cache_size: int = CACHE_SIZE, disk: DiskIO = None):
         self.piece_length = piece_length
         self.file_list = File.init_file_list(files)
         self.torrent_size = sum(map(len, self.file_list))
         self.piece_count = math.ceil(self.torrent_size / self.piece_length)
         self.piece_list = Piece.init_piece_list(self.torrent_size, self.piece_length, self.piece_count, hash_list)
         self.verified = False
+        self.shared = None
+        self.cache = ReadCache(self._read_piece, cache_size)
+        self.disk = disk if disk is not None else DiskIO()
+        self._handles = {}
+        self._handles_pid = os.getpid()
+        self._reading = {}
+        # Pieces that overlap a skipped file are kept whole in a part file, the skipped file is never created
+        if len(self.file_list) > 1:
+            self.part_dir = os.path.join(os.path.commonpath([file.path for file in self.file_list]), '.parts')
+        else:
+            self.part_dir = os.path.join(os.path.dirname(self.file_list[0].path), '.parts')
+        self.parts = set()
+        # Verified pieces whose write failed, mapped to when it is retried. They are served from memory until then
+        self.unwritten = {}
+        self._update_priorities()
+        # Streaming readers on other threads wait on verified_cond for their pieces
+        self.readers = []
+        self.verified_cond = threading.Condition()
+        self._reader_fds = {}
+        self._reader_lock = threading.Lock()
+
+    def attach_shared(self, shared) -> None:
+        # Workers share piece state only, pieces on disk are read from there by every worker
+        self.shared = shared
+        for i, piece in enumerate(self.piece_list):
+            if piece.verified:
+                shared.mark_verified(i)
+
+    def mark_verified(self, index: int) -> None:
+        # Piece was verified and written to disk by another worker
+        piece = self.piece_list[index]
+        if not piece.verified and self.priorities[index] > PRIORITY_SKIP:
+            self.wanted_left -= 1
+        piece.verified = True
+        piece.release()
+        if self._skips(index):
+            self.parts.add(index)
+        self._notify_readers()
+        if self.finished():
+            self._complete()
 
     def check_local_files(self):
         # If there is local data, check if it matches hash
         if self._read_local_data():
             self.verify_torrent()
+            self._update_priorities()
+            self._write_parts()
+            self._notify_readers()
+
+    def set_file_priority(self, index: int, priority: int) -> None:
+        if index >= len(self.file_list) or index < 0:
+            raise ValueError(f"File index out of bounds: index={index}, file_count={len(self.file_list)}")
+        self.file_list[index].priority = priority
+        self._update_priorities()
+        self._write_parts()
+
+    def finished(self) -> bool:
+        # Every piece of the files we want is verified
+        return self.wanted_left == 0
+
+    def _update_priorities(self) -> None:
+        self.priorities = [PRIORITY_SKIP] * self.piece_count
+        for file in self.file_list:
+            if file.length == 0:
+                continue
+            first = file.offset // self.piece_length
+            last = (file.offset + file.length - 1) // self.piece_length
+            # Only the first and last piece of a file can be shared with other files
+            if last - first > 1:
+                self.priorities[first + 1:last] = [file.priority] * (last - first - 1)
+            self.priorities[first] = max(self.priorities[first], file.priority)
+            self.priorities[last] = max(self.priorities[last], file.priority)
+        self.wanted_left = sum(1 for piece, priority in zip(self.piece_list, self.priorities) if priority > PRIORITY_SKIP and not piece.verified)
+
+    def _skips(self, index: int) -> bool:
+        return any(file.priority == PRIORITY_SKIP for file, _, _ in self.file_extents(index, 0, self.piece_list[index].length))
+
+    def _part_file(self, index: int) -> File:
+        return File({'length': self.piece_list[index].length, 'path': os.path.join(self.part_dir, str(index))})
+
+    def _write_parts(self) -> None:
+        # Copy part pieces into the files that are wanted now, the part file stays so the piece can still be read from it
+        for index in sorted(self.parts):
+            piece = self.piece_list[index]
+            extents = []
+            pos = 0
+            data = None
+            for file, offset, length in self.file_extents(index, 0, piece.length):
+                if file.priority != PRIORITY_SKIP:
+                    if data is None:
+                        # The part file may still be queued for writing while the piece is in memory
+                        data = bytes(piece.blocks) if piece.in_memory() else self._read_piece(index)
+                    extents.append((file, offset, data[pos:pos + length]))
+                pos += length
+            if len(extents) > 0:
+                self.disk.write(extents)
             
     def store(self, index: int, begin: int, block: bytearray) -> None:
         if index > self.piece_count or index < 0:
@@ -134,15 +252,84 @@ class Torrent:
         self.piece_list[index].add_block(begin, block)
 
         if (self.verify_piece(index)):
-            if self.verify_torrent():
-                self._write_to_disk()
+            if self.priorities[index] > PRIORITY_SKIP:
+                self.wanted_left -= 1
+            self._write_piece(index)
+            self._notify_readers()
+            if self.finished():
+                self._complete()
 
     def retrieve(self, index: int, begin: int, length: int) -> bytearray:
         if index > self.piece_count or index < 0:
             raise ValueError(f"Index out of bounds: index={index}, piece_count={self.piece_count}")
         
-        return self.piece_list[index].get_block(begin, length)
+        piece = self.piece_list[index]
+        if not piece.in_memory():
+            if length + begin > piece.length or begin < 0:
+                raise ValueError(f"Requested block outside of bounds: begin={begin}, length={length}, piece_length={piece.length}")
+            return self.cache.get(index, begin, length)
+        return piece.get_block(begin, length)
     
+    def read_verified(self, index: int, begin: int, length: int) -> bytes:
+        """
+        Reads from a verified piece on any thread, from memory until the piece is written and
+        from disk after that
+        """
+        piece = self.piece_list[index]
+        blocks = piece.blocks
+        if blocks is not None:
+            return bytes(blocks[begin:begin + length])
+        if index in self.parts:
+            extents = [(self._part_file(index), begin, length)]
+        else:
+            extents = self.file_extents(index, begin, length)
+        data = bytearray()
+        for file, offset, extent_length in extents:
+            data += os.pread(self._reader_fd(file), extent_length, offset)
+        return bytes(data)
+
+    def deadline_pieces(self) -> List[int]:
+        # Unverified pieces in the windows of the streaming readers, the ones nearest to a read position first
+        pieces = []
+        for reader in list(self.readers):
+            for distance, index in enumerate(reader.pieces()):
+                if not self.piece_list[index].verified:
+                    pieces.append((distance, index))
+        return [index for _, index in sorted(pieces)]
+
+    def _notify_readers(self) -> None:
+        if len(self.readers) > 0:
+            with self.verified_cond:
+                self.verified_cond.notify_all()
+
+    def _reader_fd(self, file: File) -> int:
+        # Separate from _handles, which belong to the event loop thread
+        with self._reader_lock:
+            if file.path not in self._reader_fds:
+                self._reader_fds[file.path] = os.open(file.path, os.O_RDONLY)
+            return self._reader_fds[file.path]
+
+    def readable(self, index: int) -> bool:
+        # retrieve() will not touch the disk, or the cache is too small to hold the piece anyway
+        piece = self.piece_list[index]
+        return piece.in_memory() or self.cache.contains(index) or piece.length > self.cache.size
+
+    def prefetch(self, index: int, callback) -> None:
+        # Read an on-disk piece into the cache on the disk pool, callback(ok) runs on the event loop
+        if index in self._reading:
+            self._reading[index].append(callback)
+            return
+        self._reading[index] = [callback]
+        self.cache.misses += 1
+        self.disk.read(self._piece_extents(index), lambda data: self._prefetched(index, data))
+
+    def _prefetched(self, index: int, data: bytes) -> None:
+        callbacks = self._reading.pop(index)
+        if data is not None:
+            self.cache.insert(index, data)
+        for callback in callbacks:
+            callback(data is not None)
+
     def get_free_blocks_in_piece(self, index: int, num_blocks=None):
         if index > self.piece_count or index < 0:
             raise ValueError(f"Index out of bounds: index={index}, piece_count={self.piece_count}")
@@ -167,6 +354,10 @@ class Torrent:
             self.verified = True
             return True
     
+    def left(self) -> int:
+        # Skipped files are not part of the download
+        return sum(piece.length for piece, priority in zip(self.piece_list, self.priorities) if priority > PRIORITY_SKIP and not piece.verified)
+
     def verified_ratio(self) -> tuple[int, int]:
         total = self.piece_count
         v = 0
@@ -176,46 +367,120 @@ class Torrent:
         return (v, total)
             
     def _read_local_data(self) -> bool:
-        pos = 0
+        # Hash existing data piece by piece, verified pieces are served from disk
+        present = set()
+        for file in self.file_list:
+            if os.path.exists(file.path) and os.stat(file.path).st_size == file.length:
+                present.add(file.path)
+
         modified = False
+        for index, piece in enumerate(self.piece_list):
+            extents = self.file_extents(index, 0, piece.length)
+            if all(file.path in present for file, _, _ in extents):
+                modified = True
+                if hashlib.sha1(self._read_piece(index)).digest() == piece.hash:
+                    piece.verified = True
+                    piece.release()
+                    continue
+            part = self._part_file(index)
+            if os.path.exists(part.path) and os.stat(part.path).st_size == part.length:
+                modified = True
+                self.parts.add(index)
+                if hashlib.sha1(self._read_piece(index)).digest() == piece.hash:
+                    piece.verified = True
+                    piece.release()
+                else:
+                    self.parts.discard(index)
+
+        return modified
+    
+    def file_extents(self, index: int, begin: int, length: int) -> List[tuple]:
+        # Map a range of a piece onto (file, file offset, length) extents
+        extents = []
+        pos = index * self.piece_length + begin
+        end = pos + length
         for file in self.file_list:
-            end = pos + file.length
-            if os.path.exists(file.path):
-                if os.stat(file.path).st_size == file.length:
-                    # Reading file
-                    with open(file.path, "rb") as f:
-                        while pos < end: 
-                            modified = True
+            if pos >= end:
+                break
+            file_end = file.offset + file.length
+            if pos < file_end and file.length > 0:
+                extent_length = min(end, file_end) - pos
+                extents.append((file, pos - file.offset, extent_length))
+                pos += extent_length
+        return extents
 
-                            index = pos // self.piece_length
-                            block_offset = pos % self.piece_length
+    def block_extent(self, index: int, begin: int, length: int):
+        # (file, offset) of a block that is on disk within a single file, None otherwise
+        piece = self.piece_list[index]
+        if piece.in_memory() or begin < 0 or length + begin > piece.length:
+            return None
+        if index in self.parts:
+            return self._file_handle(self._part_file(index)), begin
+        extents = self.file_extents(index, begin, length)
+        if len(extents) != 1:
+            return None
+        file, offset, _ = extents[0]
+        return self._file_handle(file), offset
 
-                            block_size = min([end-pos, self.piece_length-block_offset])
-                            block = f.read(block_size)
+    def _file_handle(self, file: File):
+        # Handles opened before the workers forked share their file position, each process opens its own
+        if self._handles_pid != os.getpid():
+            self._handles = {}
+            self._handles_pid = os.getpid()
+        if file.path not in self._handles:
+            self._handles[file.path] = open(file.path, "rb")
+        return self._handles[file.path]
 
-                            self.piece_list[index].add_block(block_offset, block)
+    def _piece_extents(self, index: int) -> List[tuple]:
+        if index in self.parts:
+            return [(self._part_file(index), 0, self.piece_list[index].length)]
+        return self.file_extents(index, 0, self.piece_list[index].length)
 
-                            pos += block_size
-            pos = end
+    def _read_piece(self, index: int) -> bytes:
+        data = bytearray()
+        for file, offset, length in self._piece_extents(index):
+            f = self._file_handle(file)
+            f.seek(offset)
+            data += f.read(length)
+        return bytes(data)
 
-        return modified
-    
-    def _write_to_disk(self) -> None:
+    def _write_piece(self, index: int) -> None:
+        # Hand the verified piece to the disk pool, the in-memory copy is dropped once it is written
+        piece = self.piece_list[index]
+        extents = []
         pos = 0
-        for file in self.file_list:
-            end = pos + file.length
-            with open(file.path, "wb") as f:
-                while pos < end:
-                    index = math.floor(pos / self.piece_length)
-                    block_offset = pos - index * self.piece_length
+        skips = self._skips(index)
+        for file, offset, length in self.file_extents(index, 0, piece.length):
+            if file.priority != PRIORITY_SKIP:
+                extents.append((file, offset, piece.blocks[pos:pos + length]))
+            pos += length
+        if skips:
+            extents.append((self._part_file(index), 0, piece.blocks))
+            self.parts.add(index)
+        self.disk.write(extents, lambda ok: self._written(index, ok))
 
-                    block_size = min([end-pos, self.piece_length-block_offset])
-                    block = self.retrieve(index, block_offset, block_size)
+    def _written(self, index: int, ok: bool) -> None:
+        # A failed write (ENOSPC, EIO) must not drop the only copy of a verified piece
+        if ok:
+            self.piece_list[index].release()
+            # Other workers only see the piece once they can read it from disk
+            if self.shared is not None:
+                self.shared.mark_verified(index)
+        else:
+            self.unwritten[index] = time.monotonic() + WRITE_RETRY
 
-                    f.write(block)
+    def retry_writes(self) -> None:
+        now = time.monotonic()
+        for index, retry in list(self.unwritten.items()):
+            if retry <= now:
+                del self.unwritten[index]
+                if self.piece_list[index].in_memory():
+                    self._write_piece(index)
 
-                    pos += block_size
-        pos = end
+    def _complete(self) -> None:
+        if self.shared is None or self.shared.claim_complete():
+            if self.disk.fsync_policy == FSYNC_COMPLETE:
+                self.disk.sync(self.file_list)
 
     def __repr__(self) -> str:
-        return f"Torrent(piece_length={self.piece_length}, piece_count={self.piece_count}, torrent_size={self.torrent_size}, verified={self.verified}, verified_ratio={self.verified_ratio()}, file_list={self.file_list})"
\ No newline at end of file
+        return f"Torrent(piece_length={self.piece_length}, piece_count={self.piece_count}, torrent_size={self.torrent_size}, verified={self.verified}, left={self.left()}, verified_ratio={self.verified_ratio()}, unwritten={len(self.unwritten)}, cache={self.cache}, disk={self.disk}, file_list={self.file_list})"
\ No newline at end of file
@@ -1,12 +1,38 @@
-import bencode
 import hashlib
 from collections import OrderedDict
 
+import bdecode
+
+
+class PieceHashes:
+    """
+    The 20-byte SHA1 piece hashes as slices of the torrent file, without copying them
+    """
+    def __init__(self, pieces: memoryview) -> None:
+        if len(pieces) % 20 != 0:
+            raise ValueError('Invalid torrent file')
+        self.pieces = pieces
+
+    def __len__(self) -> int:
+        return len(self.pieces) // 20
+
+    def __getitem__(self, index: int) -> memoryview:
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('Piece index out of range')
+        return self.pieces[index * 20:index * 20 + 20]
+
+    def __repr__(self) -> str:
+        return f'PieceHashes(count={len(self)})'
+
 
 class TorrentFile(object):
     info: dict
     info_hash: bytes
-    announce: str
+    info_bytes: bytes
+    pieces: PieceHashes
+    announce: str = None
     announce_list: list = None # we don't implement this and next 3
     creation_date: int = None
     comment: str = None
@@ -18,15 +44,19 @@ class TorrentFile(object):
         # read the file and set instance variables
         with open(path, 'rb') as f:
             torrent_file = f.read()
-            torrent = bencode.decode(torrent_file)
+            decoder = bdecode.Decoder(torrent_file, raw_keys=('pieces',))
+            torrent = decoder.decode()
             self._decoded = torrent
-            if 'info' not in torrent:
+            if 'info' not in torrent or 'pieces' not in torrent['info']:
                 raise ValueError('Invalid torrent file')
             self.info = torrent['info']
-            self.info_hash = hashlib.sha1(bencode.encode(self.info)).digest()
-            if 'announce' not in torrent:
-                raise ValueError('Invalid torrent file')
-            self.announce = torrent['announce']
+            # Hash the info dict as it appears in the file, re-encoding it may not give the same bytes
+            self.info_bytes = bytes(decoder.raw('info'))
+            self.info_hash = hashlib.sha1(self.info_bytes).digest()
+            self.pieces = PieceHashes(self.info['pieces'])
+            # Trackerless torrents find peers some other way
+            if 'announce' in torrent:
+                self.announce = torrent['announce']
             if 'announce-list' in torrent:
                 self.announce_list = torrent['announce-list']
             if 'creation date' in torrent:
@@ -41,7 +71,7 @@ class TorrentFile(object):
     def __repr__ (self) -> str:
         ret = 'TorrentFile('
         for key, value in self.__dict__.items():
-            if key == '_decoded':
+            if key in ('_decoded', 'info_bytes'):
                 continue
             ret += f'{key}={repr(value)}, '
         ret = ret[:-2] + ')'
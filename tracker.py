@@ -1,12 +1,45 @@
+import os
+import re
+import ssl
+import random
 import socket
+import select
 import urllib.parse
 import urllib3
 import bencode
 import time
 import struct
 import logging
+import threading
+from collections import deque
+from typing import Callable
 
-from peer import Peer
+from peer import normalize_ip
+
+def decode_compact_peers(data: bytes, family: int = socket.AF_INET) -> list[tuple]:
+    """
+    Decodes a compact peer list, a 4 byte IPv4 address (BEP 23) or a 16 byte IPv6
+    address (BEP 7) and a 2 byte port per peer, into (ip, port) tuples. Peer objects
+    are only made for the peers that are dialled
+    """
+    view = memoryview(data)
+    if family == socket.AF_INET6:
+        view = view[:len(view) - len(view) % 18]
+        return [(socket.inet_ntop(socket.AF_INET6, ip), port) for ip, port in struct.iter_unpack('!16sH', view)]
+    view = view[:len(view) - len(view) % 6]
+    return [(socket.inet_ntoa(ip), port) for ip, port in struct.iter_unpack('!4sH', view)]
+
+def dechunk(body: bytes) -> bytes:
+    # Decodes a chunked transfer encoding body
+    data = bytearray()
+    pos = 0
+    while True:
+        end = body.index(b'\r\n', pos)
+        size = int(body[pos:end].split(b';')[0], 16)
+        if size == 0:
+            return bytes(data)
+        data += body[end + 2:end + 2 + size]
+        pos = end + 4 + size
 
 class Tracker:
     url: str
@@ -17,11 +50,27 @@ class Tracker:
 
     logger: logging.Logger
 
+    s: socket.socket = None
+    events: int = 0
+    deadline: float = 0
+    failed: bool = False
+    address: tuple = None
+    default_port: int
+    # The operation waiting for the hostname to be resolved
+    pending: Callable = None
+    resolving: bool = False
+    started: bool = False
+    interval: int = None
+    min_interval: int = None
+    # (ip, port) of the peers in the last response
+    peers: list
+
     def __init__(self, url: str, info_hash: str, peer_id: bytes, port: int) -> None:
         self.url = url
         self.info_hash = info_hash
         self.peer_id = peer_id
         self.port = port
+        self.peers = []
         self.logger = logging.getLogger(__name__)
 
     def __repr__(self) -> str:
@@ -31,7 +80,10 @@ class Tracker:
         ret = ret[:-2] + ')'
         return ret
     
-    def make_request(self, left: int, uploaded: int, downloaded: int, no_peer_id: bool, event: str = None) -> bool:
+    def announce(self, left: int, uploaded: int, downloaded: int, no_peer_id: bool, event: str = None) -> None:
+        """
+        Starts a non-blocking announce, the event loop then calls handle() and expire()
+        """
         params = {}
 
         params['info_hash'] = self.info_hash
@@ -46,87 +98,252 @@ class Tracker:
             params['event'] = event
             
         self.logger.info(f'Sending request to {self.url}')
-        return self._request(params)
-    
-    def _request(self, params) -> bool:
+        self.failed = False
+        self._start(lambda: self._request(params))
+
+    def _start(self, operation: Callable) -> None:
+        # Hostnames are resolved on a thread, the operation runs once resume() is called with the address
+        try:
+            if self.address is None and not self._resolve_literal():
+                self.pending = operation
+                self.deadline = time.monotonic() + self.timeout
+                resolver().resolve(self)
+                return
+            operation()
+        except OSError as err:
+            self.logger.info(f'Failed to send request to {self.url}: {err}')
+            self.close()
+            self.failed = True
+
+    def resume(self) -> bool:
+        """
+        Runs the operation that waited for the address, same return values as handle()
+        """
+        operation = self.pending
+        self.pending = None
+        if self.address is None:
+            return False
+        try:
+            operation()
+        except OSError as err:
+            self.logger.info(f'Failed to send request to {self.url}: {err}')
+            self.close()
+            return False
+        return None
+
+    def _request(self, params) -> None:
+        raise NotImplementedError
+
+    def handle(self, eventmask: int) -> bool:
+        """
+        Returns True when the announce succeeded, False when it failed and None while it is in progress
+        """
         raise NotImplementedError
 
-    def _connect_socket(self, s: socket, default_port: int) -> bool:
-        host = urllib3.util.parse_url(self.url).host
-        port = urllib3.util.parse_url(self.url).port
-        if port is None:
-            port = default_port
+    def expire(self) -> bool:
+        # Deadline passed, returns False when the announce gave up and None when it is still in progress
+        self.logger.info(f'Timeout from {self.url}')
+        self.pending = None
+        self.close()
+        return False
+
+    def fileno(self) -> int:
+        return self.s.fileno() if self.s is not None else None
+
+    def finish(self) -> None:
+        # Called once the announce is over, subclasses may keep the socket for the next one
+        self.close()
+
+    def close(self) -> None:
+        if self.s is not None:
+            self.s.close()
+            self.s = None
+
+    def target(self) -> tuple:
+        url = urllib3.util.parse_url(self.url)
+        if url.host is None:
+            raise OSError(f'Invalid announce link {self.url}')
+        port = url.port if url.port is not None else self.default_port
+        # IPv6 literals keep their brackets in the url
+        return url.host.strip('[]'), port
+
+    def _resolve_literal(self) -> bool:
+        # IP addresses need no lookup, the address is resolved once and reused by later announces
+        host, port = self.target()
         try:
-            s.connect((host, port))
-        except socket.gaierror as err:
-            self.logger.info(f'Invalid announce link {self.url} {err}')
+            self.address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM, 0, socket.AI_NUMERICHOST)[0][4][:2]
+        except (socket.gaierror, UnicodeError):
             return False
         return True
     
     @staticmethod
     def create_tracker(url: str, info_hash: str, peer_id: bytes, port: int, encoding: str):
-        if url.startswith('http://'):
+        if url.startswith('http://') or url.startswith('https://'):
             return HTTPTracker(url, info_hash, peer_id, port)
         elif url.startswith('udp://'):
             return UDPTracker(url, info_hash, peer_id, port, encoding)
-        elif url.startswith('https://'):
-            raise NotImplementedError
         else:
             raise ValueError('Invalid tracker type')
 
 class HTTPTracker(Tracker):
+    """
+    Keeps one keep-alive connection (HTTPS when the url asks for it) open between announces
+    and reads responses into a buffer that is allocated once
+    """
+    timeout = 15
+    compact = True
+    buffer_size = 65536
+
+    state: str = None
+    keep_alive: bool = False
+    reused: bool = False
+
     def __init__(self, url: str, info_hash: str, peer_id: bytes, port: int) -> None:
         super().__init__(url, info_hash, peer_id, port)
+        self.https = url.startswith('https://')
+        self.default_port = 443 if self.https else 80
+        self.buffer = bytearray(self.buffer_size)
 
-    def _request(self, params: dict) -> bool:     
-        r = self._send_request(params, 5)
+    def _request(self, params: dict) -> None:
+        url = urllib3.util.parse_url(self.url)
+        if self.compact:
+            params = dict(params, compact=1)
+        url_query = urllib.parse.urlencode(params)
+        request = 'GET ' + url.path + '?' + url_query + ' HTTP/1.1\r\n'
+        request += 'Host: ' + url.host + '\r\n'
+        request += 'Connection: keep-alive\r\n'
+        request += '\r\n'
+        self.request = request.encode()
+        self.deadline = time.monotonic() + self.timeout
+        self.reused = self.s is not None and self.keep_alive
+        if self.reused:
+            self._send()
+        else:
+            self._connect()
+
+    def _connect(self) -> None:
+        self.close()
+        self.s = socket.socket(socket.AF_INET6 if ':' in self.address[0] else socket.AF_INET, socket.SOCK_STREAM)
+        self.s.setblocking(False)
+        self.s.connect_ex(self.address)
+        self.state = 'connect'
+        self.events = select.EPOLLOUT
+
+    def _send(self) -> None:
+        self.pending = memoryview(self.request)
+        self.received = 0
+        self.header_end = None
+        self.state = 'send'
+        self.events = select.EPOLLOUT
+
+    def handle(self, eventmask: int) -> bool:
         try:
-            data = bencode.decode(r)
-        except Exception as e:
-            self.logger.info(f'Received response has invalid format: {e}')
+            if self.state == 'connect':
+                err = self.s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err != 0:
+                    raise OSError(err, os.strerror(err))
+                if self.https:
+                    context = ssl.create_default_context()
+                    self.s = context.wrap_socket(self.s, server_hostname=urllib3.util.parse_url(self.url).host, do_handshake_on_connect=False)
+                    self.state = 'handshake'
+                else:
+                    self._send()
+            if self.state == 'handshake':
+                self.s.do_handshake()
+                self._send()
+            if self.state == 'send':
+                while len(self.pending) > 0:
+                    sent = self.s.send(self.pending)
+                    self.pending = self.pending[sent:]
+                self.state = 'recv'
+                self.events = select.EPOLLIN
+                return None
+            return self._recv()
+        except ssl.SSLWantReadError:
+            self.events = select.EPOLLIN
+            return None
+        except ssl.SSLWantWriteError:
+            self.events = select.EPOLLOUT
+            return None
+        except BlockingIOError:
+            return None
+        except OSError as e:
+            if self.reused and self.received == 0:
+                # The tracker closed the idle connection, open a new one
+                return self._reconnect()
+            self.logger.info(f'Failed to receive response: {e}')
+            self.close()
             return False
-        if not self._process_data(data):
-            return False
-        self.logger.info('Request succesful')
-        return True
-    
-    def _send_request(self, params: dict, timeout: int) -> bool:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.settimeout(timeout)
-        url = self.url
-        if self._connect_socket(s, 80):
-            host = urllib3.util.parse_url(url).host
-            url_path = urllib3.util.parse_url(url).path
-            url_query = urllib.parse.urlencode(params)
-            s.settimeout(timeout)
-            # send request
-            request = 'GET ' + url_path + '?' + url_query + ' HTTP/1.1\r\n'
-            request += 'Host: ' + host + '\r\n'
-            request += 'Connection: close\r\n'
-            request += '\r\n'
-            s.send(request.encode())
-            # receive response
-            response = b''
-            while True:
-                try:
-                    data = s.recv(1024)
-                except Exception as e:
-                    self.logger.info(f'Failed to receive response: {e}')
-                    return False
-                if not data:
-                    break
-                response += data
-            s.close()
+
+    def _recv(self) -> bool:
+        while True:
+            if self.received == len(self.buffer):
+                self.buffer.extend(bytearray(len(self.buffer)))
+            n = self.s.recv_into(memoryview(self.buffer)[self.received:])
+            if n == 0:
+                if self.reused and self.received == 0:
+                    return self._reconnect()
+                # Server closed the connection, whatever arrived is the response
+                self.keep_alive = False
+                return self._response(bytes(self.buffer[:self.received]))
+            self.received += n
+            response = self._complete()
+            if response is not None:
+                return self._response(response)
+
+    def _reconnect(self) -> bool:
+        self.reused = False
+        self._connect()
+        return None
+
+    def _complete(self) -> bytes:
+        # Returns the full response once the body has arrived according to the headers
+        if self.header_end is None:
+            end = self.buffer.find(b'\r\n\r\n', 0, self.received)
+            if end < 0:
+                return None
+            self.header_end = end + 4
+            headers = bytes(self.buffer[:end]).lower()
+            self.content_length = None
+            self.chunked = b'transfer-encoding: chunked' in headers
+            match = re.search(rb'content-length: *(\d+)', headers)
+            if match:
+                self.content_length = int(match.group(1))
+            self.keep_alive = b'connection: close' not in headers and (self.chunked or self.content_length is not None)
+        if self.content_length is not None:
+            if self.received >= self.header_end + self.content_length:
+                return bytes(self.buffer[:self.header_end + self.content_length])
+        elif self.chunked:
+            if self.buffer.endswith(b'0\r\n\r\n', 0, self.received):
+                return bytes(self.buffer[:self.received])
+        return None
+
+    def finish(self) -> None:
+        if not self.keep_alive:
+            self.close()
+
+    def close(self) -> None:
+        super().close()
+        self.keep_alive = False
+
+    def _response(self, response: bytes) -> bool:
+        try:
             # get status code
             status_code = int(response.split(b' ')[1])
             if status_code != 200:
                 self.logger.info(f'Status code is not 200; Response: {response}')
             # strip headers by finding b'\r\n\r\n'
-            response = response.split(b'\r\n\r\n', 1)[1]
-            return response
-        else:
-            self.logger.info('Could not connect to tracker')
+            headers, body = response.split(b'\r\n\r\n', 1)
+            if b'transfer-encoding: chunked' in headers.lower():
+                body = dechunk(body)
+            data = bencode.decode(body)
+        except Exception as e:
+            self.logger.info(f'Received response has invalid format: {e}')
             return False
+        if not self._process_data(data):
+            return False
+        self.logger.info('Request succesful')
+        return True
         
     def _process_data(self, data):
         if 'failure reason' in data:
@@ -146,79 +363,305 @@ class HTTPTracker(Tracker):
             self.complete = data['complete']
         if 'incomplete' in data:
             self.incomplete = data['incomplete']
-        if 'peers' in data:
+        if 'peers' in data and isinstance(data['peers'], (bytes, str)):
+            peers = data['peers']
+            if isinstance(peers, str):
+                # bencode decodes strings that happen to be valid utf-8
+                peers = peers.encode('utf-8')
+            self.peers = decode_compact_peers(peers)
+        elif 'peers' in data and 'peers6' in data and len(data['peers']) == 0:
+            # Some trackers send an empty peers list next to peers6
+            self.peers = []
+        elif 'peers' in data:
             self.peers = []
             for peer in data['peers']:
-                peer_obj = None
+                # The peer id is not kept, the handshake tells it
                 try:
-                    if 'peer id' in peer:
-                        peer_obj = Peer(peer['peer id'], peer['ip'], peer['port'])
-                    else:
-                        peer_obj = Peer(None, peer['ip'], peer['port'])
-                    self.peers.append(peer_obj)
-                except ValueError as e:
-                    self.logger.info(f'Failed when parsing a peer: {e} Peer: {peer} Peer Object: {peer_obj}')
+                    self.peers.append((peer['ip'], peer['port']))
+                except (KeyError, TypeError) as e:
+                    self.logger.info(f'Failed when parsing a peer: {e} Peer: {peer}')
+        if 'peers6' in data and isinstance(data['peers6'], (bytes, str)):
+            peers6 = data['peers6']
+            if isinstance(peers6, str):
+                peers6 = peers6.encode('utf-8')
+            if 'peers' not in data:
+                self.peers = []
+            self.peers = self.peers + decode_compact_peers(peers6, socket.AF_INET6)
         return True
 
+class UDPSocket:
+    """
+    One UDP socket shared by every UDP tracker (BEP 15). Responses are matched to their
+    tracker by transaction id, and connection ids are cached per tracker address.
+    """
+    connection_lifetime = 60
+
+    def __init__(self) -> None:
+        # Dual-stack so IPv4 and IPv6 trackers share it, IPv4 addresses are sent IPv4-mapped
+        try:
+            self.s = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            self.s.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        except OSError:
+            self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.s.setblocking(False)
+        self.transactions = {}
+        self.connection_ids = {}
+
+    def fileno(self) -> int:
+        return self.s.fileno()
+
+    def transaction(self, tracker) -> int:
+        while True:
+            transaction_id = random.randint(-2 ** 31, 2 ** 31 - 1)
+            if transaction_id not in self.transactions:
+                self.transactions[transaction_id] = tracker
+                return transaction_id
+
+    def forget(self, transaction_id: int) -> None:
+        self.transactions.pop(transaction_id, None)
+
+    def connection_id(self, address: tuple) -> int:
+        if address in self.connection_ids:
+            connection_id, received = self.connection_ids[address]
+            if time.monotonic() - received < self.connection_lifetime:
+                return connection_id
+        return None
+
+    def set_connection_id(self, address: tuple, connection_id: int) -> None:
+        self.connection_ids[address] = (connection_id, time.monotonic())
+
+    def sendto(self, data: bytes, address: tuple) -> None:
+        if self.s.family == socket.AF_INET6 and ':' not in address[0]:
+            address = ('::ffff:' + address[0], address[1])
+        self.s.sendto(data, address)
+
+    def receive(self) -> list[tuple]:
+        """
+        Returns (tracker, data) for every datagram that answers a pending transaction
+        """
+        responses = []
+        while True:
+            try:
+                data, address = self.s.recvfrom(65536)
+            except BlockingIOError:
+                break
+            except OSError:
+                continue
+            if len(data) < 8:
+                continue
+            transaction_id = struct.unpack('!i', data[4:8])[0]
+            tracker = self.transactions.get(transaction_id)
+            address = (normalize_ip(address[0]), address[1])
+            if tracker is not None and tracker.address == address:
+                del self.transactions[transaction_id]
+                responses.append((tracker, data))
+        return responses
+
+_udp_socket = None
+
+def udp_socket() -> UDPSocket:
+    global _udp_socket
+    if _udp_socket is None:
+        _udp_socket = UDPSocket()
+    return _udp_socket
+
+class Resolver:
+    """
+    Resolves tracker hostnames on threads, getaddrinfo blocks for as long as the DNS server
+    takes. Results are posted to a pipe that the event loop polls, and process() sets the
+    addresses on the loop thread
+    """
+    def __init__(self) -> None:
+        self.logger = logging.getLogger(__name__)
+        self.done = deque()
+        self.rfd, self.wfd = os.pipe()
+        os.set_blocking(self.rfd, False)
+        os.set_blocking(self.wfd, False)
+
+    def fileno(self) -> int:
+        return self.rfd
+
+    def resolve(self, tracker: Tracker) -> None:
+        # A lookup still stuck on a dead server is not started twice
+        if not tracker.resolving:
+            tracker.resolving = True
+            threading.Thread(target=self._work, args=(tracker, *tracker.target()), daemon=True).start()
+
+    def process(self) -> list[Tracker]:
+        """
+        Returns the trackers whose lookup finished, their address stays None when it failed
+        """
+        try:
+            os.read(self.rfd, 4096)
+        except BlockingIOError:
+            pass
+        trackers = []
+        while len(self.done) > 0:
+            tracker, address, error = self.done.popleft()
+            tracker.resolving = False
+            if address is None:
+                self.logger.info(f'Invalid announce link {tracker.url} {error}')
+            tracker.address = address
+            trackers.append(tracker)
+        return trackers
+
+    def _work(self, tracker: Tracker, host: str, port: int) -> None:
+        try:
+            address = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)[0][4][:2]
+            error = None
+        except (socket.gaierror, UnicodeError) as err:
+            address = None
+            error = err
+        self.done.append((tracker, address, error))
+        try:
+            os.write(self.wfd, b'\0')
+        except BlockingIOError:
+            # The loop has not drained earlier wakeups yet, it will see this lookup too
+            pass
+
+_resolver = None
+
+def resolver() -> Resolver:
+    global _resolver
+    if _resolver is None:
+        _resolver = Resolver()
+    return _resolver
+
 class UDPTracker(Tracker):
+    """
+    BEP 15 client on the shared UDP socket. Requests are retransmitted after 15 * 2 ^ n
+    seconds, and the tracker can scrape up to 74 info hashes per packet.
+    """
     PROTOCOL_ID: int = 0x41727101980
     connection_id: int = 0
-    connection_id_time: float
     encoding: str
+    timeout = 15
+    default_port = 6969
+    # BEP 15 allows n to go up to 8 (3840 s), a dead tracker would then hold up its tier for hours
+    max_retries = 2
+    scrape_batch = 74
+
+    operation: str = None
+    action: int = None
+    transaction_id: int = None
+    retries: int = 0
+    udp: UDPSocket = None
 
     def __init__(self, url: str, info_hash: str, peer_id: bytes, port: int, encoding: str) -> None:
         super().__init__(url, info_hash, peer_id, port)
         self.encoding = encoding
+        self.scrapes = {}
 
-    def _request(self, params: dict) -> bool:
-        transaction_id = 0
-        # set up socket
-        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        if self._connect_socket(s, 6969):
-            # connect
-            if self.connection_id == 0 or time.time() - self.connection_id_time > 3600:
-                if not self._connect(s, transaction_id):
-                    s.close()
-                    return False
+    def _request(self, params: dict) -> None:
+        self.close()
+        self.udp = udp_socket()
+        self.params = params
+        self.operation = 'announce'
+        self._next()
 
-            # announce
-            if not self._announce(s, transaction_id, params):
-                s.close()
-                return False
-            
-            s.close()
-            self.logger.info('Request succesful')
-            return True
+    def scrape(self, info_hashes: list[bytes]) -> None:
+        """
+        Starts a scrape, seeders, completed and leechers per info hash end up in self.scrapes
+        """
+        self.logger.info(f'Sending scrape to {self.url}')
+        self.failed = False
+        self._start(lambda: self._scrape(info_hashes))
+
+    def _scrape(self, info_hashes: list[bytes]) -> None:
+        self.close()
+        self.udp = udp_socket()
+        self.operation = 'scrape'
+        self.batches = [info_hashes[i:i + self.scrape_batch] for i in range(0, len(info_hashes), self.scrape_batch)]
+        self._next()
+
+    def fileno(self) -> int:
+        # Responses arrive on the shared UDP socket
+        return None
+
+    def close(self) -> None:
+        if self.udp is not None and self.transaction_id is not None:
+            self.udp.forget(self.transaction_id)
+        self.transaction_id = None
+
+    def _next(self) -> None:
+        # Sends the next request of the operation, connecting first when the connection id expired
+        self.close()
+        self.retries = 0
+        self.connection_id = self.udp.connection_id(self.address)
+        if self.connection_id is None:
+            self.action = 0
+        elif self.operation == 'announce':
+            self.action = 1
         else:
-            self.logger.info('Failed to connect to tracker')
-            return False
+            self.action = 2
+        self.transaction_id = self.udp.transaction(self)
+        self._send()
+
+    def _send(self) -> None:
+        self.deadline = time.monotonic() + self.timeout * 2 ** self.retries
+        if self.action == 0:
+            data = self._connect_request(self.transaction_id)
+        elif self.action == 1:
+            data = self._announce_request(self.transaction_id, self.params)
+        else:
+            data = self._scrape_request(self.transaction_id, self.batches[0])
+        self.udp.sendto(data, self.address)
 
-    def _connect(self, s: socket, transaction_id: int) -> bool:
-        self._connect_request(s, transaction_id)
-        response = self._udp_recv(s, 15)
-        if response is None:
-            self.logger.info('Timeout in connect')
+    def expire(self) -> bool:
+        if self.pending is not None:
+            # Still waiting for the hostname
+            return super().expire()
+        self.retries += 1
+        if self.retries > self.max_retries:
+            self.logger.info(f'Timeout from {self.url}')
+            self.close()
             return False
-        if not self._connect_response(transaction_id, response):
-            self.logger.info('Bad response')
+        if self.action != 0 and self.udp.connection_id(self.address) is None:
+            # Connection id expired while waiting, connect again first
+            self._next()
+            return None
+        try:
+            self._send()
+        except OSError as e:
+            self.logger.info(f'Failed to retransmit to {self.url}: {e}')
+            self.close()
             return False
-        
-        return True
+        return None
 
-    def _announce(self, s: socket, transaction_id: int, params: dict) -> None:
-        self._announce_request(s, transaction_id, params)
-        response = self._udp_recv(s, 15)
-        if response is None:
-            self.logger.info('Timeout in announce')
+    def receive(self, data: bytes) -> bool:
+        """
+        Handles a response from the shared socket, same return values as handle()
+        """
+        transaction_id = self.transaction_id
+        self.transaction_id = None
+        action = struct.unpack('!i', data[:4])[0]
+        if action == 3:
+            self.logger.info(f'Tracker error: {data[8:]}')
             return False
-        if not self._announce_response(transaction_id, response):
+        try:
+            if self.action == 0:
+                if not self._connect_response(transaction_id, data):
+                    self.logger.info('Bad response')
+                    return False
+                self._next()
+                return None
+            if self.action == 1:
+                if not self._announce_response(transaction_id, data):
+                    return False
+                self.logger.info('Request succesful')
+                return True
+            if not self._scrape_response(transaction_id, data, self.batches.pop(0)):
+                return False
+            if len(self.batches) > 0:
+                self._next()
+                return None
+            return True
+        except OSError as e:
+            self.logger.info(f'Failed to send request to {self.url}: {e}')
             return False
-        
-        return True
 
-    def _connect_request(self, s: socket, transaction_id: int) -> None:
-        data = struct.pack('!qii', UDPTracker.PROTOCOL_ID, 0, transaction_id)
-        s.send(data)
+    def _connect_request(self, transaction_id: int) -> bytes:
+        return struct.pack('!qii', UDPTracker.PROTOCOL_ID, 0, transaction_id)
 
     def _connect_response(self, transaction_id: int, data: bytes) -> bool:
         if data is None:
@@ -232,10 +675,10 @@ class UDPTracker(Tracker):
             self.logger.info(f'Invalid action or transaction id: transaction_id_r={transaction_id_r} transaction_id={transaction_id} action={action}')
             return False
         self.connection_id = connection_id
-        self.connection_id_time = time.time()
+        self.udp.set_connection_id(self.address, connection_id)
         return True
     
-    def _announce_request(self, s: socket, transaction_id: int, params: dict) -> None:
+    def _announce_request(self, transaction_id: int, params: dict) -> bytes:
         data = struct.pack('!qii', self.connection_id, 1, transaction_id)
         
         info_hash = params['info_hash']
@@ -266,9 +709,9 @@ class UDPTracker(Tracker):
         if 'port' in params:
             port = params['port']
         
-        data += struct.pack('!20s20sqqq', info_hash, str(peer_id).encode(encoding=self.encoding), downloaded, left, uploaded)
-        data += struct.pack('!iIiih', event, ip, key, num_want, port)
-        s.send(data)
+        data += struct.pack('!20s20sqqq', info_hash, peer_id if isinstance(peer_id, bytes) else str(peer_id).encode(encoding=self.encoding), downloaded, left, uploaded)
+        data += struct.pack('!iIiiH', event, ip, key, num_want, port)
+        return data
     
     def _announce_response(self, transaction_id: int, data: bytes) -> bool:
         if data is None:
@@ -286,23 +729,27 @@ class UDPTracker(Tracker):
         self.complete = seeders
         self.interval = interval
 
-        if len(data) != 20 + 6 * (leechers + seeders):
+        # Trackers reached over IPv6 answer with 18 byte IPv6 entries
+        family = socket.AF_INET6 if ':' in self.address[0] else socket.AF_INET
+        if (len(data) - 20) % (18 if family == socket.AF_INET6 else 6) != 0:
             self.logger.info('Invalid response length')
             return False
 
-        self.peers = []
-        for i in range(leechers + seeders):
-            ip, port = struct.unpack('!IH', data[20 + 6 * i: 20 + 6 * i + 6])
-            ip = socket.inet_ntoa(struct.pack('!I', ip))
-            peer_obj = Peer(None, ip, port)
-            self.peers.append(peer_obj)
+        self.peers = decode_compact_peers(data[20:], family)
         return True
 
-    def _udp_recv(self, s: socket, timeout: int) -> bytes:
-        s.settimeout(timeout)
-        data = None
-        try:
-            data = s.recv(4096)
-        except:
-            pass
-        return data
\ No newline at end of file
+    def _scrape_request(self, transaction_id: int, info_hashes: list[bytes]) -> bytes:
+        return struct.pack('!qii', self.connection_id, 2, transaction_id) + b''.join(info_hashes)
+
+    def _scrape_response(self, transaction_id: int, data: bytes, info_hashes: list[bytes]) -> bool:
+        if len(data) != 8 + 12 * len(info_hashes):
+            self.logger.info('Invalid response length')
+            return False
+        action, transaction_id_r = struct.unpack('!ii', data[:8])
+        if transaction_id_r != transaction_id or action != 2:
+            self.logger.info(f'Invalid action or transaction id: transaction_id_r={transaction_id_r} transaction_id={transaction_id} action={action}')
+            return False
+        for info_hash, counts in zip(info_hashes, struct.iter_unpack('!iii', memoryview(data)[8:])):
+            # seeders, completed, leechers
+            self.scrapes[info_hash] = counts
+        return True
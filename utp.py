@@ -0,0 +1,582 @@
+import os
+import time
+import heapq
+import random
+import select
+import socket
+import struct
+import logging
+import threading
+import timerfd
+
+# uTP (BEP 29), reliable streams over UDP with LEDBAT delay based congestion control
+ST_DATA = 0
+ST_FIN = 1
+ST_STATE = 2
+ST_RESET = 3
+ST_SYN = 4
+VERSION = 1
+SELECTIVE_ACK = 1
+
+HEADER = struct.Struct('!BBHIIIHH')
+PACKET_SIZE = 1400
+TARGET_DELAY = 100000
+GAIN = 1
+MIN_WINDOW = 2 * PACKET_SIZE
+MAX_WINDOW = 4 * 1024 * 1024
+RECV_WINDOW = 1024 * 1024
+MIN_TIMEOUT = 0.5
+MAX_TRANSMISSIONS = 6
+
+def timestamp() -> int:
+    return int(time.monotonic() * 1000000) & 0xffffffff
+
+def seq_less(a: int, b: int) -> bool:
+    # Sequence numbers wrap at 16 bits
+    return 0 < ((b - a) & 0xffff) < 0x8000
+
+def is_utp(data: bytes) -> bool:
+    return len(data) >= HEADER.size and data[0] & 0x0f == VERSION and data[0] >> 4 <= ST_SYN
+
+def pack(kind: int, conn_id: int, reply_micro: int, wnd: int, seq_nr: int, ack_nr: int, sack: bytes = None, payload: bytes = b'') -> bytes:
+    header = HEADER.pack(kind << 4 | VERSION, SELECTIVE_ACK if sack else 0, conn_id, timestamp(), reply_micro, wnd, seq_nr, ack_nr)
+    if sack:
+        header += bytes([0, len(sack)]) + sack
+    return header + payload
+
+def parse(data: bytes) -> tuple:
+    """
+    Returns (type, conn_id, timestamp, timestamp difference, wnd_size, seq_nr, ack_nr, sack, payload),
+    raises ValueError if the packet is malformed
+    """
+    if not is_utp(data):
+        raise ValueError('Not a uTP packet')
+    kind, extension, conn_id, ts, ts_diff, wnd, seq_nr, ack_nr = HEADER.unpack_from(data)
+    offset = HEADER.size
+    sack = None
+    while extension != 0:
+        if offset + 2 > len(data) or offset + 2 + data[offset + 1] > len(data):
+            raise ValueError('Truncated uTP extension')
+        length = data[offset + 1]
+        if extension == SELECTIVE_ACK:
+            sack = data[offset + 2:offset + 2 + length]
+        extension = data[offset]
+        offset += 2 + length
+    return kind >> 4, conn_id, ts, ts_diff, wnd, seq_nr, ack_nr, sack, data[offset:]
+
+class OutPacket:
+    def __init__(self, kind: int, seq_nr: int, payload: bytes) -> None:
+        self.kind = kind
+        self.seq_nr = seq_nr
+        self.payload = payload
+        self.sent = 0
+        self.transmissions = 0
+        self.resend = False
+
+class UTPSocket:
+    """
+    One uTP connection. Looks enough like a connected TCP socket for the peer manager, its
+    fileno is an eventfd that is readable while received data or the end of stream is waiting
+    """
+    state: str
+    cwnd: float = MIN_WINDOW
+    slow_start = True
+    peer_wnd: int = RECV_WINDOW
+    srtt: float = None
+    rttvar: float = 0
+    rto: float = 1
+    reply_micro: int = 0
+    base_delay: int = None
+    queuing_delay: int = 0
+    retransmits: int = 0
+    timeouts: int = 0
+    linger: float = 0
+
+    def __init__(self, utp, address: tuple, recv_id: int, send_id: int, seq_nr: int) -> None:
+        self.utp = utp
+        self.address = address
+        self.recv_id = recv_id
+        self.send_id = send_id
+        self.seq_nr = seq_nr
+        self.ack_nr = 0
+        self.event = os.eventfd(0, os.EFD_NONBLOCK)
+        self.connected = threading.Event()
+        self.inbuf = bytearray()
+        self.out_of_order = {}
+        self.outbuf = bytearray()
+        # Sent packets by sequence number, oldest first, and the ones waiting to be sent again
+        self.unacked = {}
+        self.resends = []
+        self.in_flight = 0
+        self.duplicate_acks = 0
+        self.last_loss = 0
+        self.pace_time = 0
+        self.base_delays = []
+        self.need_ack = False
+        self.eof = False
+        self.reset = False
+        self.closing = False
+        self.fin_nr = None
+        self.last_recv = time.monotonic()
+
+    def __repr__(self) -> str:
+        srtt = round(self.srtt * 1000) if self.srtt is not None else None
+        return f'UTPSocket({self.address}, state={self.state}, cwnd={int(self.cwnd)}, in_flight={self.in_flight}, srtt={srtt} ms, queuing_delay={self.queuing_delay // 1000} ms, retransmits={self.retransmits}, timeouts={self.timeouts})'
+
+    def fileno(self) -> int:
+        return self.event
+
+    def getpeername(self) -> tuple:
+        return self.address
+
+    def settimeout(self, timeout) -> None:
+        pass
+
+    def recv(self, size: int) -> bytes:
+        with self.utp.lock:
+            if self.reset and len(self.inbuf) == 0:
+                raise ConnectionResetError('uTP connection reset')
+            window = self.window()
+            data = bytes(self.inbuf[:size])
+            del self.inbuf[:size]
+            if len(self.inbuf) == 0 and not self.eof:
+                try:
+                    os.eventfd_read(self.event)
+                except BlockingIOError:
+                    pass
+            if window < 4 * PACKET_SIZE and len(data) > 0:
+                # The window reopened, tell the sender
+                self.need_ack = True
+                self.utp._flush(self)
+            return data
+
+    def send(self, data: bytes) -> int:
+        with self.utp.lock:
+            if self.closing or self.reset:
+                raise BrokenPipeError('uTP connection closed')
+            self.outbuf += data
+            self.utp._flush(self)
+            self.utp._arm()
+            return len(data)
+
+    def sendall(self, data: bytes) -> None:
+        self.send(data)
+
+    def sendfile(self, f, offset: int, count: int) -> int:
+        return self.send(os.pread(f.fileno(), count, offset))
+
+    def close(self) -> None:
+        with self.utp.lock:
+            if not self.closing:
+                self.closing = True
+                os.close(self.event)
+                self.utp._finish(self)
+                self.utp._arm()
+
+    def window(self) -> int:
+        return max(RECV_WINDOW - len(self.inbuf) - sum(len(payload) for payload in self.out_of_order.values()), 0)
+
+    def _readable(self) -> None:
+        if not self.closing:
+            os.eventfd_write(self.event, 1)
+
+    def _sack(self) -> bytes:
+        # Bit i acknowledges ack_nr + 2 + i
+        if len(self.out_of_order) == 0:
+            return None
+        bits = bytearray(4)
+        for seq_nr in self.out_of_order:
+            i = (seq_nr - self.ack_nr - 2) & 0xffff
+            if i < 32:
+                bits[i // 8] |= 1 << (i % 8)
+        return bytes(bits)
+
+    def _delay_sample(self, delay: int) -> None:
+        # The base delay is the lowest one way delay of the last two minutes, anything above it is queuing
+        minute = int(time.monotonic() // 60)
+        if len(self.base_delays) == 0 or self.base_delays[-1][0] != minute:
+            self.base_delays = self.base_delays[-1:] + [[minute, delay]]
+        elif ((delay - self.base_delays[-1][1]) & 0xffffffff) >= 0x80000000:
+            self.base_delays[-1][1] = delay
+        self.base_delay = self.base_delays[0][1]
+        for _, value in self.base_delays:
+            if ((value - self.base_delay) & 0xffffffff) >= 0x80000000:
+                self.base_delay = value
+        self.queuing_delay = (delay - self.base_delay) & 0xffffffff
+        if self.queuing_delay >= 0x80000000:
+            self.queuing_delay = 0
+
+    def _acked(self, acked_bytes: int) -> None:
+        # LEDBAT, grow while the queuing delay is under target and shrink once it goes over.
+        # Slow start doubles the window each round trip until the delay gets near the target
+        off_target = (TARGET_DELAY - self.queuing_delay) / TARGET_DELAY
+        cwnd = self.cwnd + GAIN * off_target * acked_bytes * PACKET_SIZE / self.cwnd
+        if self.slow_start and self.queuing_delay > TARGET_DELAY * 0.9:
+            self.slow_start = False
+        if self.slow_start:
+            cwnd = max(cwnd, self.cwnd + acked_bytes)
+        self.cwnd = min(max(cwnd, MIN_WINDOW), MAX_WINDOW)
+
+    def _rtt_sample(self, rtt: float) -> None:
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar += (abs(self.srtt - rtt) - self.rttvar) / 4
+            self.srtt += (rtt - self.srtt) / 8
+        self.rto = max(self.srtt + 4 * self.rttvar, MIN_TIMEOUT)
+
+    def _loss(self, now: float) -> None:
+        # At most one window cut per round trip
+        self.slow_start = False
+        if now - self.last_loss > (self.srtt or self.rto):
+            self.last_loss = now
+            self.cwnd = max(self.cwnd / 2, MIN_WINDOW)
+
+    def _resend(self, packet: OutPacket) -> None:
+        if not packet.resend:
+            packet.resend = True
+            self.resends.append(packet.seq_nr)
+
+class UTP:
+    """
+    uTP over one UDP socket, which also carries the DHT on the same port. Datagrams that are
+    not uTP are queued for take_datagrams. delay (seconds) and loss (0-1) are applied to
+    outgoing packets to simulate a slow link
+    """
+    connect_timeout = 2
+    idle_timeout = 180
+    linger_timeout = 10
+    max_datagrams = 1000
+    packets_sent = 0
+    packets_received = 0
+
+    def __init__(self, ip: str, port: int, ep: select.epoll, delay: float = 0, loss: float = 0) -> None:
+        self.ep = ep
+        self.delay = delay
+        self.loss = loss
+        self.logger = logging.getLogger(__name__)
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.s.setblocking(False)
+        self.s.bind((ip, port))
+        self.lock = threading.RLock()
+        self.connections = {}
+        self.datagrams = []
+        self.delayed = []
+        self.timer = timerfd.create(timerfd.CLOCK_MONOTONIC, 0)
+        ep.register(self.timer, select.EPOLLIN)
+        ep.register(self.s.fileno(), select.EPOLLIN)
+
+    def __repr__(self) -> str:
+        return f'UTP(port={self.s.getsockname()[1]}, connections={len(self.connections)}, sent={self.packets_sent}, received={self.packets_received})'
+
+    def owns(self, fileno: int) -> bool:
+        return fileno == self.timer or fileno == self.s.fileno()
+
+    def handle(self, fileno: int, eventmask: int) -> list[UTPSocket]:
+        """
+        Returns connections accepted from other peers
+        """
+        with self.lock:
+            # Re-arming the timer clears it, so it is never read
+            accepted = []
+            if fileno != self.timer:
+                accepted = self._receive()
+            self._expire()
+            self._arm()
+            return accepted
+
+    def connect(self, ip: str, port: int) -> UTPSocket:
+        """
+        Opens a connection, blocking until the peer answers or connect_timeout passes. Returns None on failure
+        """
+        if ':' in ip:
+            # The socket is IPv4, IPv6 peers are connected over TCP
+            return None
+        with self.lock:
+            recv_id = random.randrange(0xffff)
+            while ((ip, port), recv_id) in self.connections:
+                recv_id = random.randrange(0xffff)
+            conn = UTPSocket(self, (ip, port), recv_id, (recv_id + 1) & 0xffff, 1)
+            conn.state = 'syn_sent'
+            self.connections[((ip, port), recv_id)] = conn
+            conn._resend(self._queue(conn, ST_SYN, b''))
+            self._flush(conn)
+            self._arm()
+        if conn.connected.wait(self.connect_timeout) and not conn.reset:
+            return conn
+        with self.lock:
+            conn.closing = True
+            os.close(conn.event)
+            self._remove(conn)
+        return None
+
+    def take_datagrams(self) -> list:
+        datagrams = self.datagrams
+        self.datagrams = []
+        return datagrams
+
+    def close(self) -> None:
+        with self.lock:
+            for conn in list(self.connections.values()):
+                self._send(conn, ST_RESET, conn.seq_nr, b'')
+                self._remove(conn)
+            self.ep.unregister(self.timer)
+            self.ep.unregister(self.s.fileno())
+            os.close(self.timer)
+            self.s.close()
+
+    def print(self) -> None:
+        print(self)
+        for conn in self.connections.values():
+            print(conn)
+
+    def _receive(self) -> list[UTPSocket]:
+        accepted = []
+        while True:
+            try:
+                data, address = self.s.recvfrom(65536)
+            except BlockingIOError:
+                break
+            except OSError:
+                continue
+            if not is_utp(data):
+                if len(self.datagrams) < self.max_datagrams:
+                    self.datagrams.append((data, address))
+                continue
+            try:
+                conn = self._process(parse(data), address)
+            except ValueError:
+                continue
+            if conn is not None:
+                accepted.append(conn)
+        # Acks are coalesced, one per connection for everything read in this batch
+        for conn in list(self.connections.values()):
+            self._flush(conn)
+        return accepted
+
+    def _process(self, packet: tuple, address: tuple) -> UTPSocket:
+        kind, conn_id, ts, ts_diff, wnd, seq_nr, ack_nr, sack, payload = packet
+        self.packets_received += 1
+        conn = self.connections.get((address, conn_id))
+        if kind == ST_SYN:
+            conn = self.connections.get((address, (conn_id + 1) & 0xffff))
+            if conn is None:
+                conn = UTPSocket(self, address, (conn_id + 1) & 0xffff, conn_id, random.randrange(0xffff))
+                conn.state = 'connected'
+                conn.ack_nr = seq_nr
+                conn.reply_micro = (timestamp() - ts) & 0xffffffff
+                self.connections[(address, conn.recv_id)] = conn
+                conn.connected.set()
+                self._send(conn, ST_STATE, conn.seq_nr, b'')
+                return conn
+            # Our answer to the SYN was lost
+            self._send(conn, ST_STATE, conn.seq_nr, b'')
+            return None
+        if conn is None:
+            if kind != ST_RESET:
+                self._send_raw(HEADER.pack(ST_RESET << 4 | VERSION, 0, conn_id, timestamp(), 0, 0, 0, seq_nr), address)
+            return None
+        now = time.monotonic()
+        conn.last_recv = now
+        conn.reply_micro = (timestamp() - ts) & 0xffffffff
+        if kind == ST_RESET:
+            self._fail(conn)
+            return None
+        if conn.state == 'syn_sent':
+            if kind != ST_STATE:
+                return None
+            conn.state = 'connected'
+            conn.ack_nr = (seq_nr - 1) & 0xffff
+            conn.connected.set()
+        conn.peer_wnd = wnd
+        self._ack(conn, kind, ack_nr, sack, ts_diff, now)
+        if kind == ST_STATE:
+            return None
+        if kind == ST_FIN:
+            conn.fin_nr = seq_nr
+        conn.need_ack = True
+        if seq_nr == (conn.ack_nr + 1) & 0xffff:
+            conn.inbuf += payload
+            conn.ack_nr = seq_nr
+            while (conn.ack_nr + 1) & 0xffff in conn.out_of_order:
+                conn.ack_nr = (conn.ack_nr + 1) & 0xffff
+                conn.inbuf += conn.out_of_order.pop(conn.ack_nr)
+            if conn.fin_nr is not None and not seq_less(conn.ack_nr, conn.fin_nr):
+                conn.eof = True
+            if len(conn.inbuf) > 0 or conn.eof:
+                conn._readable()
+        elif seq_less(conn.ack_nr, seq_nr) and ((seq_nr - conn.ack_nr) & 0xffff) < RECV_WINDOW // PACKET_SIZE:
+            conn.out_of_order[seq_nr] = payload
+        return None
+
+    def _ack(self, conn: UTPSocket, kind: int, ack_nr: int, sack: bytes, ts_diff: int, now: float) -> None:
+        acked_bytes = 0
+        while len(conn.unacked) > 0:
+            seq_nr = next(iter(conn.unacked))
+            if seq_less(ack_nr, seq_nr):
+                break
+            acked_bytes += self._release(conn, seq_nr, now)
+        lost = []
+        first = (ack_nr + 1) & 0xffff
+        if sack:
+            # Selectively acked packets, a packet that three later ones got past is taken as lost
+            sacked = 0
+            for i in reversed(range(len(sack) * 8)):
+                seq_nr = (ack_nr + 2 + i) & 0xffff
+                if sack[i // 8] & (1 << (i % 8)):
+                    sacked += 1
+                    if seq_nr in conn.unacked:
+                        acked_bytes += self._release(conn, seq_nr, now)
+                elif sacked >= 3 and seq_nr in conn.unacked:
+                    lost.append(conn.unacked[seq_nr])
+            if sacked >= 3 and first in conn.unacked:
+                lost.append(conn.unacked[first])
+        elif kind == ST_STATE and acked_bytes == 0 and first in conn.unacked:
+            # Data packets repeat the ack too, only pure acks count as duplicates
+            conn.duplicate_acks += 1
+            if conn.duplicate_acks == 3:
+                lost.append(conn.unacked[first])
+        if acked_bytes > 0:
+            conn.duplicate_acks = 0
+        for packet in lost:
+            if packet.transmissions == 1 and not packet.resend:
+                conn._resend(packet)
+                conn.retransmits += 1
+                conn._loss(now)
+        if acked_bytes > 0:
+            if ts_diff != 0:
+                conn._delay_sample(ts_diff)
+            conn._acked(acked_bytes)
+
+    def _release(self, conn: UTPSocket, seq_nr: int, now: float) -> int:
+        packet = conn.unacked.pop(seq_nr)
+        conn.in_flight -= len(packet.payload)
+        if packet.transmissions == 1:
+            conn._rtt_sample(now - packet.sent)
+        return len(packet.payload)
+
+    def _queue(self, conn: UTPSocket, kind: int, payload: bytes) -> OutPacket:
+        packet = OutPacket(kind, conn.seq_nr, payload)
+        conn.unacked[conn.seq_nr] = packet
+        conn.seq_nr = (conn.seq_nr + 1) & 0xffff
+        return packet
+
+    def _flush(self, conn: UTPSocket) -> None:
+        """
+        Sends retransmissions and new data as far as the window and pacing allow, then any ack still owed
+        """
+        now = time.monotonic()
+        window = min(conn.cwnd, conn.peer_wnd)
+        # Pace the window over one round trip, with a few packets of burst
+        rate = conn.cwnd / max(conn.srtt or 0.1, 0.001)
+        conn.pace_time = max(conn.pace_time, now - 4 * PACKET_SIZE / rate)
+        while len(conn.resends) > 0 and conn.pace_time <= now:
+            packet = conn.unacked.get(conn.resends.pop(0))
+            if packet is not None and packet.resend:
+                self._transmit(conn, packet, now)
+                conn.pace_time += max(len(packet.payload), HEADER.size) / rate
+        while conn.state == 'connected' and len(conn.outbuf) > 0 and conn.pace_time <= now:
+            size = min(len(conn.outbuf), PACKET_SIZE)
+            if conn.in_flight > 0 and conn.in_flight + size > window:
+                break
+            packet = self._queue(conn, ST_DATA, bytes(conn.outbuf[:size]))
+            del conn.outbuf[:size]
+            conn.in_flight += size
+            self._transmit(conn, packet, now)
+            conn.pace_time += size / rate
+        if conn.closing and conn.state == 'connected' and len(conn.outbuf) == 0:
+            conn.state = 'fin_sent'
+            self._transmit(conn, self._queue(conn, ST_FIN, b''), now)
+        if conn.need_ack:
+            self._send(conn, ST_STATE, conn.seq_nr, b'')
+
+    def _transmit(self, conn: UTPSocket, packet: OutPacket, now: float) -> None:
+        packet.resend = False
+        packet.transmissions += 1
+        packet.sent = now
+        kind_conn_id = conn.recv_id if packet.kind == ST_SYN else conn.send_id
+        data = pack(packet.kind, kind_conn_id, conn.reply_micro, conn.window(), packet.seq_nr, conn.ack_nr, conn._sack(), packet.payload)
+        conn.need_ack = False
+        self._send_raw(data, conn.address)
+
+    def _send(self, conn: UTPSocket, kind: int, seq_nr: int, payload: bytes) -> None:
+        conn.need_ack = False
+        self._send_raw(pack(kind, conn.send_id, conn.reply_micro, conn.window(), seq_nr, conn.ack_nr, conn._sack(), payload), conn.address)
+
+    def _send_raw(self, data: bytes, address: tuple) -> None:
+        self.packets_sent += 1
+        if self.loss > 0 and random.random() < self.loss:
+            return
+        if self.delay > 0:
+            heapq.heappush(self.delayed, (time.monotonic() + self.delay, self.packets_sent, data, address))
+            return
+        try:
+            self.s.sendto(data, address)
+        except OSError as e:
+            self.logger.info(f'uTP send to {address} failed: {e}')
+
+    def _finish(self, conn: UTPSocket) -> None:
+        if conn.state in ('syn_sent', 'closed') or conn.reset or conn.eof and len(conn.unacked) == 0:
+            self._remove(conn)
+        else:
+            conn.linger = time.monotonic() + self.linger_timeout
+            self._flush(conn)
+
+    def _fail(self, conn: UTPSocket) -> None:
+        conn.reset = True
+        conn.connected.set()
+        conn._readable()
+        self._remove(conn)
+
+    def _remove(self, conn: UTPSocket) -> None:
+        conn.state = 'closed'
+        self.connections.pop((conn.address, conn.recv_id), None)
+
+    def _expire(self) -> None:
+        now = time.monotonic()
+        while len(self.delayed) > 0 and self.delayed[0][0] <= now:
+            _, _, data, address = heapq.heappop(self.delayed)
+            try:
+                self.s.sendto(data, address)
+            except OSError:
+                pass
+        for conn in list(self.connections.values()):
+            if conn.closing and (len(conn.unacked) == 0 and conn.state == 'fin_sent' or now >= conn.linger):
+                self._remove(conn)
+                continue
+            if not conn.closing and now - conn.last_recv > self.idle_timeout:
+                self._fail(conn)
+                continue
+            oldest = next(iter(conn.unacked.values()), None)
+            if oldest is not None and not oldest.resend and now - oldest.sent >= conn.rto:
+                if oldest.transmissions >= MAX_TRANSMISSIONS:
+                    self._fail(conn)
+                    continue
+                # Nothing came back for a whole timeout, start over from the smallest window
+                conn.timeouts += 1
+                conn.rto = min(conn.rto * 2, 30)
+                conn.cwnd = MIN_WINDOW
+                conn.slow_start = False
+                for packet in conn.unacked.values():
+                    if not packet.resend:
+                        conn._resend(packet)
+                        conn.retransmits += 1
+            self._flush(conn)
+
+    def _arm(self) -> None:
+        deadlines = [self.delayed[0][0]] if len(self.delayed) > 0 else []
+        for conn in self.connections.values():
+            oldest = next(iter(conn.unacked.values()), None)
+            if oldest is not None and not oldest.resend:
+                deadlines.append(oldest.sent + conn.rto)
+            if len(conn.outbuf) > 0 or len(conn.resends) > 0:
+                deadlines.append(conn.pace_time)
+            if conn.closing:
+                deadlines.append(conn.linger)
+            else:
+                deadlines.append(conn.last_recv + self.idle_timeout)
+        if len(deadlines) == 0:
+            timerfd.settime(self.timer, 0, 0, 0)
+            return
+        timerfd.settime(self.timer, 0, max(min(deadlines) - time.monotonic(), 0.001), 0)